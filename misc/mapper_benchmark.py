@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+'''Measure the performance of the mapper endpoints.
+
+This seeds a number of projects with mappings, driving /insert and
+/insert/ignoredups through the Flask test client, then measures revision
+lookups (/rev/git and /rev/hg) and map file downloads (/mapfile/full and
+/mapfile/since) against the seeded data.  For each operation, it reports the
+number of requests, the 50th and 99th percentile request latency, the rows
+handled per second, and the peak RSS of the process so far, as JSON.
+
+By default it uses an in-memory and an on-disk SQLite database; pass --uri
+(more than once, if you like) to measure another database, such as a scratch
+MySQL instance:
+
+    misc/mapper_benchmark.py --projects 4 --rows 100000 \\
+        --uri mysql://root@localhost/mapper_bench --output before.json
+
+Note that the tables in the given databases are dropped and re-created!
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from relengapi.app import create_app
+from relengapi.blueprints.mapper import Hash
+from relengapi.blueprints.mapper import Project
+from relengapi.lib import auth
+from relengapi.lib.permissions import p
+
+
+def make_app(uri):
+    app = create_app(test_config={
+        'TESTING': True,
+        'SECRET_KEY': 'benchmark',
+        'SQLALCHEMY_DATABASE_URIS': {'mapper': uri},
+    })
+    user = auth.HumanUser('benchmark@example.com')
+    user._permissions = set([p.mapper.mapping.insert, p.mapper.project.insert])
+
+    @app.before_request
+    def set_user():
+        auth.login_manager.reload_user(user)
+
+    return app
+
+
+def reset_db(app, projects):
+    meta = app.db.metadata['mapper']
+    engine = app.db.engine('mapper')
+    meta.drop_all(bind=engine)
+    meta.create_all(bind=engine)
+    session = app.db.session('mapper')
+    for project in projects:
+        session.add(Project(name=project))
+    session.commit()
+    app.db.flush_sessions()
+    app.mapper_rev_cache.clear()
+    app.mapper_projects.invalidate()
+
+
+def backdate(app, seconds):
+    session = app.db.session('mapper')
+    session.execute(Hash.__table__.update().values(
+        date_added=Hash.date_added - seconds))
+    session.commit()
+    app.db.flush_sessions()
+
+
+def git_sha(project, i):
+    return hashlib.sha1('git %s %d' % (project, i)).hexdigest()
+
+
+def hg_sha(project, i):
+    return hashlib.sha1('hg %s %d' % (project, i)).hexdigest()
+
+
+def mapfile(project, start, stop):
+    return ''.join('%s %s\n' % (git_sha(project, i), hg_sha(project, i))
+                   for i in xrange(start, stop))
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X reports bytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def percentile(sorted_values, pct):
+    # nearest-rank percentile
+    rank = max(0, int(round(pct / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[rank]
+
+
+class Operation(object):
+
+    """Latencies and row counts of the requests for one operation"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.rows = 0
+
+    def request(self, method, path, expect_rows=None, **kwargs):
+        start = time.time()
+        rv = method(path, **kwargs)
+        # map files are streamed, so the time to read the body counts
+        data = rv.data
+        self.latencies.append(time.time() - start)
+        if rv.status_code != 200:
+            raise RuntimeError('%s returned %d' % (path, rv.status_code))
+        if expect_rows is None:
+            expect_rows = data.count('\n')
+        self.rows += expect_rows
+        return data
+
+    def result(self, uri):
+        latencies = sorted(self.latencies)
+        elapsed = sum(latencies)
+        return {
+            'uri': uri,
+            'operation': self.name,
+            'requests': len(latencies),
+            'rows': self.rows,
+            'elapsed_s': round(elapsed, 4),
+            'p50_ms': round(1000 * percentile(latencies, 50), 3),
+            'p99_ms': round(1000 * percentile(latencies, 99), 3),
+            'rows_per_s': round(self.rows / elapsed, 1) if elapsed else None,
+            'peak_rss_kb': peak_rss_kb(),
+        }
+
+
+def insert(client, op, projects, start, stop, batch, ignoredups=False):
+    suffix = '/ignoredups' if ignoredups else ''
+    for project in projects:
+        for first in xrange(start, stop, batch):
+            last = min(first + batch, stop)
+            op.request(client.post, '/mapper/%s/insert%s' % (project, suffix),
+                       expect_rows=last - first, content_type='text/plain',
+                       data=mapfile(project, first, last))
+
+
+def run(uri, args):
+    app = make_app(uri)
+    client = app.test_client()
+    projects = ['bench%d' % i for i in xrange(args.projects)]
+    rows = args.rows
+    rand = random.Random(args.seed)
+    ops = []
+
+    def op(name):
+        ops.append(Operation(name))
+        return ops[-1]
+
+    reset_db(app, projects)
+    insert(client, op('insert'), projects, 0, rows, args.batch)
+
+    # half of these mappings already exist
+    reset_db(app, projects)
+    insert(client, Operation('setup'), projects, 0, rows // 2, args.batch)
+    # backdate the first half, so that /mapfile/since can select the second
+    backdate(app, 3600)
+    insert(client, op('insert/ignoredups'), projects, 0, rows, args.batch,
+           ignoredups=True)
+
+    # the database now contains `rows` mappings for each project
+    lookups = [(rand.choice(projects), rand.randrange(rows))
+               for _ in xrange(args.lookups)]
+    for name, vcs, sha, prefix, cached in [
+        ('rev/git', 'git', git_sha, 40, False),
+        ('rev/git (prefix)', 'git', git_sha, 12, False),
+        ('rev/git (cached)', 'git', git_sha, 40, True),
+        ('rev/hg', 'hg', hg_sha, 40, False),
+        ('rev/hg (prefix)', 'hg', hg_sha, 12, False),
+    ]:
+        lookup_op = op(name)
+        for project, i in lookups:
+            if not cached:
+                app.mapper_rev_cache.clear()
+            lookup_op.request(client.get, '/mapper/%s/rev/%s/%s' % (
+                project, vcs, sha(project, i)[:prefix]), expect_rows=1)
+
+    full_op = op('mapfile/full')
+    for _ in xrange(args.repeat):
+        for project in projects:
+            full_op.request(client.get, '/mapper/%s/mapfile/full' % project)
+
+    # the second half of each project's mappings
+    since_op = op('mapfile/since')
+    since = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - 1800))
+    for _ in xrange(args.repeat):
+        for project in projects:
+            since_op.request(client.get, '/mapper/%s/mapfile/since/%s' % (project, since))
+
+    return [o.result(uri) for o in ops]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--projects', type=int, default=4,
+                        help='number of projects to seed')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='number of mappings per project')
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='number of mappings per insert request')
+    parser.add_argument('--lookups', type=int, default=1000,
+                        help='number of revision lookups per operation')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of map file downloads per project')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed used to pick revisions to look up')
+    parser.add_argument('--uri', action='append', dest='uris',
+                        help='SQLAlchemy URI of a database to benchmark')
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout,
+                        help='file to write the JSON results to')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        uris = args.uris or [
+            'sqlite://',
+            'sqlite:///%s' % os.path.join(tmpdir, 'mapper.db'),
+        ]
+        results = []
+        for uri in uris:
+            results.extend(run(uri, args))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    config = dict((k, getattr(args, k))
+                  for k in ('projects', 'rows', 'batch', 'lookups', 'repeat', 'seed'))
+    json.dump({'config': config, 'results': results}, args.output,
+              indent=4, sort_keys=True)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+'''Measure the performance of the tooltool file and batch searches.
+
+This seeds the database with a number of upload batches, each containing
+several files, and builds the search index with `relengapi tooltool-reindex`'s
+implementation.  It then runs a set of file and batch searches, both with the
+search index and the way the /tooltool/file and /tooltool/upload endpoints
+searched before the index existed.  For each, it reports
+the number of queries, the 50th and 99th percentile latency, and the peak RSS
+of the process so far, as JSON.
+
+By default it uses an on-disk SQLite database and a million batch files; pass
+--uri to measure another database, such as a scratch MySQL instance:
+
+    misc/tooltool_search_benchmark.py --batch-files 1000000 \\
+        --uri mysql://root@localhost/tooltool_bench --output after.json
+
+Note that the tables in the given database are dropped and re-created!
+'''
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import resource
+import shutil
+import sqlalchemy as sa
+import sys
+import tempfile
+import time
+
+from relengapi.app import create_app
+from relengapi.blueprints.tooltool import search
+from relengapi.blueprints.tooltool import tables
+
+# rows per insert statement while seeding
+INSERT_CHUNK_SIZE = 10000
+
+TOOLS = ['gcc', 'clang', 'binutils', 'cmake', 'yasm', 'rustc', 'cargo', 'sccache',
+         'android-sdk', 'android-ndk', 'xcode', 'mingw', 'python', 'node', 'gtk3']
+EXTENSIONS = ['tar.xz', 'tar.bz2', 'tar.gz', 'zip', 'dmg', 'exe']
+AUTHORS = ['user%d@example.com' % i for i in xrange(50)]
+
+
+def make_app(uri):
+    return create_app(test_config={
+        'TESTING': True,
+        'SECRET_KEY': 'benchmark',
+        'SQLALCHEMY_DATABASE_URIS': {'relengapi': uri},
+        'TOOLTOOL_REGIONS': {'us-east-1': 'tt-use1'},
+    })
+
+
+def reset_db(app):
+    meta = app.db.metadata['relengapi']
+    engine = app.db.engine('relengapi')
+    meta.drop_all(bind=engine)
+    meta.create_all(bind=engine)
+
+
+def digest(i):
+    return hashlib.sha512('file %d' % i).hexdigest()
+
+
+def filename(rand, i):
+    return '%s-%d.%d.%d.%s' % (rand.choice(TOOLS), i % 10, i % 97, i,
+                               rand.choice(EXTENSIONS))
+
+
+def seed(app, rand, batch_files, files_per_batch):
+    # use Core inserts; the ORM would index rows as they are inserted, but
+    # the index is built separately so that its cost can be measured
+    engine = app.db.engine('relengapi')
+    f_tbl = tables.File.__table__
+    b_tbl = tables.Batch.__table__
+    bf_tbl = tables.BatchFile.__table__
+    uploaded = datetime.datetime.utcnow()
+    num_batches = (batch_files + files_per_batch - 1) // files_per_batch
+    batches_per_chunk = max(1, INSERT_CHUNK_SIZE // files_per_batch)
+    for first in xrange(0, num_batches, batches_per_chunk):
+        batch_ids = range(first, min(first + batches_per_chunk, num_batches))
+        file_ids = range(batch_ids[0] * files_per_batch,
+                         min((batch_ids[-1] + 1) * files_per_batch, batch_files))
+        with engine.begin() as conn:
+            conn.execute(f_tbl.insert(), [
+                dict(id=i + 1, size=i, sha512=digest(i), visibility='public')
+                for i in file_ids])
+            conn.execute(b_tbl.insert(), [
+                dict(id=b + 1, author=rand.choice(AUTHORS), uploaded=uploaded,
+                     message='Update %s to %d.%d' % (rand.choice(TOOLS), b % 10, b))
+                for b in batch_ids])
+            conn.execute(bf_tbl.insert(), [
+                dict(file_id=i + 1, batch_id=i // files_per_batch + 1,
+                     filename=filename(rand, i))
+                for i in file_ids])
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X reports bytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def percentile(sorted_values, pct):
+    # nearest-rank percentile
+    rank = max(0, int(round(pct / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[rank]
+
+
+class Operation(object):
+
+    """Latencies and result counts of the queries for one operation"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.results = 0
+
+    def time(self, fn):
+        start = time.time()
+        results = fn()
+        self.latencies.append(time.time() - start)
+        self.results += results
+        return results
+
+    def result(self, uri):
+        latencies = sorted(self.latencies)
+        return {
+            'uri': uri,
+            'operation': self.name,
+            'queries': len(latencies),
+            'results': self.results,
+            'elapsed_s': round(sum(latencies), 4),
+            'p50_ms': round(1000 * percentile(latencies, 50), 3),
+            'p99_ms': round(1000 * percentile(latencies, 99), 3),
+            'peak_rss_kb': peak_rss_kb(),
+        }
+
+
+def indexed(app, search_fn, q, limit):
+    def fn():
+        with app.app_context():
+            return len(search_fn(app.db.session('relengapi'), q, limit))
+    return fn
+
+
+def legacy_files(app, q):
+    # the query /tooltool/file used before the search index existed
+    def fn():
+        with app.app_context():
+            query = app.db.session('relengapi').query(tables.File).join(tables.BatchFile)
+            query = query.filter(sa.or_(
+                tables.BatchFile.filename.contains(q),
+                tables.File.sha512.startswith(q)))
+            return len(query.all())
+    return fn
+
+
+def legacy_batches(app, q):
+    # the query /tooltool/upload used before the search index existed
+    def fn():
+        with app.app_context():
+            tbl = tables.Batch
+            return len(tbl.query.filter(sa.or_(
+                tbl.author.contains(q),
+                tbl.message.contains(q))).all())
+    return fn
+
+
+def run(uri, args):
+    app = make_app(uri)
+    rand = random.Random(args.seed)
+    ops = []
+
+    reset_db(app)
+    seed(app, rand, args.batch_files, args.files_per_batch)
+
+    reindex_op = Operation('reindex')
+    ops.append(reindex_op)
+    with app.app_context():
+        reindex_op.time(lambda: search.reindex(app.db.session('relengapi')) or 0)
+
+    rare = args.batch_files // 2
+    batch = rare // args.files_per_batch
+    queries = [
+        ('file', 'rare filename', lambda: '.%d.%d.' % (rare % 97, rare)),
+        ('file', 'common filename', lambda: 'clang-'),
+        ('file', 'digest prefix', lambda: digest(rand.randrange(args.batch_files))[:12]),
+        ('file', 'short query', lambda: 'gc'),
+        ('batch', 'batch message', lambda: 'to %d.%d' % (batch % 10, batch)),
+        ('batch', 'batch author', lambda: 'user7@'),
+    ]
+    for kind, name, make_q in queries:
+        new_op = Operation('%s: %s' % (kind, name))
+        old_op = Operation('%s: %s (unindexed)' % (kind, name))
+        ops.extend([new_op, old_op])
+        for _ in xrange(args.repeat):
+            q = make_q()
+            if kind == 'file':
+                new_op.time(indexed(app, search.search_files, q, args.limit))
+                old_op.time(legacy_files(app, q))
+            else:
+                new_op.time(indexed(app, search.search_batches, q, args.limit))
+                old_op.time(legacy_batches(app, q))
+
+    return [o.result(uri) for o in ops]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--batch-files', type=int, default=1000000,
+                        help='number of batch files to seed')
+    parser.add_argument('--files-per-batch', type=int, default=10,
+                        help='number of files in each seeded batch')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of times to run each query')
+    parser.add_argument('--limit', type=int, default=100,
+                        help='maximum number of results for indexed queries')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed used to generate the data')
+    parser.add_argument('--uri',
+                        help='SQLAlchemy URI of a database to benchmark')
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout,
+                        help='file to write the JSON results to')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        uri = args.uri or 'sqlite:///%s' % os.path.join(tmpdir, 'tooltool.db')
+        results = run(uri, args)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    config = dict((k, getattr(args, k))
+                  for k in ('batch_files', 'files_per_batch', 'repeat', 'limit', 'seed'))
+    json.dump({'config': config, 'results': results}, args.output,
+              indent=4, sort_keys=True)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
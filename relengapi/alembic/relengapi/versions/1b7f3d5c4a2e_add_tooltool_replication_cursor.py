@@ -0,0 +1,28 @@
+"""add tooltool_replication_cursor
+
+Revision ID: 1b7f3d5c4a2e
+Revises: 4a2bc0e1e5d4
+Create Date: 2026-10-18 10:03:17.220915
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '1b7f3d5c4a2e'
+down_revision = '4a2bc0e1e5d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('tooltool_replication_cursor',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('file_id', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    op.drop_table('tooltool_replication_cursor')
@@ -0,0 +1,101 @@
+"""add tooltool search trigram tables
+
+Revision ID: 2e6b9a0f4c71
+Revises: 5c81e2f09d3b
+Create Date: 2026-10-18 14:21:40.118204
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '2e6b9a0f4c71'
+down_revision = '5c81e2f09d3b'
+branch_labels = None
+depends_on = None
+
+
+# number of rows indexed at a time while upgrading
+CHUNK_SIZE = 1000
+
+files = sa.table('tooltool_files', sa.column('id', sa.Integer))
+batch_files = sa.table('tooltool_batch_files',
+                       sa.column('file_id', sa.Integer),
+                       sa.column('filename', sa.Text))
+batches = sa.table('tooltool_batches',
+                   sa.column('id', sa.Integer),
+                   sa.column('author', sa.Text),
+                   sa.column('message', sa.Text))
+filename_trigrams = sa.table('tooltool_filename_trigrams',
+                             sa.column('trigram', sa.String),
+                             sa.column('file_id', sa.Integer))
+batch_trigrams = sa.table('tooltool_batch_trigrams',
+                          sa.column('trigram', sa.String),
+                          sa.column('batch_id', sa.Integer))
+
+
+def trigrams(text):
+    # this must match relengapi.blueprints.tooltool.search.trigrams
+    text = text.lower()
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+def index_existing_rows():
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        file_ids = [r[0] for r in conn.execute(
+            sa.select([files.c.id]).where(files.c.id > last_id).order_by(
+                files.c.id).limit(CHUNK_SIZE))]
+        if not file_ids:
+            break
+        grams = {}
+        for file_id, filename in conn.execute(
+                sa.select([batch_files.c.file_id, batch_files.c.filename]).where(
+                    batch_files.c.file_id.in_(file_ids))):
+            grams.setdefault(file_id, set()).update(trigrams(filename))
+        rows = [{'file_id': file_id, 'trigram': gram}
+                for file_id, file_grams in grams.iteritems() for gram in file_grams]
+        if rows:
+            conn.execute(filename_trigrams.insert(), rows)
+        last_id = file_ids[-1]
+
+    last_id = 0
+    while True:
+        chunk = conn.execute(
+            sa.select([batches.c.id, batches.c.author, batches.c.message]).where(
+                batches.c.id > last_id).order_by(batches.c.id).limit(CHUNK_SIZE)).fetchall()
+        if not chunk:
+            break
+        rows = [{'batch_id': batch_id, 'trigram': gram}
+                for batch_id, author, message in chunk
+                for gram in trigrams(author) | trigrams(message)]
+        if rows:
+            conn.execute(batch_trigrams.insert(), rows)
+        last_id = chunk[-1][0]
+
+
+def upgrade():
+    op.create_table('tooltool_filename_trigrams',
+                    sa.Column('trigram', sa.String(length=3), nullable=False),
+                    sa.Column('file_id', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['file_id'], ['tooltool_files.id'], ))
+    op.create_index('ix_tooltool_filename_trigrams_trigram', 'tooltool_filename_trigrams',
+                    ['trigram', 'file_id'], unique=False)
+    op.create_table('tooltool_batch_trigrams',
+                    sa.Column('trigram', sa.String(length=3), nullable=False),
+                    sa.Column('batch_id', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['batch_id'], ['tooltool_batches.id'], ))
+    op.create_index('ix_tooltool_batch_trigrams_trigram', 'tooltool_batch_trigrams',
+                    ['trigram', 'batch_id'], unique=False)
+    index_existing_rows()
+
+
+def downgrade():
+    op.drop_index('ix_tooltool_batch_trigrams_trigram', table_name='tooltool_batch_trigrams')
+    op.drop_table('tooltool_batch_trigrams')
+    op.drop_index('ix_tooltool_filename_trigrams_trigram',
+                  table_name='tooltool_filename_trigrams')
+    op.drop_table('tooltool_filename_trigrams')
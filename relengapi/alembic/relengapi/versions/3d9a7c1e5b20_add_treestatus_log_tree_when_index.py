@@ -0,0 +1,24 @@
+"""add an index on treestatus_log tree and when
+
+Revision ID: 3d9a7c1e5b20
+Revises: 2e6b9a0f4c71
+Create Date: 2026-10-18 19:02:13.540817
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3d9a7c1e5b20'
+down_revision = '2e6b9a0f4c71'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_treestatus_log_tree_when', 'treestatus_log',
+                    ['tree', 'when'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_treestatus_log_tree_when', table_name='treestatus_log')
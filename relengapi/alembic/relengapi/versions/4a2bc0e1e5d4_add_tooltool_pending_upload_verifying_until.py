@@ -0,0 +1,26 @@
+"""add tooltool_pending_upload.verifying_until
+
+Revision ID: 4a2bc0e1e5d4
+Revises: 993e4d841aa
+Create Date: 2026-10-18 09:12:41.503218
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '4a2bc0e1e5d4'
+down_revision = '993e4d841aa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tooltool_pending_upload',
+                  sa.Column('verifying_until', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('tooltool_pending_upload', 'verifying_until')
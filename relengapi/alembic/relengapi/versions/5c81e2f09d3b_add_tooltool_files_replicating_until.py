@@ -0,0 +1,26 @@
+"""add tooltool_files.replicating_until
+
+Revision ID: 5c81e2f09d3b
+Revises: 1b7f3d5c4a2e
+Create Date: 2026-10-18 10:41:55.817306
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5c81e2f09d3b'
+down_revision = '1b7f3d5c4a2e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tooltool_files',
+                  sa.Column('replicating_until', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('tooltool_files', 'replicating_until')
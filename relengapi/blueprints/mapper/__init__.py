@@ -2,8 +2,12 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import base64
 import calendar
+import collections
 import dateutil.parser
+import heapq
+import itertools
 import re
 import sqlalchemy as sa
 import structlog
@@ -12,9 +16,13 @@ import time
 from flask import Blueprint
 from flask import Response
 from flask import abort
+from flask import current_app
 from flask import g
 from flask import jsonify
 from flask import request
+from relengapi import util
+from relengapi.blueprints.mapper import snapshots
+from relengapi.lib import badpenny
 from relengapi.lib import db
 from sqlalchemy import orm
 from sqlalchemy.orm.exc import MultipleResultsFound
@@ -31,6 +39,44 @@ p.mapper.mapping.insert.doc("Allows new hg-git mappings to be inserted "
 p.mapper.project.insert.doc("Allows new projects to be inserted into "
                             "mapper db (projects table)")
 
+# number of rows fetched per query when streaming a mapfile
+MAPFILE_PAGE_SIZE = 10000
+
+# default and maximum number of mappings returned by each request to the
+# cursor-based feed
+FEED_PAGE_SIZE = 10000
+
+# the feed only returns mappings added at least this many seconds ago, giving
+# the transactions which inserted them time to commit
+FEED_SETTLE_TIME = 60
+
+# a snapshot's watermark is this many seconds before the newest mapping it
+# contains; mappings added since the watermark are always read from the
+# database, so mappings which commit shortly after the snapshot is written,
+# with a date_added before its newest mapping, are not left out
+SNAPSHOT_MARGIN = 60
+
+# number of mappings parsed, checked and inserted together by the bulk insert
+# endpoints; this keeps the duplicate check well under SQLite's limit of 999
+# bound parameters per statement
+INSERT_CHUNK_SIZE = 400
+
+# number of full SHAs resolved by each query of the batch revision endpoint
+REVS_CHUNK_SIZE = 400
+
+# number of resolved revisions cached by each process
+REV_CACHE_SIZE = 10000
+
+# maximum age, in seconds, of each process's copy of the projects table
+PROJECT_CACHE_TTL = 60
+
+# dialect-specific prefixes that make an INSERT silently skip rows violating
+# a unique index
+_INSERT_IGNORE_PREFIXES = {
+    'mysql': 'IGNORE',
+    'sqlite': 'OR IGNORE',
+}
+
 # TODO: replace abort with a custom exception
 # - http://flask.pocoo.org/docs/patterns/apierrors/
 
@@ -87,37 +133,145 @@ class Hash(db.declarative_base('mapper')):
     }
 
 
-def _project_filter(projects_arg):
-    """Helper method that returns the SQLAlchemy filter expression for the
-    project name(s) specified. This can be a comma-separated list, which is
-    the way we combine queries across multiple projects.
+class ProjectCache(object):
+
+    """A process-wide mapping of project names to ids.
+
+    Projects are rarely added, so the whole projects table is loaded at once,
+    when the first request is handled, and loaded again when this copy is
+    more than PROJECT_CACHE_TTL seconds old or after invalidate() is called.
+    A name that is not found also causes a reload, in case the project was
+    just added by another process, but at most once per PROJECT_CACHE_TTL, so
+    that requests for nonexistent projects cannot force a reload each time.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._loaded = None
+        self._reloaded_for_miss = None
+
+    def _load(self):
+        session = current_app.db.session('mapper')
+        self._ids = dict(session.query(Project.name, Project.id))
+        self._loaded = time.time()
+
+    def get(self, names):
+        """Return the ids of the given project names; names that do not exist
+        are omitted."""
+        now = time.time()
+        if self._loaded is None or now - self._loaded > PROJECT_CACHE_TTL:
+            self._load()
+        elif any(n not in self._ids for n in names) and (
+                self._reloaded_for_miss is None or
+                now - self._reloaded_for_miss > PROJECT_CACHE_TTL):
+            self._reloaded_for_miss = now
+            self._load()
+        ids = self._ids
+        return [ids[n] for n in names if n in ids]
+
+    def invalidate(self):
+        self._loaded = None
+        self._reloaded_for_miss = None
+
+
+def _project_ids(projects_arg):
+    """Helper method to look up the ids of the project(s) specified.
 
     Args:
         projects_arg: Comma-separated list of project names
 
     Returns:
-        A SQLAlchemy filter expression
+        A list of project ids; names that do not exist are omitted
     """
-    if ',' in projects_arg:
-        return Project.name.in_(projects_arg.split(','))
-    else:
-        return Project.name == projects_arg
+    return current_app.mapper_projects.get(projects_arg.split(','))
+
+
+# a row of a map file, ordered by hg changeset and then project id
+_MapfileRow = collections.namedtuple('_MapfileRow', 'hg_changeset project_id git_commit')
+
+
+def _project_mapfile_rows(engine, project_id, criteria, page_size):
+    # generate the project's mapping rows matching the criteria, in order of
+    # hg changeset, a page at a time using keyset pagination over the
+    # (project_id, hg_changeset) index
+    last = None
+    while True:
+        sel = sa.select([Hash.hg_changeset, Hash.project_id, Hash.git_commit])
+        sel = sel.where(sa.and_(Hash.project_id == project_id, *criteria))
+        if last is not None:
+            sel = sel.where(Hash.hg_changeset > last)
+        sel = sel.order_by(Hash.hg_changeset).limit(page_size)
+        rows = engine.execute(sel).fetchall()
+        for row in rows:
+            yield _MapfileRow(*row)
+        if len(rows) < page_size:
+            return
+        last = rows[-1].hg_changeset
+
+
+def _mapfile_pages(engine, project_ids, criteria, page_size):
+    """Generate successive pages of mapping rows for the given projects
+    matching the given criteria, ordered by hg changeset.
+
+    Each project's rows are read with separate Core selects, using keyset
+    pagination over the (project_id, hg_changeset) index, so the cost of a
+    query does not depend on how far into the result set it is.  The
+    projects' rows are then merged, with the project id breaking ties between
+    projects containing the same hg changeset.
+
+    Args:
+        engine: SQLAlchemy engine for the mapper database
+        project_ids: list of project ids
+        criteria: list of additional SQLAlchemy filter expressions
+        page_size: maximum number of rows per page, and per query
 
+    Returns:
+        A generator of lists of rows with git_commit, hg_changeset and
+        project_id attributes
+    """
+    rows = heapq.merge(*[_project_mapfile_rows(engine, project_id, criteria, page_size)
+                         for project_id in project_ids])
+    while True:
+        page = list(itertools.islice(rows, page_size))
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+
+
+def _build_mapfile(projects, *criteria):
+    """Helper method to build a streaming map file for the given projects.
+
+    The first page of results is fetched before returning, so that an empty
+    result can be detected; the remainder is fetched as the response is sent.
 
-def _build_mapfile(query):
-    """Helper method to build a map file from a SQLAlchemy query.
     Args:
-        query: SQLAlchemy query
+        projects: Comma-separated list of project names
+        criteria: additional SQLAlchemy filter expressions on Hash
 
     Returns:
-        * Text output: 40 characters git commit SHA, a space,
-          40 characters hg changeset SHA, a newline; or
-        * None: if the query returns no results
+        * Response streaming text output: 40 characters git commit SHA, a
+          space, 40 characters hg changeset SHA, a newline; or
+        * None: if there are no matching results
     """
-    contents = '\n'.join('%s %s' % (r.git_commit, r.hg_changeset)
-                         for r in query)
-    if contents:
-        return Response(contents + '\n', mimetype='text/plain')
+    project_ids = _project_ids(projects)
+    if not project_ids:
+        return None
+    pages = _mapfile_pages(current_app.db.engine('mapper'), project_ids, criteria,
+                           MAPFILE_PAGE_SIZE)
+    try:
+        first = next(pages)
+    except StopIteration:
+        return None
+
+    def generate():
+        for page in itertools.chain([first], pages):
+            yield ''.join('%s %s\n' % (r.git_commit, r.hg_changeset)
+                          for r in page)
+    return Response(generate(), mimetype='text/plain')
+
+
+_is_sha = re.compile('^[a-f0-9]{40}$').match
 
 
 def _check_well_formed_sha(vcs, sha, exact_length=40):
@@ -148,81 +302,229 @@ def _check_well_formed_sha(vcs, sha, exact_length=40):
               % (vcs, exact_length, len(sha), str(sha)))
 
 
-def _get_project(session, project):
-    """Helper method to return Project class for a project with the given name.
+def _get_project_id(project):
+    """Helper method to return the id of the project with the given name.
 
     Args:
-        session: SQLAlchemy ORM Session object
         project: Name of the project (e.g. 'build-tools')
 
     Returns:
-        the corresponding python Project object
+        the project's id
 
     Exceptions:
         HTTP 404: Project could not be found
-        HTTP 500: Multiple projects with same name found
     """
-    try:
-        return Project.query.filter_by(name=project).one()
-    except MultipleResultsFound:
-        abort(500, "Multiple projects with name %s found in database" %
-              project)
-    except NoResultFound:
+    project_ids = current_app.mapper_projects.get([project])
+    if not project_ids:
         abort(404, "Could not find project %s in database" % project)
+    return project_ids[0]
 
 
-def _add_hash(session, git_commit, hg_changeset, project):
+def _add_hash(session, git_commit, hg_changeset, project_id):
     """Helper method to add a git-hg mapping into the current SQLAlchemy ORM session.
 
     Args:
         session: SQLAlchemy ORM Session object
         git_commit: String of the 40 character SHA of the git commit
         hg_changeset: String of the 40 character SHA of the hg changeset
-        project: String of the name of the project (e.g. 'build-tools')
+        project_id: Id of the project (e.g. the id of 'build-tools')
 
     Exceptions:
         HTTP 400: Malformed SHA
     """
     _check_well_formed_sha('git', git_commit)  # can raise http 400
     _check_well_formed_sha('hg', hg_changeset)  # can raise http 400
-    h = Hash(git_commit=git_commit, hg_changeset=hg_changeset, project=project,
-             date_added=time.time())
+    h = Hash(git_commit=git_commit, hg_changeset=hg_changeset,
+             project_id=project_id, date_added=time.time())
     session.add(h)
 
 
+def _select_revs(project_ids, vcs_type, commit):
+    """Helper method to build a select for the mappings matching a full or
+    abbreviated SHA.
+
+    A full SHA is matched exactly, and a prefix as a range, so that either
+    way the query is a scan of the unique (project_id, sha) index.
+
+    Args:
+        project_ids: List of project ids to search
+        vcs_type: Name of the vcs system ('hg' or 'git') of commit
+        commit: Full or abbreviated SHA
+
+    Returns:
+        A SQLAlchemy select of up to two (git_commit, hg_changeset) rows;
+        more than one row means the SHA is ambiguous
+    """
+    column = Hash.git_commit if vcs_type == 'git' else Hash.hg_changeset
+    if len(commit) == 40:
+        match = column == commit
+    else:
+        # SHAs are always 40 lowercase hex characters, so those starting with
+        # a given prefix form a contiguous range
+        match = sa.and_(column >= commit,
+                        column <= commit + 'f' * (40 - len(commit)))
+    sel = sa.select([Hash.git_commit, Hash.hg_changeset])
+    return sel.where(sa.and_(Hash.project_id.in_(project_ids), match)).limit(2)
+
+
+def _lookup_rev(projects, vcs_type, commit):
+    """Helper method to find the mappings for a full or abbreviated SHA.
+
+    Args:
+        projects: Comma-separated list of project names
+        vcs_type: Name of the vcs system ('hg' or 'git') of commit
+        commit: Full or abbreviated SHA
+
+    Returns:
+        A list of up to two (git_commit, hg_changeset) rows; more than one
+        row means the SHA is ambiguous
+    """
+    project_ids = _project_ids(projects)
+    if not project_ids:
+        return []
+    sel = _select_revs(project_ids, vcs_type, commit)
+    return g.db.session('mapper').execute(sel).fetchall()
+
+
+def _resolve_revs(engine, project_ids, vcs_type, commits):
+    """Generate the lines of a batch revision lookup response.
+
+    Full SHAs are resolved REVS_CHUNK_SIZE at a time, with a single IN query
+    per chunk; abbreviated SHAs are each resolved with a range query.
+
+    Args:
+        engine: SQLAlchemy engine for the mapper database
+        project_ids: List of project ids to search
+        vcs_type: Name of the vcs system ('hg' or 'git') of the commits
+        commits: List of full or abbreviated SHAs
+
+    Returns:
+        A generator of strings, each containing one line per SHA, in order:
+        ``<git> <hg>``, ``missing <sha>`` or ``ambiguous <sha>``
+    """
+    column = Hash.git_commit if vcs_type == 'git' else Hash.hg_changeset
+    key = 0 if vcs_type == 'git' else 1
+    for i in xrange(0, len(commits), REVS_CHUNK_SIZE):
+        chunk = commits[i:i + REVS_CHUNK_SIZE]
+        full = set(c for c in chunk if len(c) == 40)
+        matches = collections.defaultdict(list)
+        if full:
+            sel = sa.select([Hash.git_commit, Hash.hg_changeset])
+            sel = sel.where(sa.and_(Hash.project_id.in_(project_ids),
+                                    column.in_(full)))
+            for row in engine.execute(sel):
+                matches[row[key]].append(row)
+        lines = []
+        for commit in chunk:
+            if commit in full:
+                rows = matches.get(commit, [])
+            else:
+                sel = _select_revs(project_ids, vcs_type, commit)
+                rows = engine.execute(sel).fetchall()
+            if not rows:
+                lines.append('missing %s\n' % commit)
+            elif len(rows) > 1:
+                lines.append('ambiguous %s\n' % commit)
+            else:
+                lines.append('%s %s\n' % (rows[0][0], rows[0][1]))
+        yield ''.join(lines)
+
+
 @bp.route('/<projects>/rev/<vcs_type>/<commit>')
 def get_rev(projects, vcs_type, commit):
     # (documentation in relengapi/docs/usage/mapper.rst)
     _check_well_formed_sha(vcs_type, commit, exact_length=None)  # can raise http 400
-    q = Hash.query.join(Project).filter(_project_filter(projects))
-    if vcs_type == "git":
-        q = q.filter(sa.text("git_commit like :cspatttern")).params(
-            cspatttern=commit + "%")
-    elif vcs_type == "hg":
-        q = q.filter(sa.text("hg_changeset like :cspatttern")).params(
-            cspatttern=commit + "%")
-    try:
-        row = q.one()
-        return "%s %s" % (row.git_commit, row.hg_changeset)
-    except NoResultFound:
-        if vcs_type == "git":
-            abort(404, "No hg changeset found for git commit id %s in project(s) %s"
-                  % (commit, projects))
-        elif vcs_type == "hg":
-            abort(404, "No git commit found for hg changeset %s in project(s) %s"
-                  % (commit, projects))
-    except MultipleResultsFound:
-        abort(500, "Internal error - multiple results returned for %s commit %s"
-              "in project %s - this should not be possible in database"
-              % (vcs_type, commit, projects))
+    # only successful lookups of full SHAs are cached: mappings are never
+    # changed or deleted, so these results never go stale, even when another
+    # process inserts mappings.  An abbreviated SHA can become ambiguous.
+    cacheable = len(commit) == 40
+    cache_key = (projects, vcs_type, commit)
+    row = current_app.mapper_rev_cache.get(cache_key) if cacheable else None
+    if row is None:
+        rows = _lookup_rev(projects, vcs_type, commit)
+        if not rows:
+            if vcs_type == "git":
+                abort(404, "No hg changeset found for git commit id %s in project(s) %s"
+                      % (commit, projects))
+            elif vcs_type == "hg":
+                abort(404, "No git commit found for hg changeset %s in project(s) %s"
+                      % (commit, projects))
+        if len(rows) > 1:
+            abort(500, "Internal error - multiple results returned for %s commit %s"
+                  "in project %s - this should not be possible in database"
+                  % (vcs_type, commit, projects))
+        row = tuple(rows[0])
+        if cacheable:
+            current_app.mapper_rev_cache.set(cache_key, row)
+    return "%s %s" % row
+
+
+@bp.route('/<projects>/revs/<vcs_type>', methods=('POST',))
+def get_revs(projects, vcs_type):
+    # (documentation in relengapi/docs/usage/mapper.rst)
+    if vcs_type not in ("git", "hg"):
+        abort(400, "Unknown vcs type %s" % vcs_type)
+    if request.mimetype == 'application/json':
+        commits = request.get_json()
+        if not isinstance(commits, list) or \
+                not all(isinstance(c, basestring) for c in commits):
+            abort(400, "Request body must be a JSON list of SHAs")
+    elif request.mimetype == 'text/plain':
+        commits = [l.strip() for l in request.stream if l.strip()]
+    else:
+        abort(400, "HTTP request header 'Content-Type' must be set to "
+              "'text/plain' or 'application/json'")
+    for commit in commits:
+        _check_well_formed_sha(vcs_type, commit, exact_length=None)  # can raise http 400
+    project_ids = _project_ids(projects)
+    if not project_ids:
+        abort(404, "Could not find project(s) %s in database" % projects)
+    lines = _resolve_revs(current_app.db.engine('mapper'), project_ids,
+                          vcs_type, commits)
+    return Response(lines, mimetype='text/plain')
+
+
+def _snapshot_mapfile(projects):
+    """Helper method to build a map file from the current snapshot of a
+    single project, if MAPPER_SNAPSHOT_DIR is configured.
+
+    The mappings added since the snapshot's watermark are read from the
+    database.  If they are the same ones the snapshot contains (mappings are
+    never deleted, so it is enough to compare their number), the snapshot is
+    served as-is; otherwise they are merged into it, dropping duplicates.
+
+    Args:
+        projects: Comma-separated list of project names
+
+    Returns:
+        * Response containing the map file; or
+        * None: if there is no usable snapshot
+    """
+    directory = current_app.config.get('MAPPER_SNAPSHOT_DIR')
+    if not directory or ',' in projects:
+        return None
+    project_ids = _project_ids(projects)
+    if not project_ids:
+        return None
+    snapshot = snapshots.load(directory, projects)
+    if not snapshot:
+        return None
+    pages = _mapfile_pages(current_app.db.engine('mapper'), project_ids,
+                           (Hash.date_added >= snapshot.watermark,), MAPFILE_PAGE_SIZE)
+    first = next(pages, [])
+    if len(first) < MAPFILE_PAGE_SIZE and len(first) == snapshot.tail_count:
+        return snapshots.response(snapshot)
+
+    recent = ('%s %s\n' % (r.git_commit, r.hg_changeset)
+              for page in itertools.chain([first], pages) for r in page)
+    return Response(snapshots.merge(snapshot.lines(), recent),
+                    mimetype='text/plain')
 
 
 @bp.route('/<projects>/mapfile/full')
 def get_full_mapfile(projects):
     # (documentation in relengapi/docs/usage/mapper.rst)
-    q = Hash.query.join(Project).filter(_project_filter(projects))
-    q = q.order_by(Hash.hg_changeset)
-    mapfile = _build_mapfile(q)
+    mapfile = _snapshot_mapfile(projects) or _build_mapfile(projects)
     if not mapfile:
         abort(404, 'No results found in database for requested map file')
     return mapfile
@@ -237,17 +539,80 @@ def get_mapfile_since(projects, since):
         abort(400, 'Invalid date %s specified; see https://labix.org/python-dateutil: %s'
               % (since, e.message))
     since_epoch = calendar.timegm(since_dt.utctimetuple())
-    q = Hash.query.join(Project).filter(_project_filter(projects))
-    q = q.order_by(Hash.hg_changeset)
-    q = q.filter(Hash.date_added > since_epoch)
-    print q
-    mapfile = _build_mapfile(q)
+    mapfile = _build_mapfile(projects, Hash.date_added > since_epoch)
     if not mapfile:
         abort(404, 'No mappings inserted into database for project(s) %s since %s'
               % (projects, since))
     return mapfile
 
 
+def _encode_cursor(row):
+    """Helper method to encode the position of a row in the feed as an opaque
+    cursor string."""
+    return base64.urlsafe_b64encode('%d:%d:%s' % (
+        row.date_added, row.project_id, row.hg_changeset))
+
+
+def _decode_cursor(cursor):
+    """Helper method to decode a cursor into a (date_added, project_id,
+    hg_changeset) tuple, or None for the cursor '0' at the beginning of the
+    feed.
+
+    Exceptions:
+        HTTP 400: Invalid cursor
+    """
+    if cursor == '0':
+        return None
+    try:
+        # a cursor is ASCII, so this raises UnicodeError if it is not
+        date_added, project_id, hg_changeset = \
+            base64.urlsafe_b64decode(cursor.encode('ascii')).split(':')
+        if not _is_sha(hg_changeset):
+            raise ValueError(hg_changeset)
+        return int(date_added), int(project_id), hg_changeset
+    except (TypeError, ValueError, UnicodeError):
+        # (the cursor is not echoed, as it may not be printable)
+        abort(400, "Invalid cursor")
+
+
+@bp.route('/<projects>/mapfile/after/<cursor>')
+def get_mapfile_after(projects, cursor):
+    # (documentation in relengapi/docs/usage/mapper.rst)
+    position = _decode_cursor(cursor)  # can raise HTTP 400
+    try:
+        limit = int(request.args.get('limit', FEED_PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= FEED_PAGE_SIZE:
+        abort(400, "limit must be between 1 and %d" % FEED_PAGE_SIZE)
+    project_ids = _project_ids(projects)
+    if not project_ids:
+        abort(404, "Could not find project(s) %s in database" % projects)
+
+    # the feed is ordered by (date_added, project_id, hg_changeset), which is
+    # unique, and read using the project_id__date_added index
+    sel = sa.select([Hash.git_commit, Hash.hg_changeset, Hash.project_id,
+                     Hash.date_added])
+    sel = sel.where(sa.and_(
+        Hash.project_id.in_(project_ids),
+        Hash.date_added <= time.time() - FEED_SETTLE_TIME))
+    if position:
+        date_added, project_id, hg_changeset = position
+        sel = sel.where(sa.or_(
+            Hash.date_added > date_added,
+            sa.and_(Hash.date_added == date_added, sa.or_(
+                Hash.project_id > project_id,
+                sa.and_(Hash.project_id == project_id,
+                        Hash.hg_changeset > hg_changeset)))))
+    sel = sel.order_by(Hash.date_added, Hash.project_id, Hash.hg_changeset)
+    rows = g.db.session('mapper').execute(sel.limit(limit)).fetchall()
+
+    rv = Response(''.join('%s %s\n' % (r.git_commit, r.hg_changeset)
+                          for r in rows), mimetype='text/plain')
+    rv.headers['X-Mapper-Next-Cursor'] = _encode_cursor(rows[-1]) if rows else cursor
+    return rv
+
+
 @bp.route('/projects', methods=('GET',))
 def get_projects():
     # (documentation in relengapi/docs/usage/mapper.rst)
@@ -257,9 +622,83 @@ def get_projects():
     return jsonify(projects=[x.name for x in rows])
 
 
+def _parse_mappings(lines, project):
+    """Generate (git_commit, hg_changeset) pairs from the lines of a map file.
+
+    Args:
+        lines: Iterable of map file lines
+        project: Single project name string, for error messages
+
+    Exceptions:
+        HTTP 400: Line does not contain a space
+        HTTP 400: Malformed SHA
+    """
+    for line in lines:
+        line = line.rstrip()
+        try:
+            (git_commit, hg_changeset) = line.split(' ')
+        except ValueError:
+            logger.error(
+                "Received input line: '%s' for project %s", line, project)
+            logger.error("Was expecting an input line such as "
+                         "'686a558fad7954d8481cfd6714cdd56b491d2988 "
+                         "fef90029cb654ad9848337e262078e403baf0c7a'")
+            logger.error("i.e. where the first hash is a git commit SHA "
+                         "and the second hash is a mercurial changeset SHA")
+            abort(400, "Input line '%s' received for project %s did not contain a space"
+                  % (line, project))
+        _check_well_formed_sha('git', git_commit)  # can raise http 400
+        _check_well_formed_sha('hg', hg_changeset)  # can raise http 400
+        yield git_commit, hg_changeset
+
+
+def _new_mappings(session, project_id, chunk, date_added=None):
+    """Helper method to filter out mappings which would violate the unique
+    indexes on the hashes table.
+
+    A single query finds any of the chunk's SHAs which already exist in the
+    project; mappings repeating a SHA earlier in the chunk are dropped too.
+
+    Args:
+        session: SQLAlchemy ORM Session object
+        project_id: Id of the project being inserted into
+        chunk: List of (git_commit, hg_changeset) pairs
+        date_added: date_added for the rows; by default, the current time
+
+    Returns:
+        A list of row dictionaries suitable for inserting into the hashes table
+    """
+    git_commits = set(git for git, hg in chunk)
+    hg_changesets = set(hg for git, hg in chunk)
+    sel = sa.select([Hash.git_commit, Hash.hg_changeset]).where(sa.and_(
+        Hash.project_id == project_id,
+        sa.or_(Hash.git_commit.in_(git_commits),
+               Hash.hg_changeset.in_(hg_changesets))))
+    seen_git = set()
+    seen_hg = set()
+    for git_commit, hg_changeset in session.execute(sel):
+        seen_git.add(git_commit)
+        seen_hg.add(hg_changeset)
+
+    if date_added is None:
+        date_added = int(time.time())
+    rows = []
+    for git_commit, hg_changeset in chunk:
+        if git_commit in seen_git or hg_changeset in seen_hg:
+            continue
+        seen_git.add(git_commit)
+        seen_hg.add(hg_changeset)
+        rows.append({'git_commit': git_commit, 'hg_changeset': hg_changeset,
+                     'project_id': project_id, 'date_added': date_added})
+    return rows
+
+
 def _insert_many(project, ignore_dups=False):
     """Update the database with many git-hg mappings.
 
+    The request body is read, checked and inserted in chunks of
+    INSERT_CHUNK_SIZE lines, each written with a single executemany.
+
     Args:
         project: Single project name string
         ignore_dups: Boolean; if False, abort on duplicate entries without inserting
@@ -273,35 +712,48 @@ def _insert_many(project, ignore_dups=False):
         HTTP 400: Malformed SHA
         HTTP 404: Project not found
         HTTP 409: ignore_dups=False and there are duplicate entries
-        HTTP 500: Multiple projects found with matching project name
     """
     if request.content_type != 'text/plain':
         abort(
             400, "HTTP request header 'Content-Type' must be set to 'text/plain'")
     session = g.db.session('mapper')
-    proj = _get_project(session, project)  # can raise HTTP 404 or HTTP 500
-    for line in request.stream.readlines():
-        line = line.rstrip()
-        try:
-            (git_commit, hg_changeset) = line.split(' ')
-        except ValueError:
-            logger.error(
-                "Received input line: '%s' for project %s", line, project)
-            logger.error("Was expecting an input line such as "
-                         "'686a558fad7954d8481cfd6714cdd56b491d2988 "
-                         "fef90029cb654ad9848337e262078e403baf0c7a'")
-            logger.error("i.e. where the first hash is a git commit SHA "
-                         "and the second hash is a mercurial changeset SHA")
-            abort(400, "Input line '%s' received for project %s did not contain a space"
-                  % (line, project))
-            # header/footer won't match this format
-            continue
-        _add_hash(session, git_commit, hg_changeset, proj)  # can raise HTTP 400
-        if ignore_dups:
+    project_id = _get_project_id(project)  # can raise HTTP 404
+    insert = Hash.__table__.insert()
+    if ignore_dups:
+        prefix = _INSERT_IGNORE_PREFIXES.get(session.bind.dialect.name)
+        if prefix:
+            insert = insert.prefix_with(prefix)
+
+    # Without ignore_dups, all of the chunks are committed together at the
+    # end, so all of the rows are dated once, when the request begins; the
+    # feed's FEED_SETTLE_TIME gives the request time to commit.
+    date_added = None if ignore_dups else int(time.time())
+    mappings = _parse_mappings(request.stream, project)  # can raise HTTP 400
+    while True:
+        chunk = list(itertools.islice(mappings, INSERT_CHUNK_SIZE))
+        if not chunk:
+            break
+        # if a concurrent request inserts some of the same mappings between
+        # the duplicate check and the insert, check again and retry once
+        for attempt in (1, 2):
+            rows = _new_mappings(session, project_id, chunk, date_added)
+            if not ignore_dups and len(rows) != len(chunk):
+                session.rollback()
+                abort(409, "Some of the given mappings for project %s already exist"
+                      % project)
             try:
-                session.commit()
+                if rows:
+                    session.execute(insert, rows)
+                if ignore_dups:
+                    session.commit()
+                break
             except sa.exc.IntegrityError:
                 session.rollback()
+                if not ignore_dups:
+                    abort(409, "Some of the given mappings for project %s already exist"
+                          % project)
+                if attempt == 2:
+                    raise
     if not ignore_dups:
         try:
             session.commit()
@@ -331,12 +783,12 @@ def insert_many_ignore_dups(project):
 def insert_one(project, git_commit, hg_changeset):
     # (documentation in relengapi/docs/usage/mapper.rst)
     session = g.db.session('mapper')
-    proj = _get_project(session, project)  # can raise HTTP 404 or HTTP 500
-    _add_hash(session, git_commit, hg_changeset, proj)  # can raise HTTP 400
+    project_id = _get_project_id(project)  # can raise HTTP 404
+    _add_hash(session, git_commit, hg_changeset, project_id)  # can raise HTTP 400
     try:
         session.commit()
-        q = Hash.query.join(Project).filter(_project_filter(project))
-        q = q.filter(sa.text("git_commit == :commit")).params(commit=git_commit)
+        q = Hash.query.filter(Hash.project_id == project_id)
+        q = q.filter(Hash.git_commit == git_commit)
         return q.one().as_json()
     except sa.exc.IntegrityError:
         abort(409, "Provided mapping %s %s for project %s already exists and "
@@ -361,4 +813,54 @@ def add_project(project):
     except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
         abort(409, "Project %s could not be inserted into the database" %
               project)
+    current_app.mapper_projects.invalidate()
     return jsonify()
+
+
+@badpenny.periodic_task(seconds=3600)
+def write_snapshots(job_status):
+    """Write a snapshot of each project's full map file to MAPPER_SNAPSHOT_DIR"""
+    directory = current_app.config.get('MAPPER_SNAPSHOT_DIR')
+    if not directory:
+        return
+    engine = current_app.db.engine('mapper')
+    session = current_app.db.session('mapper')
+    for project in session.query(Project):
+        q = session.query(sa.func.max(Hash.date_added))
+        latest = q.filter(Hash.project_id == project.id).scalar()
+        if latest is None:
+            snapshots.remove(directory, project.name)
+            continue
+        # mappings from the watermark on are read from the database when the
+        # snapshot is served, so the snapshot can include anything visible.
+        # The mappings counted here are all in the snapshot; any committed
+        # meanwhile make the count too small, so are merged in when served.
+        watermark = latest - SNAPSHOT_MARGIN
+        q = session.query(sa.func.count('*')).filter(
+            Hash.project_id == project.id, Hash.date_added >= watermark)
+        tail_count = q.scalar()
+        pages = _mapfile_pages(engine, [project.id], (), MAPFILE_PAGE_SIZE)
+        lines = ('%s %s\n' % (r.git_commit, r.hg_changeset)
+                 for page in pages for r in page)
+        snapshots.write(directory, project.name, lines, watermark, tail_count)
+        job_status.log_message("wrote snapshot of %s up to %d" %
+                               (project.name, watermark))
+
+
+@bp.before_app_first_request
+def warm_project_cache():
+    # only warm a configured database; otherwise the cache is loaded when it
+    # is first used, if ever
+    if 'mapper' not in (current_app.config.get('SQLALCHEMY_DATABASE_URIS') or {}):
+        return
+    try:
+        current_app.mapper_projects.get([])
+    except Exception:
+        # the cache will be loaded by the first request that needs it
+        logger.exception("while loading the mapper projects")
+
+
+@bp.record
+def init_blueprint(state):
+    state.app.mapper_rev_cache = util.LRUCache(REV_CACHE_SIZE)
+    state.app.mapper_projects = ProjectCache()
@@ -0,0 +1,197 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Storage for precomputed map file snapshots.
+
+Each project's snapshot is a gzipped map file named ``<project>-<digest>.gz``,
+described by ``<project>.json``.  The description gives the name of the map
+file, the SHA1 digest of its uncompressed contents, its watermark, and its
+tail count: the number of the mappings it contains with a ``date_added`` of
+at least the watermark.  Mappings from the watermark on are also read from the
+database when the snapshot is served.  Both files are replaced atomically, so
+readers always see a consistent snapshot.
+"""
+
+import datetime
+import gzip
+import hashlib
+import heapq
+import json
+import os
+import tempfile
+
+from flask import Response
+from flask import request
+
+# size of the blocks in which snapshot files are read
+BLOCK_SIZE = 65536
+
+
+class Snapshot(object):
+
+    def __init__(self, project, digest, watermark, tail_count, file):
+        self.project = project
+        self.digest = digest
+        self.watermark = watermark
+        self.tail_count = tail_count
+        #: the open, gzipped map file
+        self.file = file
+
+    def lines(self):
+        """Generate the lines of the uncompressed map file"""
+        try:
+            with gzip.GzipFile(fileobj=self.file, mode='rb') as f:
+                for line in f:
+                    yield line
+        finally:
+            self.file.close()
+
+
+def _description_path(directory, project):
+    return os.path.join(directory, '%s.json' % project)
+
+
+def _write_file(directory, write):
+    # write to a temporary file in the snapshot directory, so that it can be
+    # renamed into place atomically
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+    except Exception:
+        os.unlink(tmp)
+        raise
+    return tmp
+
+
+def load(directory, project):
+    """Open the current snapshot for a project, returning None if there
+    is no snapshot."""
+    try:
+        with open(_description_path(directory, project)) as f:
+            desc = json.load(f)
+        file = open(os.path.join(directory, desc['filename']), 'rb')
+    except (IOError, ValueError, KeyError):
+        return None
+    return Snapshot(project, desc['digest'], desc['watermark'],
+                    desc.get('tail_count'), file)
+
+
+def write(directory, project, lines, watermark, tail_count):
+    """Write a new snapshot for a project from the given map file lines,
+    replacing any existing snapshot."""
+    digest = hashlib.sha1()
+
+    def write_mapfile(f):
+        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            for line in lines:
+                digest.update(line)
+                gz.write(line)
+    tmp = _write_file(directory, write_mapfile)
+    filename = '%s-%s.gz' % (project, digest.hexdigest())
+    os.rename(tmp, os.path.join(directory, filename))
+
+    old = _read_filename(directory, project)
+    desc = {'filename': filename, 'digest': digest.hexdigest(),
+            'watermark': watermark, 'tail_count': tail_count}
+    tmp = _write_file(directory, lambda f: json.dump(desc, f))
+    os.rename(tmp, _description_path(directory, project))
+    # readers which loaded the old description already have the old map
+    # file open, so it is safe to remove
+    if old and old != filename:
+        _unlink(os.path.join(directory, old))
+
+
+def remove(directory, project):
+    """Remove any snapshot for a project."""
+    old = _read_filename(directory, project)
+    _unlink(_description_path(directory, project))
+    if old:
+        _unlink(os.path.join(directory, old))
+
+
+def _read_filename(directory, project):
+    try:
+        with open(_description_path(directory, project)) as f:
+            return json.load(f)['filename']
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _read_range(file, start, stop):
+    try:
+        file.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            block = file.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        file.close()
+
+
+def response(snapshot):
+    """Build a response serving the given snapshot unchanged.
+
+    Clients accepting gzip encoding get the file as-is, with support for
+    range requests; others get it decompressed on the fly.  Either way, the
+    response has an ETag based on the snapshot's digest, and a Last-Modified
+    header giving its watermark, so conditional requests get a 304.  Since the
+    body and ETag depend on Accept-Encoding, the response varies on it.
+    """
+    if 'gzip' in request.accept_encodings:
+        size = os.fstat(snapshot.file.fileno()).st_size
+        etag = '%s-gzip' % snapshot.digest
+        status = 200
+        start, stop = 0, size
+        headers = {'Content-Encoding': 'gzip', 'Accept-Ranges': 'bytes'}
+        if_range = request.if_range
+        if request.range and (if_range.etag == etag or
+                              if_range.etag is None and if_range.date is None):
+            rng = request.range.range_for_length(size)
+            if rng is None:
+                snapshot.file.close()
+                return Response(status=416, headers={
+                    'Content-Range': 'bytes */%d' % size, 'Vary': 'Accept-Encoding'})
+            start, stop = rng
+            status = 206
+            headers['Content-Range'] = request.range.make_content_range(size).to_header()
+        headers['Content-Length'] = str(stop - start)
+        body = _read_range(snapshot.file, start, stop)
+    else:
+        etag = snapshot.digest
+        status = 200
+        headers = {}
+        body = snapshot.lines()
+    headers['Vary'] = 'Accept-Encoding'
+    rv = Response(body, status=status, headers=headers, mimetype='text/plain')
+    rv.set_etag(etag)
+    rv.last_modified = datetime.datetime.utcfromtimestamp(snapshot.watermark)
+    rv.make_conditional(request)
+    if rv.status_code == 304:
+        # the body will never be read
+        snapshot.file.close()
+    return rv
+
+
+def merge(*mapfiles):
+    """Merge the lines of several map files, each ordered by hg changeset,
+    into a single map file ordered by hg changeset.  Lines appearing in more
+    than one map file are only included once."""
+    # each line is '<git sha> <hg sha>\n', so the hg changeset starts at 41
+    decorated = [((line[41:], line) for line in mapfile) for mapfile in mapfiles]
+    last = None
+    for _, line in heapq.merge(*decorated):
+        if line != last:
+            yield line
+        last = line
@@ -2,15 +2,26 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import StringIO
+import base64
+import gzip
 import json
 import mock
+import shutil
+import tempfile
+import time
 
+from contextlib import contextmanager
 from nose.tools import eq_
+from relengapi.blueprints import mapper
 from relengapi.blueprints.mapper import Hash
 from relengapi.blueprints.mapper import Project
+from relengapi.blueprints.mapper import ProjectCache
+from relengapi.blueprints.mapper import snapshots
 from relengapi.lib import auth
 from relengapi.lib.permissions import p
 from relengapi.lib.testing.context import TestContext
+from relengapi.lib.testing.queries import count_queries
 from sqlalchemy.orm.exc import MultipleResultsFound
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -39,6 +50,8 @@ def db_teardown(app):
     session.query(Hash).delete()
     session.query(Project).delete()
     session.commit()
+    app.mapper_rev_cache.clear()
+    app.mapper_projects.invalidate()
 
 
 def set_projects(app, new_list=[]):
@@ -48,6 +61,7 @@ def set_projects(app, new_list=[]):
         project = Project(name=new_proj)
         session.add(project)
     session.commit()
+    app.mapper_projects.invalidate()
 
 
 class User(auth.BaseUser):
@@ -80,6 +94,22 @@ def insert_some_hashes(app):
     session.commit()
 
 
+@contextmanager
+def snapshot_dir(app):
+    directory = tempfile.mkdtemp()
+    app.config['MAPPER_SNAPSHOT_DIR'] = directory
+    try:
+        yield directory
+    finally:
+        del app.config['MAPPER_SNAPSHOT_DIR']
+        shutil.rmtree(directory)
+
+
+def write_snapshots(app):
+    with app.app_context():
+        mapper.write_snapshots(mock.Mock())
+
+
 def hash_pair_exists(app, git, hg):
     session = app.db.session('mapper')
     try:
@@ -114,6 +144,50 @@ def test_get_rev_abbreviated(app, client):
     eq_(rv.data, '%s %s' % (SHA1, SHA1R))
 
 
+@test_context
+def test_get_rev_abbreviated_hg(app, client):
+    insert_some_hashes(app)
+    rv = client.get('/mapper/proj/rev/hg/%s' % SHA3R[:36])
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s' % (SHA3, SHA3R))
+
+
+@test_context
+def test_get_rev_ambiguous(app, client):
+    insert_some_hashes(app)
+    # SHA1R and SHA2R both start with 'a7afcf0d'
+    rv = client.get('/mapper/proj/rev/hg/a7afcf0d')
+    eq_(rv.status_code, 500)
+
+
+@test_context
+def test_get_rev_cached(app, client):
+    insert_some_hashes(app)
+    rv = client.get('/mapper/proj/rev/git/%s' % SHA1)
+    eq_(rv.status_code, 200)
+    with mock.patch('relengapi.blueprints.mapper._lookup_rev') as _lookup_rev:
+        rv = client.get('/mapper/proj/rev/git/%s' % SHA1)
+        eq_(rv.status_code, 200)
+        eq_(rv.data, '%s %s' % (SHA1, SHA1R))
+        assert not _lookup_rev.called
+
+
+@test_context
+def test_get_rev_prefix_not_cached(app, client):
+    insert_some_hashes(app)
+    rv = client.get('/mapper/proj/rev/git/1111')
+    eq_(rv.status_code, 200)
+    # inserting another mapping (here, from outside this process) makes the
+    # prefix ambiguous
+    session = app.db.session('mapper')
+    project = session.query(Project).filter(Project.name == 'proj').one()
+    session.add(Hash(git_commit='1111' + SHA3[4:], hg_changeset=SHA3R[:-4] + '1111',
+                     project=project, date_added=12348))
+    session.commit()
+    rv = client.get('/mapper/proj/rev/git/1111')
+    eq_(rv.status_code, 500)
+
+
 @test_context
 def test_get_rev_missing(app, client):
     insert_some_hashes(app)
@@ -138,6 +212,89 @@ def test_get_rev_weird_vcs(app, client):
     # TODO: check that return is JSON, once it is
 
 
+@test_context
+def test_get_revs_text(app, client):
+    insert_some_hashes(app)
+    rv = client.post('/mapper/proj/revs/git', content_type='text/plain',
+                     data='%s\n%s\n\n%s\n' % (SHA2, 'abcdef', SHA1[:8]))
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s\nmissing abcdef\n%s %s\n' % (SHA2, SHA2R, SHA1, SHA1R))
+
+
+@test_context
+def test_get_revs_json(app, client):
+    insert_some_hashes(app)
+    rv = client.post('/mapper/proj/revs/hg', content_type='application/json',
+                     data=json.dumps([SHA3R, 'a7afcf0d', SHA1R, SHA2]))
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s\nambiguous a7afcf0d\n%s %s\nmissing %s\n' % (
+        SHA3, SHA3R, SHA1, SHA1R, SHA2))
+
+
+@test_context
+def test_get_revs_chunked(app, client):
+    insert_some_hashes(app)
+    with mock.patch('relengapi.blueprints.mapper.REVS_CHUNK_SIZE', 2):
+        rv = client.post('/mapper/proj/revs/git', content_type='application/json',
+                         data=json.dumps([SHA1, SHA2, SHA3, SHA1]))
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s\n%s %s\n%s %s\n%s %s\n' % (
+        SHA1, SHA1R, SHA2, SHA2R, SHA3, SHA3R, SHA1, SHA1R))
+
+
+@test_context
+def test_get_revs_multiple_projects(app, client):
+    insert_some_hashes(app)
+    session = app.db.session('mapper')
+    project = Project(name='proj2')
+    session.add(project)
+    session.add(
+        Hash(git_commit=SHA1, hg_changeset=SHA2, project=project, date_added=12348))
+    session.commit()
+    rv = client.post('/mapper/proj,proj2/revs/git', content_type='text/plain',
+                     data='%s\n%s\n' % (SHA1, SHA2))
+    eq_(rv.status_code, 200)
+    eq_(rv.data, 'ambiguous %s\n%s %s\n' % (SHA1, SHA2, SHA2R))
+
+
+@test_context
+def test_get_revs_malformed(app, client):
+    rv = client.post('/mapper/proj/revs/git', content_type='text/plain',
+                     data='%s\nxyz\n' % SHA1)
+    eq_(rv.status_code, 400)
+
+
+@test_context
+def test_get_revs_not_a_list(app, client):
+    rv = client.post('/mapper/proj/revs/git', content_type='application/json',
+                     data=json.dumps({'sha': SHA1}))
+    eq_(rv.status_code, 400)
+    rv = client.post('/mapper/proj/revs/git', content_type='application/json',
+                     data=json.dumps([1234]))
+    eq_(rv.status_code, 400)
+
+
+@test_context
+def test_get_revs_bad_content_type(app, client):
+    rv = client.post('/mapper/proj/revs/git', content_type='text/chocolate',
+                     data=SHA1)
+    eq_(rv.status_code, 400)
+
+
+@test_context
+def test_get_revs_weird_vcs(app, client):
+    rv = client.post('/mapper/proj/revs/darcs', content_type='text/plain',
+                     data=SHA1)
+    eq_(rv.status_code, 400)
+
+
+@test_context
+def test_get_revs_no_project(app, client):
+    rv = client.post('/mapper/notaproj/revs/git', content_type='text/plain',
+                     data=SHA1)
+    eq_(rv.status_code, 404)
+
+
 @test_context
 def test_get_mapfile(app, client):
     insert_some_hashes(app)
@@ -149,6 +306,199 @@ def test_get_mapfile(app, client):
     ))
 
 
+@test_context
+def test_get_mapfile_paged(app, client):
+    insert_some_hashes(app)
+    with mock.patch('relengapi.blueprints.mapper.MAPFILE_PAGE_SIZE', 2):
+        rv = client.get('/mapper/proj/mapfile/full')
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s\n%s %s\n%s %s\n' % (
+        SHA3, SHA3R, SHA1, SHA1R, SHA2, SHA2R,
+    ))
+
+
+@test_context
+def test_get_mapfile_multiple_projects_paged(app, client):
+    insert_some_hashes(app)
+    session = app.db.session('mapper')
+    project = Project(name='proj2')
+    session.add(project)
+    # the same hg changeset in both projects, straddling a page boundary
+    session.add(
+        Hash(git_commit=SHA3, hg_changeset=SHA1R, project=project, date_added=12348))
+    session.commit()
+    with mock.patch('relengapi.blueprints.mapper.MAPFILE_PAGE_SIZE', 2):
+        rv = client.get('/mapper/proj,proj2/mapfile/full')
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s\n%s %s\n%s %s\n%s %s\n' % (
+        SHA3, SHA3R, SHA1, SHA1R, SHA3, SHA1R, SHA2, SHA2R,
+    ))
+
+
+@test_context
+def test_get_mapfile_multiple_projects_interleaved(app, client):
+    """A map file for two projects whose rows interleave across several
+    pages is merged in hg changeset order, reading each project's rows in
+    order of its index"""
+    session = app.db.session('mapper')
+    proj = session.query(Project).filter(Project.name == 'proj').one()
+    proj2 = Project(name='proj2')
+    session.add(proj2)
+    expected = []
+    for i in range(10):
+        project = proj if i % 3 else proj2
+        git, hg = '%040x' % (100 + i), '%040x' % i
+        session.add(Hash(git_commit=git, hg_changeset=hg, project=project,
+                         date_added=12345))
+        expected.append('%s %s\n' % (git, hg))
+    session.commit()
+    with mock.patch('relengapi.blueprints.mapper.MAPFILE_PAGE_SIZE', 3), \
+            count_queries(app.db.engine('mapper')) as statements:
+        rv = client.get('/mapper/proj,proj2/mapfile/full')
+        eq_(rv.status_code, 200)
+        eq_(rv.data, ''.join(expected))
+    selects = [s for s in statements if 'FROM hashes' in s]
+    # proj has 6 rows, read in 3 pages; proj2 has 4, read in 2 pages
+    eq_(len(selects), 5)
+    for sel in selects:
+        assert 'hashes.project_id = ' in sel, sel
+        assert 'ORDER BY hashes.hg_changeset\n' in sel + '\n', sel
+
+
+@test_context
+def test_get_mapfile_snapshot(app, client):
+    insert_some_hashes(app)
+    with snapshot_dir(app), mock.patch('relengapi.blueprints.mapper.SNAPSHOT_MARGIN', 1):
+        write_snapshots(app)
+        # delete a mapping from before the watermark, to show the response
+        # comes from the snapshot
+        session = app.db.session('mapper')
+        session.query(Hash).filter(Hash.date_added == 12345).delete()
+        session.commit()
+        rv = client.get('/mapper/proj/mapfile/full')
+        eq_(rv.status_code, 200)
+        eq_(rv.data, '%s %s\n%s %s\n%s %s\n' % (
+            SHA3, SHA3R, SHA1, SHA1R, SHA2, SHA2R,
+        ))
+        assert rv.headers['ETag']
+        eq_(rv.headers['Last-Modified'], 'Thu, 01 Jan 1970 03:25:46 GMT')
+
+
+@test_context
+def test_get_mapfile_snapshot_gzip(app, client):
+    insert_some_hashes(app)
+    with snapshot_dir(app):
+        write_snapshots(app)
+        rv = client.get('/mapper/proj/mapfile/full',
+                        headers=[('Accept-Encoding', 'gzip')])
+        eq_(rv.status_code, 200)
+        eq_(rv.headers['Content-Encoding'], 'gzip')
+        eq_(rv.headers['Accept-Ranges'], 'bytes')
+        eq_(rv.headers['Vary'], 'Accept-Encoding')
+        data = rv.data
+        eq_(gzip.GzipFile(fileobj=StringIO.StringIO(data)).read(),
+            '%s %s\n%s %s\n%s %s\n' % (SHA3, SHA3R, SHA1, SHA1R, SHA2, SHA2R))
+        etag = rv.headers['ETag']
+
+        # conditional request, which closes the snapshot file
+        loaded = []
+        real_load = snapshots.load
+
+        def load(directory, project):
+            loaded.append(real_load(directory, project))
+            return loaded[-1]
+        with mock.patch('relengapi.blueprints.mapper.snapshots.load', load):
+            rv = client.get('/mapper/proj/mapfile/full',
+                            headers=[('Accept-Encoding', 'gzip'), ('If-None-Match', etag)])
+        eq_(rv.status_code, 304)
+        eq_(rv.headers['Vary'], 'Accept-Encoding')
+        assert loaded[0].file.closed
+
+        # range request
+        rv = client.get('/mapper/proj/mapfile/full',
+                        headers=[('Accept-Encoding', 'gzip'), ('Range', 'bytes=10-'),
+                                 ('If-Range', etag)])
+        eq_(rv.status_code, 206)
+        eq_(rv.data, data[10:])
+        eq_(rv.headers['Content-Range'], 'bytes 10-%d/%d' % (len(data) - 1, len(data)))
+
+        # range request for a stale ETag gets the whole thing
+        rv = client.get('/mapper/proj/mapfile/full',
+                        headers=[('Accept-Encoding', 'gzip'), ('Range', 'bytes=10-'),
+                                 ('If-Range', '"abcd"')])
+        eq_(rv.status_code, 200)
+        eq_(rv.data, data)
+
+        # unsatisfiable range request
+        rv = client.get('/mapper/proj/mapfile/full',
+                        headers=[('Accept-Encoding', 'gzip'),
+                                 ('Range', 'bytes=%d-' % (len(data) + 10))])
+        eq_(rv.status_code, 416)
+
+
+@test_context
+def test_get_mapfile_snapshot_with_new_mappings(app, client):
+    insert_some_hashes(app)
+    with snapshot_dir(app):
+        write_snapshots(app)
+        session = app.db.session('mapper')
+        project = session.query(Project).filter(Project.name == 'proj').one()
+        session.add(
+            Hash(git_commit=SHA3R, hg_changeset=SHA3, project=project, date_added=12348))
+        session.commit()
+        rv = client.get('/mapper/proj/mapfile/full')
+        eq_(rv.status_code, 200)
+        eq_(rv.data, '%s %s\n%s %s\n%s %s\n%s %s\n' % (
+            SHA3R, SHA3, SHA3, SHA3R, SHA1, SHA1R, SHA2, SHA2R,
+        ))
+        assert 'ETag' not in rv.headers
+
+
+@test_context
+def test_get_mapfile_snapshot_late_commit(app, client):
+    """A mapping committed after the snapshot was written, but dated before
+    the newest mapping in it, is merged in"""
+    insert_some_hashes(app)
+    with snapshot_dir(app):
+        write_snapshots(app)
+        session = app.db.session('mapper')
+        project = session.query(Project).filter(Project.name == 'proj').one()
+        session.add(
+            Hash(git_commit=SHA3R, hg_changeset=SHA3, project=project, date_added=12346))
+        session.commit()
+        rv = client.get('/mapper/proj/mapfile/full')
+        eq_(rv.status_code, 200)
+        eq_(rv.data, '%s %s\n%s %s\n%s %s\n%s %s\n' % (
+            SHA3R, SHA3, SHA3, SHA3R, SHA1, SHA1R, SHA2, SHA2R,
+        ))
+
+
+@test_context
+def test_get_mapfile_snapshot_multiple_projects(app, client):
+    insert_some_hashes(app)
+    with snapshot_dir(app):
+        write_snapshots(app)
+        session = app.db.session('mapper')
+        session.add(Project(name='proj2'))
+        session.commit()
+        rv = client.get('/mapper/proj,proj2/mapfile/full')
+        eq_(rv.status_code, 200)
+        assert 'ETag' not in rv.headers
+
+
+@test_context
+def test_write_snapshots_empty_project(app, client):
+    insert_some_hashes(app)
+    with snapshot_dir(app):
+        write_snapshots(app)
+        session = app.db.session('mapper')
+        session.query(Hash).delete()
+        session.commit()
+        write_snapshots(app)
+        rv = client.get('/mapper/proj/mapfile/full')
+        eq_(rv.status_code, 404)
+
+
 @test_context
 def test_get_mapfile_no_rows(client):
     rv = client.get('/mapper/proj/mapfile/full')
@@ -170,6 +520,90 @@ def test_get_mapfile_since(app, client):
     eq_(rv.data, '%s %s\n' % (SHA3, SHA3R))
 
 
+@test_context
+def test_get_mapfile_since_no_rows(app, client):
+    insert_some_hashes(app)
+    rv = client.get('/mapper/proj/mapfile/since/1970-01-02T00:00:00+00:00')
+    eq_(rv.status_code, 404)
+
+
+@test_context
+def test_get_mapfile_after(app, client):
+    insert_some_hashes(app)
+    rv = client.get('/mapper/proj/mapfile/after/0?limit=2')
+    eq_(rv.status_code, 200)
+    # ordered by date added
+    eq_(rv.data, '%s %s\n%s %s\n' % (SHA1, SHA1R, SHA2, SHA2R))
+    cursor = rv.headers['X-Mapper-Next-Cursor']
+
+    rv = client.get('/mapper/proj/mapfile/after/%s?limit=2' % cursor)
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s\n' % (SHA3, SHA3R))
+    cursor = rv.headers['X-Mapper-Next-Cursor']
+
+    # nothing new, so the cursor stays put
+    rv = client.get('/mapper/proj/mapfile/after/%s' % cursor)
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '')
+    eq_(rv.headers['X-Mapper-Next-Cursor'], cursor)
+
+
+@test_context
+def test_get_mapfile_after_same_second(app, client):
+    session = app.db.session('mapper')
+    project = session.query(Project).filter(Project.name == 'proj').one()
+    for git, hg in [(SHA1, SHA1R), (SHA2, SHA2R), (SHA3, SHA3R)]:
+        session.add(
+            Hash(git_commit=git, hg_changeset=hg, project=project, date_added=12345))
+    session.commit()
+    seen = []
+    cursor = '0'
+    for _ in range(3):
+        rv = client.get('/mapper/proj/mapfile/after/%s?limit=1' % cursor)
+        eq_(rv.status_code, 200)
+        seen.append(rv.data)
+        cursor = rv.headers['X-Mapper-Next-Cursor']
+    # ties are broken by hg changeset, and no row is skipped or repeated
+    eq_(seen, ['%s %s\n' % (SHA3, SHA3R), '%s %s\n' % (SHA1, SHA1R),
+               '%s %s\n' % (SHA2, SHA2R)])
+
+
+@test_context
+def test_get_mapfile_after_settling(app, client):
+    insert_some_hashes(app)
+    # only the mapping added at 12345 has settled
+    settle_time = time.time() - 12345.5
+    with mock.patch('relengapi.blueprints.mapper.FEED_SETTLE_TIME', settle_time):
+        rv = client.get('/mapper/proj/mapfile/after/0')
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s\n' % (SHA1, SHA1R))
+
+
+@test_context
+def test_get_mapfile_after_bad_cursor(app, client):
+    rv = client.get('/mapper/proj/mapfile/after/xyz')
+    eq_(rv.status_code, 400)
+    for cursor in [u'\xe9t\xe9'.encode('utf-8'),
+                   base64.urlsafe_b64encode('1:2:\xff\xfe'),
+                   base64.urlsafe_b64encode('1:2:3:4')]:
+        rv = client.get('/mapper/proj/mapfile/after/%s' % cursor)
+        eq_(rv.status_code, 400)
+
+
+@test_context
+def test_get_mapfile_after_bad_limit(app, client):
+    rv = client.get('/mapper/proj/mapfile/after/0?limit=0')
+    eq_(rv.status_code, 400)
+    rv = client.get('/mapper/proj/mapfile/after/0?limit=abc')
+    eq_(rv.status_code, 400)
+
+
+@test_context
+def test_get_mapfile_after_no_project(app, client):
+    rv = client.get('/mapper/notaproj/mapfile/after/0')
+    eq_(rv.status_code, 404)
+
+
 @test_context
 def test_insert_one(client):
     # TODO: this should really be POST
@@ -205,6 +639,23 @@ def test_insert_one_no_project(client):
     # TODO: check response when it's JSON
 
 
+@test_context
+def test_insert_multi_no_dups_dated_once(app, client):
+    """Mappings inserted in one transaction all have the date the request
+    began, and are not updated afterward"""
+    times = iter(xrange(1000, 2000))
+    with mock.patch('relengapi.blueprints.mapper.INSERT_CHUNK_SIZE', 1), \
+            mock.patch('relengapi.blueprints.mapper.time') as fake_time, \
+            count_queries(app.db.engine('mapper')) as statements:
+        fake_time.time.side_effect = lambda: next(times)
+        rv = client.post('/mapper/proj/insert',
+                         content_type='text/plain', data=SHAFILE)
+    eq_(rv.status_code, 200)
+    eq_([st for st in statements if st.startswith('UPDATE')], [])
+    session = app.db.session('mapper')
+    eq_(len(set(d for d, in session.query(Hash.date_added))), 1)
+
+
 @test_context
 def test_insert_multi_bad_content_type(app, client):
     rv = client.post('/mapper/proj/insert',
@@ -261,6 +712,63 @@ def test_insert_multi_ignoredups_with_dups(app, client):
     assert hash_pair_exists(app, SHA3, SHA3R)
 
 
+@test_context
+def test_insert_multi_no_dups_chunked(app, client):
+    with mock.patch('relengapi.blueprints.mapper.INSERT_CHUNK_SIZE', 2):
+        rv = client.post('/mapper/proj/insert',
+                         content_type='text/plain', data=SHAFILE)
+    eq_(rv.status_code, 200)
+    assert hash_pair_exists(app, SHA1, SHA1R)
+    assert hash_pair_exists(app, SHA2, SHA2R)
+    assert hash_pair_exists(app, SHA3, SHA3R)
+
+
+@test_context
+def test_insert_multi_no_dups_but_dups_in_later_chunk(app, client):
+    rv = client.post('/mapper/proj/insert/%s/%s' % (SHA3, SHA3R))
+    eq_(rv.status_code, 200)
+    with mock.patch('relengapi.blueprints.mapper.INSERT_CHUNK_SIZE', 2):
+        rv = client.post('/mapper/proj/insert',
+                         content_type='text/plain', data=SHAFILE)
+    eq_(rv.status_code, 409)
+    # the first chunk was rolled back, too
+    assert not hash_pair_exists(app, SHA1, SHA1R)
+    assert not hash_pair_exists(app, SHA2, SHA2R)
+    assert hash_pair_exists(app, SHA3, SHA3R)
+
+
+@test_context
+def test_insert_multi_no_dups_but_dups_in_request(app, client):
+    rv = client.post('/mapper/proj/insert', content_type='text/plain',
+                     data=SHAFILE + '%s %s\n' % (SHA1, SHA2R))
+    eq_(rv.status_code, 409)
+    assert not hash_pair_exists(app, SHA1, SHA1R)
+
+
+@test_context
+def test_insert_multi_malformed(app, client):
+    rv = client.post('/mapper/proj/insert', content_type='text/plain',
+                     data=SHAFILE + 'not a mapping\n')
+    eq_(rv.status_code, 400)
+    assert not hash_pair_exists(app, SHA1, SHA1R)
+
+
+@test_context
+def test_insert_multi_ignoredups_chunked_with_dups(app, client):
+    # SHA2's git commit already exists, mapped to a different hg changeset
+    rv = client.post('/mapper/proj/insert/%s/%s' % (SHA2, SHA3R))
+    eq_(rv.status_code, 200)
+    with mock.patch('relengapi.blueprints.mapper.INSERT_CHUNK_SIZE', 2):
+        rv = client.post('/mapper/proj/insert/ignoredups',
+                         content_type='text/plain', data=SHAFILE + SHAFILE)
+    eq_(rv.status_code, 200)
+    assert hash_pair_exists(app, SHA1, SHA1R)
+    assert not hash_pair_exists(app, SHA2, SHA2R)
+    assert hash_pair_exists(app, SHA2, SHA3R)
+    assert not hash_pair_exists(app, SHA3, SHA3R)
+    eq_(app.db.session('mapper').query(Hash).count(), 2)
+
+
 @test_context
 def test_add_project(client):
     rv = client.post('/mapper/proj2')
@@ -275,6 +783,89 @@ def test_add_project_existing(client):
     # TODO: check that return is JSON, once it is
 
 
+@test_context
+def test_project_cache(app, client):
+    insert_some_hashes(app)
+    with mock.patch('relengapi.blueprints.mapper.ProjectCache._load',
+                    autospec=True, side_effect=ProjectCache._load) as _load:
+        rv = client.get('/mapper/proj/mapfile/full')
+        eq_(rv.status_code, 200)
+        rv = client.get('/mapper/proj/rev/git/%s' % SHA1)
+        eq_(rv.status_code, 200)
+        # loaded at most once, by the first request
+        assert _load.call_count <= 1
+        _load.reset_mock()
+
+        # a project added by another process is found on a miss
+        session = app.db.session('mapper')
+        session.add(Project(name='proj2'))
+        session.commit()
+        rv = client.post('/mapper/proj2/insert/%s/%s' % (SHA1, SHA1R))
+        eq_(rv.status_code, 200)
+        eq_(_load.call_count, 1)
+        _load.reset_mock()
+
+        # and the whole table is re-read once the TTL expires
+        with mock.patch('time.time') as time:
+            time.return_value = 2 ** 40
+            rv = client.get('/mapper/proj/rev/git/%s' % SHA2)
+        eq_(rv.status_code, 200)
+        eq_(_load.call_count, 1)
+
+
+@test_context
+def test_project_cache_misses(app):
+    """Names that are not found cause a reload at most once per TTL"""
+    with app.app_context(), mock.patch('time.time') as fake_time, \
+            mock.patch('relengapi.blueprints.mapper.ProjectCache._load',
+                       autospec=True, side_effect=ProjectCache._load) as _load:
+        fake_time.return_value = 1000
+        cache = ProjectCache()
+        eq_(cache.get(['proj']), [1])
+        eq_(_load.call_count, 1)
+        for _ in range(3):
+            eq_(cache.get(['junk']), [])
+        eq_(_load.call_count, 2)
+        fake_time.return_value = 1000 + mapper.PROJECT_CACHE_TTL / 2
+        eq_(cache.get(['junk']), [])
+        eq_(_load.call_count, 2)
+        fake_time.return_value = 1000 + mapper.PROJECT_CACHE_TTL + 1
+        eq_(cache.get(['junk']), [])
+        eq_(_load.call_count, 3)
+
+
+@test_context
+def test_project_cache_warmed(app):
+    """The project cache is loaded before the first request if the database
+    is configured, and a failure to load it is only logged"""
+    assert mapper.warm_project_cache in app.before_first_request_funcs
+    with app.app_context():
+        app.mapper_projects.invalidate()
+        mapper.warm_project_cache()
+        assert app.mapper_projects._loaded is not None
+        app.mapper_projects.invalidate()
+        with mock.patch('relengapi.blueprints.mapper.ProjectCache._load',
+                        side_effect=RuntimeError('db down')):
+            mapper.warm_project_cache()
+        eq_(app.mapper_projects._loaded, None)
+        with mock.patch.dict(app.config, {'SQLALCHEMY_DATABASE_URIS': None}):
+            mapper.warm_project_cache()
+        eq_(app.mapper_projects._loaded, None)
+
+
+@test_context
+def test_add_project_then_insert(client):
+    rv = client.get('/mapper/proj2/mapfile/full')
+    eq_(rv.status_code, 404)
+    rv = client.post('/mapper/proj2')
+    eq_(rv.status_code, 200)
+    rv = client.post('/mapper/proj2/insert/%s/%s' % (SHA1, SHA1R))
+    eq_(rv.status_code, 200)
+    rv = client.get('/mapper/proj2/mapfile/full')
+    eq_(rv.status_code, 200)
+    eq_(rv.data, '%s %s\n' % (SHA1, SHA1R))
+
+
 @test_context
 def test_query_all_projects_1_result(client):
     rv = client.get('/mapper/projects')
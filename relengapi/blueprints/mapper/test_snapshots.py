@@ -0,0 +1,72 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+from nose.tools import eq_
+from relengapi.blueprints.mapper import snapshots
+
+LINES = ['%s %s\n' % (c * 40, h * 40) for c, h in [('1', 'a'), ('2', 'b')]]
+
+
+@contextmanager
+def snapshot_dir():
+    directory = tempfile.mkdtemp()
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_load_missing():
+    with snapshot_dir() as directory:
+        eq_(snapshots.load(directory, 'proj'), None)
+
+
+def test_write_load():
+    with snapshot_dir() as directory:
+        snapshots.write(directory, 'proj', iter(LINES), 1234, 2)
+        snap = snapshots.load(directory, 'proj')
+        eq_(snap.watermark, 1234)
+        eq_(snap.tail_count, 2)
+        eq_(list(snap.lines()), LINES)
+        assert snap.file.closed
+
+
+def test_write_replaces():
+    with snapshot_dir() as directory:
+        snapshots.write(directory, 'proj', iter(LINES), 1234, 2)
+        old = snapshots.load(directory, 'proj')
+        snapshots.write(directory, 'proj', iter(LINES[:1]), 1235, 1)
+        new = snapshots.load(directory, 'proj')
+        eq_(new.watermark, 1235)
+        eq_(list(new.lines()), LINES[:1])
+        assert new.digest != old.digest
+        # the already-open old snapshot is still readable
+        eq_(list(old.lines()), LINES)
+        # and only the new snapshot remains on disk
+        eq_(sorted(os.listdir(directory)),
+            ['proj-%s.gz' % new.digest, 'proj.json'])
+
+
+def test_remove():
+    with snapshot_dir() as directory:
+        snapshots.write(directory, 'proj', iter(LINES), 1234, 2)
+        snapshots.remove(directory, 'proj')
+        eq_(snapshots.load(directory, 'proj'), None)
+        eq_(os.listdir(directory), [])
+
+
+def test_merge():
+    extra = '%s %s\n' % ('3' * 40, 'ab' * 20)
+    eq_(list(snapshots.merge(iter(LINES), iter([extra]))),
+        [LINES[0], extra, LINES[1]])
+
+
+def test_merge_duplicates():
+    """Lines appearing in several map files are merged into one"""
+    eq_(list(snapshots.merge(iter(LINES), iter(LINES[1:]))), LINES)
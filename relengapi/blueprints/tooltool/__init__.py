@@ -15,7 +15,10 @@ from flask import redirect
 from flask import url_for
 from flask.ext.login import current_user
 from flask.ext.login import login_required
+from relengapi.blueprints.tooltool import cache
 from relengapi.blueprints.tooltool import grooming
+from relengapi.blueprints.tooltool import inventory
+from relengapi.blueprints.tooltool import search
 from relengapi.blueprints.tooltool import tables
 from relengapi.blueprints.tooltool import types
 from relengapi.blueprints.tooltool import util
@@ -53,6 +56,13 @@ p.tooltool.manage.doc("Manage tooltool files, including deleting and changing vi
 UPLOAD_EXPIRES_IN = 60
 GET_EXPIRES_IN = 60
 
+# the most files that can be resolved in one request
+MAX_RESOLVE_FILES = 1000
+
+# the default and maximum number of search results in one request
+DEFAULT_SEARCH_LIMIT = 100
+MAX_SEARCH_LIMIT = 1000
+
 logger = structlog.get_logger()
 
 
@@ -63,6 +73,13 @@ def get_region_and_bucket(region_arg):
     # no region specified, so return one at random
     return random.choice(cfg.items())
 
+
+def can_download(visibility):
+    allow_pub_dl = current_app.config.get('TOOLTOOL_ALLOW_ANONYMOUS_PUBLIC_DOWNLOAD')
+    if visibility == 'public' and allow_pub_dl:
+        return True
+    return p.get('tooltool.download.{}'.format(visibility)).can()
+
 bp.root_widget_template(
     'tooltool_root_widget.html', priority=100,
     condition=lambda: not current_user.is_anonymous())
@@ -76,23 +93,35 @@ def root():
                             url_for('.static', filename='tooltool.css'))
 
 
+def check_search_page(limit, offset):
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        raise BadRequest("limit must be between 1 and {}".format(MAX_SEARCH_LIMIT))
+    if offset < 0:
+        raise BadRequest("offset must not be negative")
+
+
 @bp.route('/upload')
-@api.apimethod([types.UploadBatch], unicode)
-def search_batches(q):
+@api.apimethod([types.UploadBatch], unicode, int, int)
+def search_batches(q, limit=DEFAULT_SEARCH_LIMIT, offset=0):
     """Search upload batches.  The required query parameter ``q`` can match a
-    substring of an author's email or a batch message."""
-    tbl = tables.Batch
-    q = tbl.query.filter(sa.or_(
-        tbl.author.contains(q),
-        tbl.message.contains(q)))
-    return [row.to_json() for row in q.all()]
+    substring of an author's email or a batch message.  Queries of at least
+    three characters use an index.
+
+    Results are ordered by batch id.  At most ``limit`` results (default 100,
+    maximum 1000) are returned, starting after the first ``offset``."""
+    check_search_page(limit, offset)
+    session = g.db.session('relengapi')
+    return tables.batches_to_json(session, search.search_batches(session, q, limit, offset))
 
 
 @bp.route('/upload/<int:id>')
 @api.apimethod(types.UploadBatch, int)
 def get_batch(id):
     """Get a specific upload batch by id."""
-    row = tables.Batch.query.filter(tables.Batch.id == id).first()
+    tbl = tables.Batch
+    row = tbl.query.filter(tbl.id == id).options(
+        sa.orm.subqueryload(tbl._files).joinedload(tables.BatchFile.file).subqueryload(
+            tables.File.instances)).first()
     if not row:
         raise NotFound
     return row.to_json()
@@ -147,47 +176,77 @@ def upload_batch(region=None, body=None):
         author=body.author,
         message=body.message)
 
-    s3 = current_app.aws.connect_to('s3', region)
-    for filename, info in body.files.iteritems():
-        log = logger.bind(tooltool_sha512=info.digest, tooltool_operation='upload',
-                          tooltool_batch_id=batch.id)
+    for info in body.files.itervalues():
         if info.algorithm != 'sha512':
             raise BadRequest("'sha512' is the only allowed digest algorithm")
         if not is_valid_sha512(info.digest):
             raise BadRequest("Invalid sha512 digest")
-        digest = info.digest
-        file = tables.File.query.filter(tables.File.sha512 == digest).first()
-        if file and file.visibility != info.visibility:
-            raise BadRequest("Cannot change a file's visibility level")
-        if file and file.instances != []:
-            if file.size != info.size:
-                raise BadRequest("Size mismatch for {}".format(filename))
+
+    # fetch all of the files in the batch that already exist, with their
+    # instances, in a constant number of queries
+    tbl = tables.File
+    digests = set(info.digest for info in body.files.itervalues())
+    files = {f.sha512: f for f in tbl.query.filter(tbl.sha512.in_(digests)).options(
+        sa.orm.subqueryload(tbl.instances))}
+
+    new_files = {}
+    to_upload = []
+    for filename, info in body.files.iteritems():
+        file = files.get(info.digest)
+        if file:
+            if file.visibility != info.visibility:
+                raise BadRequest("Cannot change a file's visibility level")
+            if file.instances != []:
+                if file.size != info.size:
+                    raise BadRequest("Size mismatch for {}".format(filename))
+                continue
+        elif info.digest in new_files:
+            if new_files[info.digest]['visibility'] != info.visibility:
+                raise BadRequest("Cannot change a file's visibility level")
         else:
-            if not file:
-                file = tables.File(
-                    sha512=digest,
-                    visibility=info.visibility,
-                    size=info.size)
-                session.add(file)
-            log.info("generating signed S3 PUT URL to {} for {}; expiring in {}s".format(
-                info.digest[:10], current_user, UPLOAD_EXPIRES_IN))
-            info.put_url = s3.generate_url(
-                method='PUT', expires_in=UPLOAD_EXPIRES_IN, bucket=bucket,
-                key=util.keyname(info.digest),
-                headers={'Content-Type': 'application/octet-stream'})
-            # The PendingUpload row needs to reflect the updated expiration
-            # time, even if there's an existing pending upload that expires
-            # earlier.  The `merge` method does a SELECT and then either UPDATEs
-            # or INSERTs the row.  However, merge needs the file_id, rather than
-            # just a reference to the file object; and for that, we need to flush
-            # the inserted file.
-            session.flush()
-            pu = tables.PendingUpload(
-                file_id=file.id,
-                region=region,
-                expires=time.now() + datetime.timedelta(seconds=UPLOAD_EXPIRES_IN))
-            session.merge(pu)
-        session.add(tables.BatchFile(filename=filename, file=file, batch=batch))
+            new_files[info.digest] = dict(
+                sha512=info.digest,
+                visibility=info.visibility,
+                size=info.size)
+        to_upload.append(info)
+
+    # insert the new files in bulk, then fetch them back to learn their ids
+    if new_files:
+        session.execute(tbl.__table__.insert(), new_files.values())
+        files.update((f.sha512, f) for f in tbl.query.filter(tbl.sha512.in_(new_files)))
+
+    for info in to_upload:
+        log = logger.bind(tooltool_sha512=info.digest, tooltool_operation='upload',
+                          tooltool_batch_id=batch.id)
+        log.info("generating signed S3 PUT URL to {} for {}; expiring in {}s".format(
+            info.digest[:10], current_user, UPLOAD_EXPIRES_IN))
+    put_urls = current_app.aws.generate_s3_urls(
+        region, bucket, [util.keyname(info.digest) for info in to_upload],
+        method='PUT', expires_in=UPLOAD_EXPIRES_IN,
+        headers={'Content-Type': 'application/octet-stream'})
+    for info, put_url in zip(to_upload, put_urls):
+        info.put_url = put_url
+
+    # The PendingUpload rows need to reflect the updated expiration time, even
+    # if there's an existing pending upload that expires earlier.  Update any
+    # existing rows for these files in bulk, leaving their verification locks
+    # in place, and insert rows for the rest.
+    file_ids = set(files[info.digest].id for info in to_upload)
+    if file_ids:
+        pu_tbl = tables.PendingUpload.__table__
+        expires = time.now() + datetime.timedelta(seconds=UPLOAD_EXPIRES_IN)
+        existing = set(row.file_id for row in session.execute(
+            sa.select([pu_tbl.c.file_id]).where(pu_tbl.c.file_id.in_(file_ids))))
+        if existing:
+            session.execute(pu_tbl.update().where(pu_tbl.c.file_id.in_(existing)).values(
+                region=region, expires=expires))
+        if file_ids - existing:
+            session.execute(pu_tbl.insert(), [
+                dict(file_id=file_id, region=region, expires=expires)
+                for file_id in file_ids - existing])
+
+    for filename, info in body.files.iteritems():
+        session.add(tables.BatchFile(filename=filename, file=files[info.digest], batch=batch))
     session.add(batch)
     session.commit()
 
@@ -231,16 +290,17 @@ def upload_complete(digest):
 
 
 @bp.route('/file')
-@api.apimethod([types.File], unicode)
-def search_files(q):
+@api.apimethod([types.File], unicode, int, int)
+def search_files(q, limit=DEFAULT_SEARCH_LIMIT, offset=0):
     """Search for files matching the query ``q``.  The query matches against
-    prefixes of hashes (at least 8 characters) or against filenames."""
+    prefixes of hashes (at least 8 characters) or against filenames.  Filename
+    queries of at least three characters use an index.
+
+    Results are ordered by file id.  At most ``limit`` results (default 100,
+    maximum 1000) are returned, starting after the first ``offset``."""
+    check_search_page(limit, offset)
     session = g.db.session('relengapi')
-    query = session.query(tables.File).join(tables.BatchFile)
-    query = query.filter(sa.or_(
-        tables.BatchFile.filename.contains(q),
-        tables.File.sha512.startswith(q)))
-    return [row.to_json() for row in query.all()]
+    return tables.files_to_json(session, search.search_files(session, q, limit, offset))
 
 
 @bp.route('/file/sha512/<digest>')
@@ -252,7 +312,9 @@ def get_file(digest):
 
     The returned File instance contains an ``instances`` attribute showing the
     regions in which the file exists."""
-    row = tables.File.query.filter(tables.File.sha512 == digest).first()
+    tbl = tables.File
+    row = tbl.query.filter(tbl.sha512 == digest).options(
+        sa.orm.joinedload(tbl.instances)).first()
     if not row:
         raise NotFound
     return row.to_json(include_instances=True)
@@ -279,7 +341,8 @@ def patch_file(digest, body):
     The returned File instance contains an ``instances`` attribute showing any
     changes."""
     session = current_app.db.session('relengapi')
-    file = session.query(tables.File).filter(tables.File.sha512 == digest).first()
+    file = session.query(tables.File).filter(tables.File.sha512 == digest).options(
+        sa.orm.joinedload(tables.File.instances)).first()
     if not file:
         raise NotFound
 
@@ -301,6 +364,7 @@ def patch_file(digest, body):
         else:
             raise BadRequest("unknown op")
     session.commit()
+    cache.invalidate(digest)
     return file.to_json(include_instances=True)
 
 
@@ -317,36 +381,124 @@ def download_file(digest, region=None):
     if not is_valid_sha512(digest):
         raise BadRequest("Invalid sha512 digest")
 
-    # see where the file is..
-    tbl = tables.File
-    file_row = tbl.query.filter(tbl.sha512 == digest).first()
-    if not file_row or not file_row.instances:
+    # see where the file is, from the cache if possible
+    info = cache.get_file(digest)
+    if info is None:
+        tbl = tables.File
+        file_row = tbl.query.filter(tbl.sha512 == digest).options(
+            sa.orm.subqueryload(tbl.instances)).first()
+        if not file_row:
+            raise NotFound
+        info = cache.set_file(digest, file_row.visibility,
+                              [inst.region for inst in file_row.instances])
+    if not info['regions']:
         raise NotFound
+    visibility = info['visibility']
 
     # check visibility
-    allow_pub_dl = current_app.config.get('TOOLTOOL_ALLOW_ANONYMOUS_PUBLIC_DOWNLOAD')
-    if file_row.visibility != 'public' or not allow_pub_dl:
-        if not p.get('tooltool.download.{}'.format(file_row.visibility)).can():
-            raise Forbidden
+    if not can_download(visibility):
+        raise Forbidden
 
     # figure out which region to use, and from there which bucket
     cfg = current_app.config['TOOLTOOL_REGIONS']
-    selected_region = None
-    for inst in file_row.instances:
-        if inst.region == region:
-            selected_region = inst.region
-            break
+    if region in info['regions']:
+        selected_region = region
     else:
         # preferred region not found, so pick one from the available set
-        selected_region = random.choice([inst.region for inst in file_row.instances])
+        selected_region = random.choice(info['regions'])
     bucket = cfg[selected_region]
 
+    signed_url = cache.get_url(digest, selected_region, visibility)
+    if signed_url:
+        return redirect(signed_url)
+
     key = util.keyname(digest)
 
-    s3 = current_app.aws.connect_to('s3', selected_region)
     log.info("generating signed S3 GET URL for {}.. expiring in {}s".format(
         digest[:10], GET_EXPIRES_IN))
-    signed_url = s3.generate_url(
-        method='GET', expires_in=GET_EXPIRES_IN, bucket=bucket, key=key)
+    signed_url, = current_app.aws.generate_s3_urls(
+        selected_region, bucket, [key], method='GET', expires_in=GET_EXPIRES_IN)
+    cache.set_url(digest, selected_region, visibility, signed_url, GET_EXPIRES_IN)
 
     return redirect(signed_url)
+
+
+@bp.route('/resolve', methods=['POST'])
+@api.apimethod({unicode: types.ResolvedFile}, unicode, body=[unicode])
+def resolve_files(region=None, body=None):
+    """Resolve a list of sha512 digests, such as those in a tooltool manifest,
+    to signed download URLs in a single request.  The result is keyed by
+    digest, and gives a status for each file: 200 with a ``get_url`` if the
+    file can be downloaded, 403 if the user does not have permission to
+    download it, or 404 if it does not exist or is not available in any
+    region.  At most 1000 digests can be resolved at once.
+
+    The query argument ``region=us-west-1`` indicates a preference for URLs in
+    that region, as for ``GET /tooltool/sha512/<digest>``.  The returned URLs
+    are valid for the same short time as those returned by that endpoint."""
+    digests = set(body)
+    if len(digests) > MAX_RESOLVE_FILES:
+        raise BadRequest("at most {} files can be resolved at once".format(
+            MAX_RESOLVE_FILES))
+    for digest in digests:
+        if not is_valid_sha512(digest):
+            raise BadRequest("Invalid sha512 digest")
+    if not digests:
+        return {}
+
+    # see where the files are, from the cache where possible
+    infos = cache.get_files(digests)
+    missing = digests - set(infos)
+    if missing:
+        tbl = tables.File
+        q = tbl.query.filter(tbl.sha512.in_(missing)).options(
+            sa.orm.subqueryload(tbl.instances))
+        infos.update(cache.set_files({
+            f.sha512: (f.visibility, [inst.region for inst in f.instances]) for f in q}))
+
+    # check each visibility level only once
+    allowed = {}
+    result = {}
+    wanted = []
+    for digest in digests:
+        info = infos.get(digest)
+        if not info or not info['regions']:
+            result[digest] = types.ResolvedFile(digest=digest, status=404)
+            continue
+        visibility = info['visibility']
+        if visibility not in allowed:
+            allowed[visibility] = can_download(visibility)
+        if not allowed[visibility]:
+            result[digest] = types.ResolvedFile(digest=digest, status=403)
+            continue
+        regions = info['regions']
+        selected_region = region if region in regions else random.choice(regions)
+        wanted.append((digest, selected_region, visibility))
+
+    # reuse cached URLs, and sign the rest for each region in bulk
+    signed = cache.get_urls(wanted)
+    to_sign = {}
+    for digest, selected_region, visibility in wanted:
+        if digest not in signed:
+            to_sign.setdefault(selected_region, []).append((digest, visibility))
+    cfg = current_app.config['TOOLTOOL_REGIONS']
+    new_urls = {}
+    for selected_region, region_files in to_sign.iteritems():
+        logger.info("generating {} signed S3 GET URLs in {}; expiring in {}s".format(
+            len(region_files), selected_region, GET_EXPIRES_IN),
+            tooltool_operation='resolve')
+        signed_urls = current_app.aws.generate_s3_urls(
+            selected_region, cfg[selected_region],
+            [util.keyname(digest) for digest, visibility in region_files],
+            method='GET', expires_in=GET_EXPIRES_IN)
+        for (digest, visibility), signed_url in zip(region_files, signed_urls):
+            signed[digest] = signed_url
+            new_urls[digest, selected_region, visibility] = signed_url
+    cache.set_urls(new_urls, GET_EXPIRES_IN)
+
+    for digest, signed_url in signed.iteritems():
+        result[digest] = types.ResolvedFile(digest=digest, status=200, get_url=signed_url)
+    return result
+
+# the inventory module only defines a periodic task, so importing it is enough
+_hush_pyflakes = [inventory]
@@ -0,0 +1,127 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Caching for the download path.
+
+Downloads only need a file's visibility and the regions it is in, so those
+are cached by digest for a short time.  Signed download URLs are cached, too,
+for a fraction of their lifetime, so that a burst of downloads of the same
+file shares one URL.  Any change to a file's visibility or instances must call
+`invalidate`.  If ``TOOLTOOL_CACHE`` is not configured, nothing is cached.
+"""
+
+from contextlib import contextmanager
+from flask import current_app
+
+# how long a file's visibility and regions are cached, in seconds
+FILE_TTL = 60
+
+# the fraction of a signed URL's lifetime for which it is reused
+URL_REUSE_FRACTION = 0.25
+
+VISIBILITIES = ('internal', 'public')
+
+
+@contextmanager
+def _get_mc():
+    cfg = current_app.config.get('TOOLTOOL_CACHE')
+    if not cfg:
+        yield None
+    else:
+        with current_app.memcached.cache(cfg) as mc:
+            yield mc
+
+
+def _file_key(digest):
+    return str('tooltool:file:{}'.format(digest))
+
+
+def _url_key(digest, region, visibility):
+    return str('tooltool:url:{}:{}:{}'.format(visibility, region, digest))
+
+
+def get_file(digest):
+    """Return the cached ``{'visibility': .., 'regions': [..]}`` for the given
+    digest, or None"""
+    with _get_mc() as mc:
+        if not mc:
+            return None
+        return mc.get(_file_key(digest))
+
+
+def set_file(digest, visibility, regions):
+    """Cache a file's visibility and regions, returning the cached value"""
+    info = {'visibility': visibility, 'regions': list(regions)}
+    with _get_mc() as mc:
+        if mc:
+            mc.set(_file_key(digest), info, time=FILE_TTL)
+    return info
+
+
+def get_files(digests):
+    """Return a dictionary of the cached information for those of the given
+    digests which are cached, as for `get_file`"""
+    with _get_mc() as mc:
+        if not mc:
+            return {}
+        keys = {_file_key(d): d for d in digests}
+        return {keys[k]: v for k, v in mc.get_multi(keys.keys()).iteritems()}
+
+
+def set_files(files):
+    """Cache the visibility and regions of each file in a dictionary keyed by
+    digest, with (visibility, regions) values, returning the cached values"""
+    infos = {d: {'visibility': vis, 'regions': list(regions)}
+             for d, (vis, regions) in files.iteritems()}
+    with _get_mc() as mc:
+        if mc and infos:
+            mc.set_multi({_file_key(d): i for d, i in infos.iteritems()}, time=FILE_TTL)
+    return infos
+
+
+def get_url(digest, region, visibility):
+    """Return a cached signed download URL, or None"""
+    with _get_mc() as mc:
+        if not mc:
+            return None
+        return mc.get(_url_key(digest, region, visibility))
+
+
+def set_url(digest, region, visibility, url, expires_in):
+    """Cache a signed download URL which expires in `expires_in` seconds"""
+    with _get_mc() as mc:
+        if mc:
+            # a time of zero would never expire
+            ttl = max(1, int(expires_in * URL_REUSE_FRACTION))
+            mc.set(_url_key(digest, region, visibility), url, time=ttl)
+
+
+def get_urls(wanted):
+    """Return a dictionary, keyed by digest, of the cached signed download
+    URLs among those `wanted`, a list of (digest, region, visibility)"""
+    with _get_mc() as mc:
+        if not mc:
+            return {}
+        keys = {_url_key(*w): w[0] for w in wanted}
+        return {keys[k]: v for k, v in mc.get_multi(keys.keys()).iteritems()}
+
+
+def set_urls(urls, expires_in):
+    """Cache signed download URLs which expire in `expires_in` seconds, given
+    as a dictionary keyed by (digest, region, visibility)"""
+    with _get_mc() as mc:
+        if mc and urls:
+            ttl = max(1, int(expires_in * URL_REUSE_FRACTION))
+            mc.set_multi({_url_key(*k): v for k, v in urls.iteritems()}, time=ttl)
+
+
+def invalidate(digest):
+    """Forget everything cached about the given digest"""
+    with _get_mc() as mc:
+        if not mc:
+            return None
+        mc.delete(_file_key(digest))
+        for region in current_app.config['TOOLTOOL_REGIONS']:
+            for visibility in VISIBILITIES:
+                mc.delete(_url_key(digest, region, visibility))
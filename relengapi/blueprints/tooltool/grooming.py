@@ -2,12 +2,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import collections
 import hashlib
 import sqlalchemy as sa
 import structlog
 
 from datetime import timedelta
 from flask import current_app
+from multiprocessing.pool import ThreadPool
+from relengapi.blueprints.tooltool import cache
 from relengapi.blueprints.tooltool import tables
 from relengapi.blueprints.tooltool import util
 from relengapi.lib import badpenny
@@ -17,24 +20,219 @@ from relengapi.lib import time
 logger = structlog.get_logger()
 
 
+# how long a pending upload stays locked while it is being verified; this
+# should comfortably exceed the time taken to download and hash a large file
+VERIFY_LOCK_DURATION = timedelta(hours=1)
+
+# default number of pending uploads to verify at once
+DEFAULT_VERIFY_CONCURRENCY = 4
+
+# how long after its URL expires an upload may be verified; after this, the
+# upload is considered abandoned and its pending upload is deleted
+UPLOAD_COMPLETION_WINDOW = timedelta(days=1)
+
+# number of pending uploads read and checked at a time, and the default time
+# after which check_pending_uploads stops starting new chunks (it runs every
+# ten minutes)
+VERIFY_CHUNK_SIZE = 100
+DEFAULT_VERIFY_TIME_LIMIT = 480
+
+# default size of the ranges in which uploads are read for verification, and
+# the number of ranges fetched at once for each upload
+DEFAULT_VERIFY_BUFFER_SIZE = 8 * 1024 * 1024
+DEFAULT_VERIFY_READ_AHEAD = 4
+
+# default number of concurrent copies made by the replication task, and the
+# time after which it stops starting new copies (it runs hourly)
+DEFAULT_REPLICATION_CONCURRENCY = 8
+DEFAULT_REPLICATION_TIME_LIMIT = 3000
+
+# number of files replicated between updates of the replication cursor
+REPLICATION_CHUNK_SIZE = 100
+
+# how long a file stays locked while it is being replicated
+REPLICATION_LOCK_DURATION = timedelta(hours=1)
+
+# for each region, the regions from which to copy files, nearest first
+REGION_PROXIMITY = {
+    'us-east-1': ['us-west-2', 'us-west-1'],
+    'us-west-1': ['us-west-2', 'us-east-1'],
+    'us-west-2': ['us-west-1', 'us-east-1'],
+}
+
+
 @badpenny.periodic_task(seconds=600)
 def check_pending_uploads(job_status):
     """Check for any pending uploads and verify them if found."""
+    config = current_app.config
     session = current_app.db.session('relengapi')
-    for pu in tables.PendingUpload.query.all():
-        check_pending_upload(session, pu)
+    concurrency = config.get('TOOLTOOL_VERIFY_CONCURRENCY', DEFAULT_VERIFY_CONCURRENCY)
+    time_limit = config.get('TOOLTOOL_VERIFY_TIME_LIMIT', DEFAULT_VERIFY_TIME_LIMIT)
+    deadline = time.now() + timedelta(seconds=time_limit)
+
+    purge_abandoned_uploads(session, job_status)
+
+    # page through the uploads which are ready to verify, in order by
+    # (expires, file_id); uploads which are not yet complete remain in the
+    # table, so the position after each chunk is tracked rather than re-reading
+    # from the top.  The uploads are downloaded and hashed in a pool of
+    # threads, so that one large file doesn't hold up the rest; all database
+    # access happens here.
+    pool = ThreadPool(concurrency)
+    try:
+        after = None
+        pus = True
+        while pus and time.now() < deadline:
+            pus = verifiable_uploads(session, after)
+            if pus:
+                after = (pus[-1].expires, pus[-1].file_id)
+                check_uploads(session, pool, pus, concurrency, job_status)
+        if pus:
+            job_status.log_message("time limit reached; leaving the remaining "
+                                   "uploads for the next run")
+    finally:
+        pool.close()
+        pool.join()
+
+
+def purge_abandoned_uploads(session, job_status):
+    """Delete, in one statement, the pending uploads which expired too long
+    ago to ever be completed, other than any still being verified."""
+    tbl = tables.PendingUpload
+    now = time.now()
+    q = session.query(tbl).filter(tbl.expires < now - UPLOAD_COMPLETION_WINDOW)
+    q = q.filter(sa.or_(tbl.verifying_until.is_(None), tbl.verifying_until < now))
+    deleted = q.delete(synchronize_session=False)
     session.commit()
+    if deleted:
+        job_status.log_message("deleted {} abandoned pending uploads".format(deleted))
+
+
+def verifiable_uploads(session, after=None):
+    """Get the next chunk of pending uploads whose URLs have expired within
+    UPLOAD_COMPLETION_WINDOW and which are not being verified, in order by
+    (expires, file_id) and following `after`, a pair of those values.  This
+    is a range scan of the index on `expires`."""
+    tbl = tables.PendingUpload
+    now = time.now()
+    q = tbl.query.filter(tbl.expires < now)
+    q = q.filter(tbl.expires >= now - UPLOAD_COMPLETION_WINDOW)
+    q = q.filter(sa.or_(tbl.verifying_until.is_(None), tbl.verifying_until < now))
+    if after is not None:
+        expires, file_id = after
+        q = q.filter(sa.or_(tbl.expires > expires,
+                            sa.and_(tbl.expires == expires, tbl.file_id > file_id)))
+    q = q.options(sa.orm.joinedload(tbl.file).subqueryload(tables.File.instances))
+    return q.order_by(tbl.expires, tbl.file_id).limit(VERIFY_CHUNK_SIZE).all()
+
+
+def check_uploads(session, pool, pus, concurrency, job_status):
+    """Verify the given pending uploads in the thread pool and record the
+    results.  An error checking one upload is logged, and its lock released,
+    without affecting the others."""
+    checks = []
+    for pu in pus:
+        sha512 = pu.file.sha512
+        try:
+            args = start_check(session, pu)
+        except Exception:
+            # start_check locks the upload only as its last step, so there is
+            # no lock to release
+            session.rollback()
+            logger.exception("while checking upload of {}".format(sha512),
+                             tooltool_sha512=sha512)
+            job_status.log_message("error checking {}".format(sha512))
+            continue
+        if args:
+            checks.append((pu, pu.file_id, sha512, args['region'],
+                           pool.apply_async(verify_upload, kwds=args)))
+    session.commit()
+    if checks:
+        job_status.log_message("verifying {} uploads, {} at a time".format(
+            len(checks), concurrency))
+
+    for i, (pu, file_id, sha512, region, result) in enumerate(checks, 1):
+        try:
+            valid = result.get()
+            finish_check(session, pu, valid, region)
+        except Exception:
+            logger.exception("while verifying upload of {}".format(sha512),
+                             tooltool_sha512=sha512)
+            job_status.log_message("{}/{}: error verifying {}".format(
+                i, len(checks), sha512))
+            _release_after_error(session, file_id)
+            continue
+        job_status.log_message("{}/{}: {} is {}".format(
+            i, len(checks), sha512,
+            {True: 'valid', False: 'invalid', None: 'missing'}[valid]))
 
 
 @badpenny.periodic_task(seconds=3600)
 def replicate(job_status):
     """Replicate objects between regions as necessary"""
-    # fetch all files with at least one instance, but not a full complement
+    config = current_app.config
+    regions = config['TOOLTOOL_REGIONS']
+    session = current_app.db.session('relengapi')
+    log_replication_backlog(session, regions, job_status)
+
+    concurrency = config.get('TOOLTOOL_REPLICATION_CONCURRENCY',
+                             DEFAULT_REPLICATION_CONCURRENCY)
+    time_limit = config.get('TOOLTOOL_REPLICATION_TIME_LIMIT',
+                            DEFAULT_REPLICATION_TIME_LIMIT)
+    started = time.now()
+    deadline = started + timedelta(seconds=time_limit)
+    stats = collections.Counter()
+
+    # pick up where the last run left off, then wrap around to the files it
+    # skipped; the cursor is saved after each chunk, in case we run out of time
+    cursor = load_replication_cursor(session)
+    passes = [(cursor, None)] + ([(0, cursor)] if cursor else [])
+    pool = ThreadPool(concurrency)
+    try:
+        for after, upto in passes:
+            files = True
+            while files and time.now() < deadline:
+                files = under_replicated_files(session, len(regions), after, upto)
+                if files:
+                    replicate_files(session, pool, files, stats)
+                    after = files[-1].id
+                    save_replication_cursor(session, after)
+            if files:
+                job_status.log_message("time limit reached; stopping after file "
+                                       "id {}".format(after))
+                break
+            # this pass is complete, so the next run can start from the top
+            save_replication_cursor(session, 0)
+    finally:
+        pool.close()
+        pool.join()
+
+    elapsed = (time.now() - started).total_seconds()
+    job_status.log_message(
+        "made {} copies ({} bytes) in {:.0f}s: {:.2f} copies/s, {:.0f} bytes/s; "
+        "{} errors; {} files already being replicated".format(
+            stats['copies'], stats['bytes'], elapsed,
+            stats['copies'] / elapsed if elapsed else 0,
+            stats['bytes'] / elapsed if elapsed else 0,
+            stats['errors'], stats['skipped']))
+
+
+def log_replication_backlog(session, regions, job_status):
+    fi_tbl = tables.FileInstance
+    # files with at least one instance
+    num_files = session.query(sa.func.count(sa.distinct(fi_tbl.file_id))).scalar()
+    per_region = dict(session.query(fi_tbl.region, sa.func.count('*')).group_by(fi_tbl.region))
+    lag = ['{}: {}'.format(r, num_files - per_region.get(r, 0)) for r in sorted(regions)]
+    backlog = under_replicated_query(session, len(regions)).count()
+    job_status.log_message("{} files need replication; files missing per region: {}".format(
+        backlog, ', '.join(lag)))
+
+
+def under_replicated_query(session, num_regions):
+    # all files with at least one instance, but not a full complement
     # of instances
-    num_regions = len(current_app.config['TOOLTOOL_REGIONS'])
     fi_tbl = tables.FileInstance
     f_tbl = tables.File
-    session = current_app.db.session('relengapi')
     subq = session.query(
         fi_tbl.file_id,
         sa.func.count('*').label('instance_count'))
@@ -43,16 +241,92 @@ def replicate(job_status):
     q = session.query(f_tbl)
     q = q.join(subq, f_tbl.id == subq.c.file_id)
     q = q.filter(subq.c.instance_count < num_regions)
-    q = q.all()
-    for file in q:
-        replicate_file(session, file)
+    return q
+
+
+def under_replicated_files(session, num_regions, after, upto=None):
+    """Get the next chunk of files needing replication, in order by id, with
+    id greater than `after` and at most `upto`"""
+    f_tbl = tables.File
+    q = under_replicated_query(session, num_regions)
+    q = q.filter(f_tbl.id > after)
+    if upto is not None:
+        q = q.filter(f_tbl.id <= upto)
+    q = q.options(sa.orm.subqueryload(f_tbl.instances))
+    return q.order_by(f_tbl.id).limit(REPLICATION_CHUNK_SIZE).all()
+
+
+def load_replication_cursor(session):
+    row = session.query(tables.ReplicationCursor).first()
+    return row.file_id if row else 0
+
+
+def save_replication_cursor(session, file_id):
+    session.merge(tables.ReplicationCursor(id=1, file_id=file_id))
     session.commit()
 
 
-def replicate_file(session, file, _test_shim=lambda: None):
-    log = logger.bind(tooltool_sha512=file.sha512)
+def lock_file_for_replication(session, file_id):
+    """Lock a file for replication, returning False if another replicator
+    already holds the lock.  The caller must commit the session."""
+    tbl = tables.File
+    return _lock(session.query(tbl).filter(tbl.id == file_id),
+                 tbl.replicating_until, REPLICATION_LOCK_DURATION)
+
+
+def unlock_files_for_replication(session, file_ids):
+    tbl = tables.File
+    _unlock(session.query(tbl).filter(tbl.id.in_(file_ids)), tbl.replicating_until)
+    session.commit()
+
+
+def replicate_files(session, pool, files, stats):
+    """Replicate the given files in the thread pool, updating the counters
+    in `stats`.  Files which are already being replicated are skipped."""
     config = current_app.config['TOOLTOOL_REGIONS']
-    regions = set(config)
+    file_ids = [f.id for f in files if lock_file_for_replication(session, f.id)]
+    stats['skipped'] += len(files) - len(file_ids)
+    # commit the locks, then re-read the files, as another replicator may
+    # have finished with them in the meantime
+    session.commit()
+    if not file_ids:
+        return
+    f_tbl = tables.File
+    files = f_tbl.query.filter(f_tbl.id.in_(file_ids)).options(
+        sa.orm.subqueryload(f_tbl.instances)).all()
+
+    try:
+        copies = []
+        for file in files:
+            key_name = util.keyname(file.sha512)
+            for source_region, target_region in plan_replication(file):
+                args = (current_app.aws, key_name, config[source_region],
+                        target_region, config[target_region])
+                copies.append((file, target_region, pool.apply_async(copy_instance, args)))
+        # commit the session before replicating, since the DB connection may
+        # otherwise go away while we're distracted.
+        session.commit()
+
+        for file, target_region, result in copies:
+            try:
+                result.get()
+            except Exception:
+                logger.exception("while replicating {} to {}".format(file.sha512, target_region),
+                                 tooltool_sha512=file.sha512)
+                stats['errors'] += 1
+                continue
+            add_instance(session, file, target_region)
+            stats['copies'] += 1
+            stats['bytes'] += file.size
+    finally:
+        unlock_files_for_replication(session, file_ids)
+
+
+def plan_replication(file):
+    """Return (source region, target region) pairs for the copies needed to
+    replicate the given file, using the nearest source for each target."""
+    log = logger.bind(tooltool_sha512=file.sha512)
+    regions = set(current_app.config['TOOLTOOL_REGIONS'])
     file_regions = set([i.region for i in file.instances])
     # only use configured source regions; if a region is removed
     # from the configuration, we can't copy from it.
@@ -61,33 +335,56 @@ def replicate_file(session, file, _test_shim=lambda: None):
         # this should only happen when the only region containing a
         # file is removed from the configuration
         log.warning("no source regions for {}".format(file.sha512))
+        return []
+
+    def nearest(target_region):
+        proximity = REGION_PROXIMITY.get(target_region, [])
+        return min(source_regions, key=lambda r: (
+            proximity.index(r) if r in proximity else len(proximity), r))
+    return [(nearest(target_region), target_region)
+            for target_region in sorted(regions - file_regions)]
+
+
+def copy_instance(aws, key_name, source_bucket, target_region, target_bucket):
+    """Copy a key to another region.  This may run in a thread without an
+    application context."""
+    conn = aws.connect_to('s3', target_region)
+    bucket = conn.get_bucket(target_bucket, validate=False)
+    bucket.copy_key(new_key_name=key_name,
+                    src_key_name=key_name,
+                    src_bucket_name=source_bucket,
+                    storage_class='STANDARD',
+                    preserve_acl=False)
+
+
+def add_instance(session, file, region):
+    # add a file instance, but it's OK if it already exists
+    try:
+        session.add(tables.FileInstance(file=file, region=region))
+        session.commit()
+    except sa.exc.IntegrityError:
+        session.rollback()
+    cache.invalidate(file.sha512)
+
+
+def replicate_file(session, file, _test_shim=lambda: None):
+    log = logger.bind(tooltool_sha512=file.sha512)
+    config = current_app.config['TOOLTOOL_REGIONS']
+    plan = plan_replication(file)
+    if not plan:
         return
-    source_region = source_regions.pop()
-    source_bucket = config[source_region]
-    target_regions = regions - file_regions
-    log.info("replicating {} from {} to {}".format(
-        file.sha512, source_region, ', '.join(target_regions)))
+    log.info("replicating {} to {}".format(
+        file.sha512, ', '.join('{} from {}'.format(t, s) for s, t in plan)))
 
     key_name = util.keyname(file.sha512)
-    for target_region in target_regions:
-        target_bucket = config[target_region]
-        conn = current_app.aws.connect_to('s3', target_region)
-        bucket = conn.get_bucket(target_bucket)
-
+    for source_region, target_region in plan:
         # commit the session before replicating, since the DB connection may
         # otherwise go away while we're distracted.
         session.commit()
         _test_shim()
-        bucket.copy_key(new_key_name=key_name,
-                        src_key_name=key_name,
-                        src_bucket_name=source_bucket,
-                        storage_class='STANDARD',
-                        preserve_acl=False)
-        try:
-            session.add(tables.FileInstance(file=file, region=target_region))
-            session.commit()
-        except sa.exc.IntegrityError:
-            session.rollback()
+        copy_instance(current_app.aws, key_name, config[source_region],
+                      target_region, config[target_region])
+        add_instance(session, file, target_region)
 
 
 @celery.task
@@ -101,21 +398,81 @@ def check_file_pending_uploads(sha512):
     session.commit()
 
 
-def verify_file_instance(sha512, size, key):
-    """Verify that the given S3 Key matches the given size and digest."""
+def read_key(key, buffer_size=DEFAULT_VERIFY_BUFFER_SIZE):
+    """Generate the contents of the given S3 Key in blocks of `buffer_size`"""
+    try:
+        while True:
+            chunk = key.read(buffer_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        key.close()
+
+
+def read_ranges(fetch, size, buffer_size=DEFAULT_VERIFY_BUFFER_SIZE,
+                read_ahead=DEFAULT_VERIFY_READ_AHEAD):
+    """Generate the contents of an object of the given size, in order, by
+    calling ``fetch(start, stop)`` for consecutive ranges of `buffer_size`
+    bytes.  Up to `read_ahead` ranges are fetched at once, in a pool of
+    threads, so at most that many ranges are held in memory."""
+    pool = ThreadPool(read_ahead)
+    try:
+        pending = collections.deque()
+        for start in xrange(0, size, buffer_size):
+            pending.append(pool.apply_async(
+                fetch, (start, min(start + buffer_size, size))))
+            if len(pending) >= read_ahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+@celery.task
+def replicate_new_file(sha512):
+    """Replicate a newly-verified file to the other regions right away, rather
+    than waiting for the periodic replication task"""
+    session = current_app.db.session('relengapi')
+    file = tables.File.query.filter(tables.File.sha512 == sha512).first()
+    if not file:
+        return
+    locked = lock_file_for_replication(session, file.id)
+    session.commit()
+    if not locked:
+        # the periodic task is already on it
+        return
+    try:
+        replicate_file(session, file)
+    finally:
+        unlock_files_for_replication(session, [file.id])
+
+
+def verify_file_instance(sha512, size, key, chunks=None, check_digest=True):
+    """Verify that the given S3 Key matches the given size and digest.  The
+    key's contents are read from `chunks`, if given, or from the key itself.
+    If `check_digest` is false, the contents are not read at all."""
     log = logger.bind(tooltool_sha512=sha512)
     if key.size != size:
         log.warning("Uploaded file {} has unexpected size {}; expected "
                     "{}".format(sha512, key.size, size))
         return False
 
-    m = hashlib.sha512()
-    for bytes in key:
-        m.update(bytes)
+    if check_digest:
+        started = time.now()
+        m = hashlib.sha512()
+        for chunk in chunks if chunks is not None else read_key(key):
+            m.update(chunk)
+        elapsed = (time.now() - started).total_seconds()
+        log.info("Read {} bytes of {} in {:.1f}s ({:.0f} bytes/s)".format(
+            size, sha512, elapsed, size / elapsed if elapsed else 0),
+            tooltool_bytes=size, tooltool_seconds=elapsed)
 
-    if m.hexdigest() != sha512:
-        log.warning("Digest of file {} does not match".format(sha512))
-        return False
+        if m.hexdigest() != sha512:
+            log.warning("Digest of file {} does not match".format(sha512))
+            return False
 
     # verify some settings on the key, in case the uploader configured
     # it differently
@@ -137,10 +494,78 @@ def verify_file_instance(sha512, size, key):
 
 
 def check_pending_upload(session, pu, _test_shim=lambda: None):
+    args = start_check(session, pu)
+    if not args:
+        return
+    _test_shim()
+    file_id = pu.file_id
+    try:
+        finish_check(session, pu, verify_upload(**args), args['region'])
+    except Exception:
+        _release_after_error(session, file_id)
+        raise
+
+
+def _lock(q, column, duration):
+    # lock the row selected by q, unless it is already locked
+    now = time.now()
+    q = q.filter(sa.or_(column.is_(None), column < now))
+    return q.update({column: now + duration}, synchronize_session=False) == 1
+
+
+def _unlock(q, column):
+    q.update({column: None}, synchronize_session=False)
+
+
+def lock_pending_upload(session, pu):
+    """Lock the pending upload for verification, returning False if another
+    checker already holds the lock.  This commits the session."""
+    tbl = tables.PendingUpload
+    locked = _lock(session.query(tbl).filter(tbl.file_id == pu.file_id),
+                   tbl.verifying_until, VERIFY_LOCK_DURATION)
+    session.commit()
+    return locked
+
+
+def unlock_pending_upload(session, pu):
+    _unlock_upload(session, pu.file_id)
+
+
+def _unlock_upload(session, file_id):
+    tbl = tables.PendingUpload
+    _unlock(session.query(tbl).filter(tbl.file_id == file_id), tbl.verifying_until)
+    session.commit()
+
+
+def _release_after_error(session, file_id):
+    # roll back whatever the failed check left in the session, and unlock
+    # its upload so that it can be checked again without waiting for the
+    # lock to expire
+    session.rollback()
+    _unlock_upload(session, file_id)
+
+
+def delete_pending_upload(session, pu):
+    """Delete a checked pending upload.  If a new upload URL was issued for the
+    file while it was being checked, keep the pending upload, unlocked, so that
+    it is checked again once the new URL expires."""
+    tbl = tables.PendingUpload
+    q = session.query(tbl).filter(tbl.file_id == pu.file_id)
+    if q.filter(tbl.expires <= time.now()).delete(synchronize_session=False):
+        session.expunge(pu)
+    else:
+        _unlock(q, tbl.verifying_until)
+    session.commit()
+
+
+def start_check(session, pu):
+    """Decide whether to verify a pending upload, handling expired and
+    not-yet-complete uploads.  If the upload should be verified, lock it and
+    return the keyword arguments for `verify_upload`; otherwise return None."""
     # we can check the upload any time between the expiration of the URL
     # (after which the user can't make any more changes, but the upload
-    # may yet be incomplete) and 1 day afterward (ample time for the upload
-    # to complete)
+    # may yet be incomplete) and UPLOAD_COMPLETION_WINDOW afterward (ample
+    # time for the upload to complete)
     sha512 = pu.file.sha512
     size = pu.file.size
 
@@ -149,7 +574,7 @@ def check_pending_upload(session, pu, _test_shim=lambda: None):
     if time.now() < pu.expires:
         # URL is not expired yet
         return
-    elif time.now() > pu.expires + timedelta(days=1):
+    elif time.now() > pu.expires + UPLOAD_COMPLETION_WINDOW:
         # Upload will probably never complete
         log.info(
             "Deleting abandoned pending upload for {}".format(sha512))
@@ -171,31 +596,111 @@ def check_pending_upload(session, pu, _test_shim=lambda: None):
         # not uploaded yet
         return
 
-    # commit the session before verifying the file instance, since the
-    # DB connection may otherwise go away while we're distracted.
-    session.commit()
-    _test_shim()
+    # locking commits the session, which is good since the DB connection may
+    # otherwise go away while we're verifying the file instance.
+    if not lock_pending_upload(session, pu):
+        log.info("Upload of {} is already being verified".format(sha512))
+        return
 
-    if not verify_file_instance(sha512, size, key):
+    config = current_app.config
+    return dict(
+        aws=current_app.aws,
+        region=pu.region,
+        bucket_name=cfg[pu.region],
+        sha512=sha512,
+        size=size,
+        verified_in=[(i.region, cfg[i.region]) for i in pu.file.instances
+                     if i.region in cfg and i.region != pu.region],
+        buffer_size=config.get('TOOLTOOL_VERIFY_BUFFER_SIZE', DEFAULT_VERIFY_BUFFER_SIZE),
+        read_ahead=config.get('TOOLTOOL_VERIFY_READ_AHEAD', DEFAULT_VERIFY_READ_AHEAD),
+        etag_shortcut=config.get('TOOLTOOL_VERIFY_ETAG_SHORTCUT', False))
+
+
+def _get_key(aws, region, bucket_name, key_name):
+    bucket = aws.connect_to('s3', region).get_bucket(bucket_name, validate=False)
+    return bucket.get_key(key_name)
+
+
+def _fetch_range(aws, region, bucket_name, key_name, start, stop):
+    # called in a read_ranges thread, so use that thread's connection
+    bucket = aws.connect_to('s3', region).get_bucket(bucket_name, validate=False)
+    return bucket.new_key(key_name).get_contents_as_string(
+        headers={'Range': 'bytes={}-{}'.format(start, stop - 1)})
+
+
+def verify_upload(aws, region, bucket_name, sha512, size, verified_in=(),
+                  buffer_size=DEFAULT_VERIFY_BUFFER_SIZE,
+                  read_ahead=DEFAULT_VERIFY_READ_AHEAD, etag_shortcut=False):
+    """Verify an uploaded file, deleting it if it is invalid.  Returns None if
+    the file is missing.  This may run in a thread without an application
+    context, so it only uses the given AWS object, and not the database.
+
+    The file is read in ranges of `buffer_size` bytes, `read_ahead` at a
+    time.  If `etag_shortcut` is true and the file has the same size and ETag
+    as an already-verified instance in one of the (region, bucket name) pairs
+    in `verified_in`, its digest is not checked."""
+    log = logger.bind(tooltool_sha512=sha512)
+    key_name = util.keyname(sha512)
+    key = _get_key(aws, region, bucket_name, key_name)
+    if not key:
+        return None
+
+    check_digest = True
+    if etag_shortcut:
+        for other_region, other_bucket_name in verified_in:
+            other = _get_key(aws, other_region, other_bucket_name, key_name)
+            if other and other.size == key.size and other.etag == key.etag:
+                log.info("Upload of {} matches the ETag of the verified instance "
+                         "in {}".format(sha512, other_region))
+                check_digest = False
+                break
+
+    def fetch(start, stop):
+        return _fetch_range(aws, region, bucket_name, key_name, start, stop)
+    chunks = read_ranges(fetch, key.size, buffer_size, read_ahead)
+    if not verify_file_instance(sha512, size, key, chunks=chunks,
+                                check_digest=check_digest):
         log.warning(
             "Upload of {} was invalid; deleting key".format(sha512))
         key.delete()
-        session.delete(pu)
-        session.commit()
+        return False
+    return True
+
+
+def finish_check(session, pu, valid, region=None):
+    """Record the result of `verify_upload` for a locked pending upload, which
+    was verified in the given region (by default, the pending upload's; a new
+    upload URL may have been issued for another region meanwhile)."""
+    region = region or pu.region
+    sha512 = pu.file.sha512
+    log = logger.bind(tooltool_sha512=sha512)
+
+    if valid is None:
+        # the key went away while we weren't looking; try again next time
+        unlock_pending_upload(session, pu)
+        return
+
+    if not valid:
+        delete_pending_upload(session, pu)
         return
 
     log.info("Upload of {} considered valid".format(sha512))
     # add a file instance, but it's OK if it already exists
     try:
-        tables.FileInstance(file=pu.file, region=pu.region)
+        tables.FileInstance(file=pu.file, region=region)
         session.commit()
     except sa.exc.IntegrityError:
         session.rollback()
 
     # and delete the pending upload
-    session.delete(pu)
-    session.commit()
+    delete_pending_upload(session, pu)
+    cache.invalidate(sha512)
 
-    # note that we don't try to copy the file out just yet; that can wait for
-    # the next scheduled distribution, and in the interim everyone will hit
-    # this one instance.
+    # copy the file to the other regions in the background; the periodic
+    # replication task will catch it if this fails, so a broken broker does
+    # not make the (already recorded) check fail
+    try:
+        replicate_new_file.delay(sha512)
+    except Exception:
+        log.warning("Could not queue replication of {}; leaving it to the "
+                    "periodic replication task".format(sha512), exc_info=True)
@@ -0,0 +1,203 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Reconciliation of file instances with the contents of each region's bucket.
+
+The keys in each bucket are listed in bulk, or read from an S3 inventory file
+if one is configured for the region, and compared with the region's file
+instances as sets of digests.  Digests are held in their 64-byte binary form,
+half the size of the hex form, so that millions of them fit in memory.
+"""
+
+import binascii
+import csv
+import gzip
+import re
+import sqlalchemy as sa
+import structlog
+
+from flask import current_app
+from relengapi.blueprints.tooltool import cache
+from relengapi.blueprints.tooltool import tables
+from relengapi.blueprints.tooltool import util
+from relengapi.lib import badpenny
+from relengapi.lib import time
+
+logger = structlog.get_logger()
+
+is_digest = re.compile(r'^[0-9a-f]{128}$').match
+
+# number of digests handled in each query when fixing instances
+FIX_CHUNK_SIZE = 500
+
+# number of missing and orphaned digests of each region logged individually
+MAX_REPORTED = 100
+
+
+def compact(digest):
+    return binascii.unhexlify(digest)
+
+
+def expand(compact_digest):
+    return binascii.hexlify(compact_digest)
+
+
+def digest_from_key(key_name):
+    """Return the digest of the file stored under the given key name, or None
+    if it is not the name of a file"""
+    prefix = util.keyname('')
+    if key_name.startswith(prefix) and is_digest(key_name[len(prefix):]):
+        return key_name[len(prefix):]
+
+
+def list_bucket(aws, region, bucket_name):
+    """Generate the names of the file keys in the given bucket.  Boto pages
+    through the listing, a thousand keys per request."""
+    bucket = aws.connect_to('s3', region).get_bucket(bucket_name, validate=False)
+    for key in bucket.list(prefix=util.keyname('')):
+        yield key.name
+
+
+def read_inventory(path):
+    """Generate the key names in an S3 inventory CSV file, which may be
+    gzipped.  The key is the second column of each row."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        for row in csv.reader(f):
+            if len(row) > 1:
+                yield row[1]
+
+
+def stored_digests(key_names):
+    """Return the set of compact digests of the files among the given key
+    names, ignoring any other keys"""
+    digests = set()
+    for key_name in key_names:
+        digest = digest_from_key(key_name)
+        if digest:
+            digests.add(compact(digest))
+    return digests
+
+
+def instance_digests(session, region):
+    """Return the set of compact digests of the files with an instance in
+    the given region"""
+    q = session.query(tables.File.sha512).join(tables.FileInstance)
+    q = q.filter(tables.FileInstance.region == region)
+    return set(compact(row.sha512) for row in q.yield_per(10000))
+
+
+def pending_digests(session):
+    """Return the set of compact digests of the files with pending uploads"""
+    q = session.query(tables.File.sha512).join(tables.PendingUpload)
+    return set(compact(row.sha512) for row in q)
+
+
+def reconcile_region(session, region, key_names):
+    """Compare the file instances in a region with the given key names from
+    its bucket, returning the sets of compact digests of instances missing
+    from the bucket, and of files in the bucket without an instance.  Files
+    with pending uploads are not yet expected to have an instance."""
+    # read the instances first: an instance added while the bucket is being
+    # listed refers to a key that already existed, so can't appear missing.
+    # This does not hold for an inventory file, which may predate instances.
+    in_db = instance_digests(session, region)
+    in_bucket = stored_digests(key_names)
+    missing = in_db - in_bucket
+    orphaned = in_bucket - in_db
+    orphaned -= pending_digests(session)
+    return missing, orphaned
+
+
+def _chunks(compact_digests):
+    digests = sorted(expand(c) for c in compact_digests)
+    for i in xrange(0, len(digests), FIX_CHUNK_SIZE):
+        yield digests[i:i + FIX_CHUNK_SIZE]
+
+
+def remove_missing_instances(session, region, missing):
+    """Delete the instances in the region of the given files, which are not
+    in its bucket; replication will copy them back from another region if
+    possible.  Returns the number of instances deleted."""
+    f_tbl = tables.File
+    fi_tbl = tables.FileInstance
+    deleted = 0
+    for digests in _chunks(missing):
+        file_ids = session.query(f_tbl.id).filter(f_tbl.sha512.in_(digests)).subquery()
+        q = fi_tbl.query.filter(fi_tbl.region == region, fi_tbl.file_id.in_(file_ids))
+        deleted += q.delete(synchronize_session=False)
+        session.commit()
+        for digest in digests:
+            cache.invalidate(digest)
+    return deleted
+
+
+def queue_orphaned_objects(session, region, orphaned):
+    """Add an expired pending upload for each of the given files in the
+    region's bucket which has a file row, so that it is verified, and an
+    instance added, by the next run of check_pending_uploads.  Returns the
+    number of pending uploads added."""
+    f_tbl = tables.File
+    pu_tbl = tables.PendingUpload
+    now = time.now()
+    added = 0
+    for digests in _chunks(orphaned):
+        q = session.query(f_tbl.id).outerjoin(pu_tbl)
+        q = q.filter(f_tbl.sha512.in_(digests), pu_tbl.file_id.is_(None))
+        rows = [{'file_id': row.id, 'region': region, 'expires': now} for row in q]
+        if not rows:
+            continue
+        try:
+            session.execute(pu_tbl.__table__.insert(), rows)
+            session.commit()
+        except sa.exc.IntegrityError:
+            # an upload of one of these files began meanwhile; the next run
+            # will try again
+            session.rollback()
+            continue
+        added += len(rows)
+    return added
+
+
+def _report(region, kind, compact_digests):
+    for i, c in enumerate(sorted(compact_digests)):
+        if i == MAX_REPORTED:
+            logger.warning("{}: and {} more {}".format(
+                region, len(compact_digests) - MAX_REPORTED, kind))
+            break
+        digest = expand(c)
+        logger.warning("{}: {} {}".format(region, kind, digest), tooltool_sha512=digest)
+
+
+@badpenny.periodic_task(seconds=86400)
+def reconcile_inventory(job_status):
+    """Compare each region's file instances with the contents of its bucket,
+    and fix any differences if so configured"""
+    config = current_app.config
+    session = current_app.db.session('relengapi')
+    inventory_files = config.get('TOOLTOOL_INVENTORY_FILES', {})
+    fix = config.get('TOOLTOOL_INVENTORY_FIX', False)
+
+    for region, bucket_name in sorted(config['TOOLTOOL_REGIONS'].iteritems()):
+        if region in inventory_files:
+            key_names = read_inventory(inventory_files[region])
+        else:
+            key_names = list_bucket(current_app.aws, region, bucket_name)
+        missing, orphaned = reconcile_region(session, region, key_names)
+        _report(region, "instance missing from S3:", missing)
+        _report(region, "object without an instance:", orphaned)
+        message = "{}: {} instances missing from S3, {} objects without an instance".format(
+            region, len(missing), len(orphaned))
+        if fix:
+            if region in inventory_files:
+                # an instance added after the inventory file was generated
+                # looks missing from it, so only a live listing is trusted
+                # to show that an instance is really missing
+                removed = "kept missing instances (inventory file)"
+            else:
+                removed = "deleted {} instances".format(
+                    remove_missing_instances(session, region, missing))
+            message += "; {}, queued {} objects for verification".format(
+                removed, queue_orphaned_objects(session, region, orphaned))
+        job_status.log_message(message)
@@ -0,0 +1,235 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Indexed search of tooltool files and upload batches.
+
+Substring searches use trigram tables: each file's filenames, and each
+batch's author and message, are broken into lowercased three-character
+trigrams when they are inserted.  A search first finds the rows having the
+query's trigrams, using the trigram index, and then checks only those rows for
+the substring itself.  Queries shorter than a trigram cannot use the index
+and fall back to a scan.
+
+Digest prefixes of at least eight hex characters are found with a range
+query on the unique ``sha512`` index.
+"""
+
+import re
+import sqlalchemy as sa
+import structlog
+
+from flask import current_app
+from relengapi.blueprints.tooltool import tables
+from relengapi.lib import subcommands
+from sqlalchemy import event
+from sqlalchemy import orm
+
+logger = structlog.get_logger()
+
+is_digest_prefix = re.compile(r'^[0-9a-f]{8,128}$').match
+
+# number of rows handled at a time by `reindex`
+REINDEX_CHUNK_SIZE = 1000
+
+# the most trigrams of a query used to look up candidates in the index
+MAX_QUERY_TRIGRAMS = 6
+
+
+def trigrams(text):
+    """Return the set of lowercased trigrams in the given text"""
+    text = text.lower()
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+def _contains(column, q):
+    # a substring match treating `%` and `_` in `q` literally, as the trigram
+    # index does; `!` is the escape character, since a backslash would need
+    # escaping differently in each dialect's string literals
+    q = q.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+    return column.contains(q, escape='!')
+
+
+def _matching_ids(table, id_column, q):
+    """Return a select of the ids in the given trigram table having the
+    trigrams in `q`, or None if `q` is too short to use the index.  At most
+    MAX_QUERY_TRIGRAMS trigrams are used, so the result may include ids which
+    do not actually match."""
+    grams = sorted(trigrams(q))
+    if not grams:
+        return None
+    # prefer trigrams which do not overlap, as they carry the most information
+    grams = (grams[::3] + [g for i, g in enumerate(grams) if i % 3])[:MAX_QUERY_TRIGRAMS]
+    # intersect the trigrams' postings with a self-join, each side of which
+    # is a lookup in the (trigram, id) index
+    first = table.alias()
+    sel = sa.select([first.c[id_column]]).where(first.c.trigram == grams[0])
+    for gram in grams[1:]:
+        other = table.alias()
+        sel = sel.where(sa.and_(other.c.trigram == gram,
+                                other.c[id_column] == first.c[id_column]))
+    return sel
+
+
+def search_files(session, q, limit, offset=0):
+    """Return the ids, in order, of the files with a filename containing `q`
+    or, if `q` looks like one, with a digest starting with `q`."""
+    tbl = tables.File
+    bf = tables.BatchFile
+    trigram_tbl = tables.filename_trigrams
+
+    by_filename = sa.select([bf.file_id]).where(_contains(bf.filename, q))
+    candidates = _matching_ids(trigram_tbl, 'file_id', q)
+    if candidates is not None:
+        by_filename = by_filename.where(bf.file_id.in_(candidates))
+    ids = by_filename
+
+    if is_digest_prefix(q):
+        # every digest starting with q sorts between q and q + 'g', so this
+        # is a range scan of the unique index
+        by_digest = sa.select([tbl.id]).where(sa.and_(tbl.sha512 >= q, tbl.sha512 < q + 'g'))
+        ids = sa.union(by_filename, by_digest)
+
+    query = session.query(tbl.id).filter(tbl.id.in_(ids))
+    return [row.id for row in query.order_by(tbl.id).limit(limit).offset(offset)]
+
+
+def search_batches(session, q, limit, offset=0):
+    """Return the ids, in order, of the batches with an author or message
+    containing `q`."""
+    tbl = tables.Batch
+    trigram_tbl = tables.batch_trigrams
+
+    query = session.query(tbl.id).filter(
+        sa.or_(_contains(tbl.author, q), _contains(tbl.message, q)))
+    candidates = _matching_ids(trigram_tbl, 'batch_id', q)
+    if candidates is not None:
+        query = query.filter(tbl.id.in_(candidates))
+    return [row.id for row in query.order_by(tbl.id).limit(limit).offset(offset)]
+
+
+def _index_filenames(conn, filenames, skip_existing=True):
+    # index the given {file_id: set of filenames}, skipping trigrams that
+    # are already indexed
+    if not filenames:
+        return
+    trigram_tbl = tables.filename_trigrams
+    existing = set()
+    if skip_existing:
+        existing = set((r[0], r[1]) for r in conn.execute(
+            sa.select([trigram_tbl.c.file_id, trigram_tbl.c.trigram]).where(
+                trigram_tbl.c.file_id.in_(filenames))))
+    rows = []
+    for file_id, names in filenames.iteritems():
+        grams = set()
+        for name in names:
+            grams |= trigrams(name)
+        rows.extend({'file_id': file_id, 'trigram': gram} for gram in grams
+                    if (file_id, gram) not in existing)
+    if rows:
+        conn.execute(trigram_tbl.insert(), rows)
+
+
+def _index_batches(conn, batches):
+    # index the given [(batch_id, author, message)]
+    rows = []
+    for batch_id, author, message in batches:
+        rows.extend({'batch_id': batch_id, 'trigram': gram}
+                    for gram in trigrams(author) | trigrams(message))
+    if rows:
+        conn.execute(tables.batch_trigrams.insert(), rows)
+
+
+# New batches and batch files are indexed as they are inserted, in the same
+# transaction.  The tooltool mappers' insert events collect the new rows in the
+# session, and a listener on that session (and no other) indexes them together
+# when the flush is complete.
+
+
+def _pending(target):
+    session = orm.object_session(target)
+    if not event.contains(session, 'after_flush', _index_new_rows):
+        event.listen(session, 'after_flush', _index_new_rows)
+        event.listen(session, 'after_rollback', _forget_new_rows)
+    return session.info.setdefault('tooltool_search_pending', ({}, []))
+
+
+@event.listens_for(tables.BatchFile, 'after_insert')
+def _collect_batch_file(mapper, connection, target):
+    filenames, batches = _pending(target)
+    filenames.setdefault(target.file_id, set()).add(target.filename)
+
+
+@event.listens_for(tables.Batch, 'after_insert')
+def _collect_batch(mapper, connection, target):
+    filenames, batches = _pending(target)
+    batches.append((target.id, target.author, target.message))
+
+
+def _index_new_rows(session, flush_context):
+    pending = session.info.pop('tooltool_search_pending', None)
+    if not pending:
+        return
+    filenames, batches = pending
+    conn = session.connection()
+    _index_filenames(conn, filenames)
+    _index_batches(conn, batches)
+
+
+def _forget_new_rows(session):
+    # a failed flush leaves rows collected which were never inserted
+    session.info.pop('tooltool_search_pending', None)
+
+
+def reindex(session, chunk_size=REINDEX_CHUNK_SIZE):
+    """Rebuild the trigram tables, a chunk of rows at a time.  Each chunk's
+    trigrams are deleted and re-inserted in a single transaction, so searches
+    continue to use the existing index while this runs."""
+    f_tbl = tables.File.__table__
+    bf_tbl = tables.BatchFile.__table__
+    trigram_tbl = tables.filename_trigrams
+    last_id = 0
+    while True:
+        conn = session.connection()
+        file_ids = [r[0] for r in conn.execute(
+            sa.select([f_tbl.c.id]).where(f_tbl.c.id > last_id).order_by(
+                f_tbl.c.id).limit(chunk_size))]
+        if not file_ids:
+            break
+        filenames = {}
+        for file_id, filename in conn.execute(
+                sa.select([bf_tbl.c.file_id, bf_tbl.c.filename]).where(
+                    bf_tbl.c.file_id.in_(file_ids))):
+            filenames.setdefault(file_id, set()).add(filename)
+        conn.execute(trigram_tbl.delete().where(trigram_tbl.c.file_id.in_(file_ids)))
+        _index_filenames(conn, filenames, skip_existing=False)
+        session.commit()
+        last_id = file_ids[-1]
+
+    b_tbl = tables.Batch.__table__
+    trigram_tbl = tables.batch_trigrams
+    last_id = 0
+    while True:
+        conn = session.connection()
+        batches = conn.execute(
+            sa.select([b_tbl.c.id, b_tbl.c.author, b_tbl.c.message]).where(
+                b_tbl.c.id > last_id).order_by(b_tbl.c.id).limit(chunk_size)).fetchall()
+        if not batches:
+            break
+        conn.execute(trigram_tbl.delete().where(
+            trigram_tbl.c.batch_id.in_([b[0] for b in batches])))
+        _index_batches(conn, batches)
+        session.commit()
+        last_id = batches[-1][0]
+
+
+class ReindexSubcommand(subcommands.Subcommand):
+
+    def make_parser(self, subparsers):
+        parser = subparsers.add_parser(
+            'tooltool-reindex', help='rebuild the tooltool search index')
+        return parser
+
+    def run(self, parser, args):
+        logger.info("Rebuilding the tooltool search index")
+        reindex(current_app.db.session('relengapi'))
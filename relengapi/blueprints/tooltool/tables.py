@@ -21,6 +21,9 @@ class File(db.declarative_base('relengapi')):
     size = sa.Column(sa.Integer, nullable=False)
     sha512 = sa.Column(sa.String(128), unique=True, nullable=False)
     visibility = sa.Column(sa.Enum('public', 'internal'), nullable=False)
+    # while the file is being replicated, the time after which another
+    # replicator may take over
+    replicating_until = sa.Column(db.UTCDateTime, nullable=True)
 
     instances = sa.orm.relationship('FileInstance', backref='file')
 
@@ -108,5 +111,95 @@ class PendingUpload(db.declarative_base('relengapi')):
     expires = sa.Column(db.UTCDateTime, index=True, nullable=False)
     region = sa.Column(
         sa.Enum(*allowed_regions), nullable=False)
+    # while a checker is verifying the upload, the time after which another
+    # checker may take over
+    verifying_until = sa.Column(db.UTCDateTime, nullable=True)
 
     file = sa.orm.relationship('File', backref='pending_uploads')
+
+
+class ReplicationCursor(db.declarative_base('relengapi')):
+
+    """The id of the last file handled by the periodic replication task, so
+    that a run which does not finish can be resumed by the next.  This table
+    has at most one row."""
+
+    __tablename__ = 'tooltool_replication_cursor'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    file_id = sa.Column(sa.Integer, nullable=False)
+
+
+# Trigram indexes used to search files by filename and batches by author and
+# message without scanning those tables.  These are maintained by
+# relengapi.blueprints.tooltool.search, and contain no primary key since
+# case- and accent-insensitive collations may consider distinct trigrams
+# equal.
+
+filename_trigrams = sa.Table(
+    'tooltool_filename_trigrams', db.declarative_base('relengapi').metadata,
+    sa.Column('trigram', sa.String(3), nullable=False),
+    sa.Column('file_id', sa.Integer, sa.ForeignKey('tooltool_files.id'), nullable=False),
+    sa.Index('ix_tooltool_filename_trigrams_trigram', 'trigram', 'file_id'),
+)
+
+batch_trigrams = sa.Table(
+    'tooltool_batch_trigrams', db.declarative_base('relengapi').metadata,
+    sa.Column('trigram', sa.String(3), nullable=False),
+    sa.Column('batch_id', sa.Integer, sa.ForeignKey('tooltool_batches.id'), nullable=False),
+    sa.Index('ix_tooltool_batch_trigrams_trigram', 'trigram', 'batch_id'),
+)
+
+
+# Core projections, building API types straight from result rows.  These
+# serialize any number of files or batches in a constant number of queries,
+# where the `to_json` methods lazy-load each row's relationships.
+
+def _file_columns():
+    f = File.__table__
+    fi = FileInstance.__table__
+    has_instances = sa.exists().where(fi.c.file_id == f.c.id).label('has_instances')
+    return [f.c.id, f.c.size, f.c.sha512, f.c.visibility, has_instances]
+
+
+def _file_json(row):
+    return types.File(
+        size=row.size,
+        digest=row.sha512,
+        algorithm='sha512',
+        visibility=row.visibility,
+        has_instances=bool(row.has_instances))
+
+
+def files_to_json(session, file_ids):
+    """Return a `types.File` for each of the given file ids, in order."""
+    if not file_ids:
+        return []
+    f = File.__table__
+    rows = session.execute(sa.select(_file_columns()).where(f.c.id.in_(file_ids)))
+    by_id = {row.id: _file_json(row) for row in rows}
+    return [by_id[id] for id in file_ids]
+
+
+def batches_to_json(session, batch_ids):
+    """Return a `types.UploadBatch`, including its files, for each of the
+    given batch ids, in order."""
+    if not batch_ids:
+        return []
+    b = Batch.__table__
+    bf = BatchFile.__table__
+    f = File.__table__
+    files = {id: {} for id in batch_ids}
+    sel = sa.select([bf.c.batch_id, bf.c.filename] + _file_columns()).select_from(
+        bf.join(f, bf.c.file_id == f.c.id)).where(bf.c.batch_id.in_(batch_ids))
+    for row in session.execute(sel):
+        files[row.batch_id][row.filename] = _file_json(row)
+    batches = {}
+    for row in session.execute(sa.select([b]).where(b.c.id.in_(batch_ids))):
+        batches[row.id] = types.UploadBatch(
+            id=row.id,
+            uploaded=row.uploaded,
+            author=row.author,
+            message=row.message,
+            files=files[row.id])
+    return [batches[id] for id in batch_ids]
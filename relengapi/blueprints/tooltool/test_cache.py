@@ -0,0 +1,85 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+
+from nose.tools import eq_
+from relengapi.blueprints.tooltool import cache
+from relengapi.lib.testing.context import TestContext
+
+ONE = '1\n'
+ONE_DIGEST = hashlib.sha512(ONE).hexdigest()
+
+cfg = {
+    'TOOLTOOL_REGIONS': {
+        'us-east-1': 'tt-use1',
+        'us-west-2': 'tt-usw2',
+    },
+    'TOOLTOOL_CACHE': 'mock://tooltool',
+}
+test_context = TestContext(config=cfg)
+
+
+@test_context.specialize(config={'TOOLTOOL_REGIONS': cfg['TOOLTOOL_REGIONS']})
+def test_no_config(app):
+    """With no cache configured, nothing is cached"""
+    with app.app_context():
+        eq_(cache.set_file(ONE_DIGEST, 'public', ['us-east-1']),
+            {'visibility': 'public', 'regions': ['us-east-1']})
+        eq_(cache.get_file(ONE_DIGEST), None)
+        cache.set_url(ONE_DIGEST, 'us-east-1', 'public', 'http://url', 60)
+        eq_(cache.get_url(ONE_DIGEST, 'us-east-1', 'public'), None)
+        eq_(cache.set_files({ONE_DIGEST: ('public', ['us-east-1'])}),
+            {ONE_DIGEST: {'visibility': 'public', 'regions': ['us-east-1']}})
+        eq_(cache.get_files([ONE_DIGEST]), {})
+        cache.set_urls({(ONE_DIGEST, 'us-east-1', 'public'): 'http://url'}, 60)
+        eq_(cache.get_urls([(ONE_DIGEST, 'us-east-1', 'public')]), {})
+        eq_(cache.invalidate(ONE_DIGEST), None)
+
+
+@test_context
+def test_file(app):
+    """A file's visibility and regions are cached until invalidated"""
+    with app.app_context():
+        eq_(cache.get_file(ONE_DIGEST), None)
+        cache.set_file(ONE_DIGEST, 'public', ['us-east-1'])
+        eq_(cache.get_file(ONE_DIGEST),
+            {'visibility': 'public', 'regions': ['us-east-1']})
+        cache.invalidate(ONE_DIGEST)
+        eq_(cache.get_file(ONE_DIGEST), None)
+
+
+@test_context
+def test_url(app):
+    """Signed URLs are cached by region and visibility until invalidated"""
+    with app.app_context():
+        cache.set_url(ONE_DIGEST, 'us-east-1', 'public', 'http://url', 60)
+        eq_(cache.get_url(ONE_DIGEST, 'us-east-1', 'public'), 'http://url')
+        eq_(cache.get_url(ONE_DIGEST, 'us-west-2', 'public'), None)
+        eq_(cache.get_url(ONE_DIGEST, 'us-east-1', 'internal'), None)
+        cache.invalidate(ONE_DIGEST)
+        eq_(cache.get_url(ONE_DIGEST, 'us-east-1', 'public'), None)
+
+
+@test_context
+def test_multi(app):
+    """Several files' information and URLs can be cached and fetched at once,
+    and are shared with the single-file functions"""
+    two_digest = hashlib.sha512('2\n').hexdigest()
+    with app.app_context():
+        eq_(cache.get_files([ONE_DIGEST, two_digest]), {})
+        cache.set_files({ONE_DIGEST: ('public', ['us-east-1'])})
+        cache.set_file(two_digest, 'internal', [])
+        eq_(cache.get_files([ONE_DIGEST, two_digest]), {
+            ONE_DIGEST: {'visibility': 'public', 'regions': ['us-east-1']},
+            two_digest: {'visibility': 'internal', 'regions': []},
+        })
+
+        cache.set_urls({(ONE_DIGEST, 'us-east-1', 'public'): 'http://one'}, 60)
+        cache.set_url(two_digest, 'us-west-2', 'internal', 'http://two', 60)
+        eq_(cache.get_urls([(ONE_DIGEST, 'us-east-1', 'public'),
+                            (two_digest, 'us-west-2', 'internal')]),
+            {ONE_DIGEST: 'http://one', two_digest: 'http://two'})
+        eq_(cache.get_url(ONE_DIGEST, 'us-east-1', 'public'), 'http://one')
+        eq_(cache.get_urls([(two_digest, 'us-east-1', 'internal')]), {})
@@ -13,6 +13,7 @@ from datetime import datetime
 from datetime import timedelta
 from flask import current_app
 from nose.tools import eq_
+from relengapi.blueprints.tooltool import cache
 from relengapi.blueprints.tooltool import grooming
 from relengapi.blueprints.tooltool import tables
 from relengapi.blueprints.tooltool import util
@@ -147,6 +148,106 @@ def test_verify_file_instance(app):
         assert grooming.verify_file_instance(DATA_DIGEST, len(DATA), key)
 
 
+def test_read_ranges():
+    """read_ranges reads the ranges in order, with limited read-ahead"""
+    data = os.urandom(1000)
+    fetched = []
+
+    def fetch(start, stop):
+        fetched.append(start)
+        return data[start:stop]
+    chunks = grooming.read_ranges(fetch, len(data), buffer_size=64, read_ahead=3)
+    first = next(chunks)
+    eq_(first, data[:64])
+    # at most the read-ahead ranges have been requested
+    assert set(fetched) <= set([0, 64, 128]), fetched
+    eq_(first + ''.join(chunks), data)
+    eq_(sorted(fetched), range(0, 1000, 64))
+
+
+def fake_key(content, etag='"abc"'):
+    key = mock.Mock()
+    key.size = len(content)
+    key.etag = etag
+    key.storage_class = 'STANDARD'
+    key.get_redirect.return_value = None
+    return key
+
+
+def test_verify_file_instance_chunks():
+    """verify_file_instance hashes the given chunks, if any"""
+    key = fake_key(DATA)
+    chunks = [DATA[:100], DATA[100:]]
+    assert grooming.verify_file_instance(DATA_DIGEST, len(DATA), key, chunks=chunks)
+    key.set_acl.assert_called_with('private')
+    assert not grooming.verify_file_instance(DATA_DIGEST, len(DATA), key,
+                                             chunks=[DATA[:100]])
+
+
+def test_verify_file_instance_no_digest():
+    """verify_file_instance doesn't read the contents with check_digest=False"""
+    key = fake_key(DATA)
+    assert grooming.verify_file_instance(DATA_DIGEST, len(DATA), key,
+                                         chunks=None, check_digest=False)
+    eq_(key.read.call_count, 0)
+
+
+def verify_upload_with_fake_keys(keys, **kwargs):
+    aws = mock.Mock()
+
+    def connect_to(service, region):
+        conn = mock.Mock()
+        conn.get_bucket.return_value.get_key.side_effect = lambda name: keys.get(region)
+        conn.get_bucket.return_value.new_key.return_value \
+            .get_contents_as_string.side_effect = \
+            lambda headers: _range(DATA, headers['Range'])
+        return conn
+    aws.connect_to.side_effect = connect_to
+    return grooming.verify_upload(aws, 'us-west-2', 'tt-usw2', DATA_DIGEST, len(DATA),
+                                  buffer_size=1000, **kwargs)
+
+
+def _range(data, hdr):
+    start, stop = map(int, hdr.split('=')[1].split('-'))
+    return data[start:stop + 1]
+
+
+def test_verify_upload():
+    """verify_upload reads the upload in ranges"""
+    keys = {'us-west-2': fake_key(DATA)}
+    assert verify_upload_with_fake_keys(keys)
+
+
+def test_verify_upload_missing():
+    """verify_upload returns None if the key is missing"""
+    eq_(verify_upload_with_fake_keys({}), None)
+
+
+def test_verify_upload_invalid():
+    """verify_upload deletes the key if it is invalid"""
+    keys = {'us-west-2': fake_key(DATA + 'x')}
+    assert not verify_upload_with_fake_keys(keys)
+    keys['us-west-2'].delete.assert_called_with()
+
+
+def test_verify_upload_etag_shortcut():
+    """verify_upload with etag_shortcut skips the digest check if a verified
+    instance has the same ETag and size"""
+    keys = {'us-west-2': fake_key(DATA), 'us-east-1': fake_key(DATA)}
+    with mock.patch('relengapi.blueprints.tooltool.grooming.read_ranges') as read_ranges:
+        read_ranges.return_value = ['garbage']
+        assert verify_upload_with_fake_keys(
+            keys, verified_in=[('us-east-1', 'tt-use1')], etag_shortcut=True)
+        # with a different ETag, the (garbage) content is checked
+        keys['us-east-1'].etag = '"def"'
+        assert not verify_upload_with_fake_keys(
+            keys, verified_in=[('us-east-1', 'tt-use1')], etag_shortcut=True)
+        # and without etag_shortcut, too
+        keys['us-east-1'].etag = keys['us-west-2'].etag
+        assert not verify_upload_with_fake_keys(
+            keys, verified_in=[('us-east-1', 'tt-use1')])
+
+
 @test_context
 def test_check_pending_upload_not_expired(app):
     """check_pending_upload doesn't check anything if the URL isn't expired yet"""
@@ -261,16 +362,271 @@ def test_check_pending_upload_success(app):
 
 @test_context
 def test_check_pending_uploads(app):
-    """check_pending_uploads calls check_pending_upload for each PU"""
+    """check_pending_uploads verifies each PU that check_pending_upload would
+    verify in a thread pool, then records the result"""
     with app.app_context(), set_time():
         expires = time.now() - timedelta(seconds=90)
         pu_row, file_row = add_pending_upload_and_file_row(
             len(DATA), DATA_DIGEST, expires, 'us-west-2')
-        with mock.patch('relengapi.blueprints.tooltool.grooming.check_pending_upload') as cpu:
-            pending_uploads = []
-            cpu.side_effect = lambda sess, pu: pending_uploads.append(pu)
-            grooming.check_pending_uploads(None)  # job_status is unsed
-            assert len(pending_uploads) == 1
+        args = dict(aws=app.aws, region='us-west-2', bucket_name='tt-usw2',
+                    sha512=DATA_DIGEST, size=len(DATA))
+        with mock.patch('relengapi.blueprints.tooltool.grooming.start_check') as start_check, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.verify_upload') as verify:
+            start_check.return_value = args
+            verify.return_value = True
+            job_status = mock.Mock()
+            with mock.patch('relengapi.blueprints.tooltool.grooming.replicate_new_file') as rnf:
+                grooming.check_pending_uploads(job_status)
+            verify.assert_called_with(**args)
+            # replication of the new file has begun
+            rnf.delay.assert_called_with(DATA_DIGEST)
+        eq_(tables.PendingUpload.query.all(), [])  # PU is deleted
+        eq_(len(tables.File.query.first().instances), 1)  # FileInstance exists
+        job_status.log_message.assert_called_with(
+            "1/1: {} is valid".format(DATA_DIGEST))
+
+
+@test_context
+def test_check_pending_uploads_replicate_error(app):
+    """If queueing the replication of a verified upload fails, the upload is
+    still recorded and reported as valid"""
+    with app.app_context(), set_time():
+        expires = time.now() - timedelta(seconds=90)
+        add_pending_upload_and_file_row(len(DATA), DATA_DIGEST, expires, 'us-west-2')
+        args = dict(aws=app.aws, region='us-west-2', bucket_name='tt-usw2',
+                    sha512=DATA_DIGEST, size=len(DATA))
+        with mock.patch('relengapi.blueprints.tooltool.grooming.start_check') as start_check, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.verify_upload') as verify, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.replicate_new_file') as rnf:
+            start_check.return_value = args
+            verify.return_value = True
+            rnf.delay.side_effect = IOError("broker down")
+            job_status = mock.Mock()
+            grooming.check_pending_uploads(job_status)
+        eq_(tables.PendingUpload.query.all(), [])
+        eq_(len(tables.File.query.first().instances), 1)
+        job_status.log_message.assert_called_with(
+            "1/1: {} is valid".format(DATA_DIGEST))
+
+
+@test_context
+def test_check_pending_uploads_exception(app):
+    """If verifying one upload fails with an exception, check_pending_uploads
+    logs it, unlocks the PU, and carries on"""
+    with app.app_context(), set_time():
+        expires = time.now() - timedelta(seconds=90)
+        pu_row, file_row = add_pending_upload_and_file_row(
+            len(DATA), DATA_DIGEST, expires, 'us-west-2')
+        args = dict(aws=app.aws, region='us-west-2', bucket_name='tt-usw2',
+                    sha512=DATA_DIGEST, size=len(DATA))
+
+        def start_check(session, pu):
+            assert grooming.lock_pending_upload(session, pu)
+            return args
+        with mock.patch('relengapi.blueprints.tooltool.grooming.start_check', start_check), \
+                mock.patch('relengapi.blueprints.tooltool.grooming.verify_upload') as verify:
+            verify.side_effect = RuntimeError('oh noes')
+            job_status = mock.Mock()
+            grooming.check_pending_uploads(job_status)
+        pu = tables.PendingUpload.query.first()
+        eq_(pu.verifying_until, None)
+        eq_(tables.File.query.first().instances, [])
+        job_status.log_message.assert_called_with(
+            "1/1: error verifying {}".format(DATA_DIGEST))
+
+
+@test_context
+def test_check_pending_uploads_finish_error(app):
+    """If recording the result for one upload fails, check_pending_uploads
+    unlocks that upload and goes on to record the rest of the chunk"""
+    with app.app_context(), set_time():
+        now = time.now()
+        file_ids = add_pending_uploads(app, [now - timedelta(seconds=90)] * 3)
+
+        def start_check(session, pu):
+            assert grooming.lock_pending_upload(session, pu)
+            return dict(region=pu.region, sha512=pu.file.sha512)
+
+        def finish_check(session, pu, valid, region):
+            if pu.file_id == file_ids[1]:
+                raise RuntimeError('oh noes')
+            session.delete(pu)
+            session.commit()
+        with mock.patch('relengapi.blueprints.tooltool.grooming.start_check', start_check), \
+                mock.patch('relengapi.blueprints.tooltool.grooming.finish_check', finish_check), \
+                mock.patch('relengapi.blueprints.tooltool.grooming.verify_upload') as verify:
+            verify.return_value = True
+            job_status = mock.Mock()
+            grooming.check_pending_uploads(job_status)
+        pus = tables.PendingUpload.query.all()
+        eq_([(pu.file_id, pu.verifying_until) for pu in pus], [(file_ids[1], None)])
+        messages = [c[1][0] for c in job_status.log_message.mock_calls]
+        assert "2/3: error verifying {}".format(hashlib.sha512('1').hexdigest()) in messages
+        assert "3/3: {} is valid".format(hashlib.sha512('2').hexdigest()) in messages
+
+
+@test_context
+def test_check_pending_uploads_start_error(app):
+    """If starting the check of one upload fails, check_pending_uploads goes
+    on to check the rest of the chunk"""
+    with app.app_context(), set_time():
+        now = time.now()
+        file_ids = add_pending_uploads(app, [now - timedelta(seconds=90)] * 2)
+
+        def start_check(session, pu):
+            if pu.file_id == file_ids[0]:
+                raise RuntimeError('S3 is down')
+            return dict(region=pu.region)
+        with mock.patch('relengapi.blueprints.tooltool.grooming.start_check', start_check), \
+                mock.patch('relengapi.blueprints.tooltool.grooming.finish_check') as finish, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.verify_upload') as verify:
+            verify.return_value = True
+            job_status = mock.Mock()
+            grooming.check_pending_uploads(job_status)
+        eq_([c[1][1].file_id for c in finish.mock_calls], [file_ids[1]])
+        job_status.log_message.assert_any_call(
+            "error checking {}".format(hashlib.sha512('0').hexdigest()))
+
+
+@test_context
+def test_check_pending_upload_finish_error(app):
+    """If recording the result of check_pending_upload fails, the pending
+    upload is unlocked and the error raised"""
+    with app.app_context(), set_time():
+        file_ids = add_pending_uploads(app, [time.now() - timedelta(seconds=90)])
+        session = app.db.session('relengapi')
+        pu = tables.PendingUpload.query.first()
+
+        def start_check(session, pu):
+            assert grooming.lock_pending_upload(session, pu)
+            return dict(region=pu.region)
+        with mock.patch('relengapi.blueprints.tooltool.grooming.start_check', start_check), \
+                mock.patch('relengapi.blueprints.tooltool.grooming.finish_check') as finish, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.verify_upload'):
+            finish.side_effect = RuntimeError('oh noes')
+            try:
+                grooming.check_pending_upload(session, pu)
+            except RuntimeError:
+                pass
+            else:
+                assert False, "error not raised"
+        pu = tables.PendingUpload.query.first()
+        eq_((pu.file_id, pu.verifying_until), (file_ids[0], None))
+
+
+def add_pending_uploads(app, expires_list, locked=[]):
+    """Add a pending upload expiring at each of the given times, returning
+    their file ids; those at the indexes in `locked` are being verified."""
+    session = app.db.session('relengapi')
+    file_ids = []
+    for i, expires in enumerate(expires_list):
+        pu_row, file_row = add_pending_upload_and_file_row(
+            i, hashlib.sha512(str(i)).hexdigest(), expires, 'us-west-2')
+        if i in locked:
+            assert grooming.lock_pending_upload(session, pu_row)
+        file_ids.append(file_row.id)
+    return file_ids
+
+
+@test_context
+def test_verifiable_uploads(app):
+    """verifiable_uploads pages through the unlocked pending uploads which
+    expired within the completion window, in order by expiration"""
+    with app.app_context(), set_time():
+        now = time.now()
+        file_ids = add_pending_uploads(app, [
+            now + timedelta(seconds=10),  # not expired yet
+            now - timedelta(seconds=30),
+            now - timedelta(seconds=90),
+            now - timedelta(seconds=90),
+            now - timedelta(hours=2),  # being verified
+            now - timedelta(days=2),  # abandoned
+        ], locked=[4])
+        session = app.db.session('relengapi')
+        with mock.patch('relengapi.blueprints.tooltool.grooming.VERIFY_CHUNK_SIZE', 2):
+            first = grooming.verifiable_uploads(session)
+            eq_([pu.file_id for pu in first], [file_ids[2], file_ids[3]])
+            after = (first[-1].expires, first[-1].file_id)
+            second = grooming.verifiable_uploads(session, after)
+            eq_([pu.file_id for pu in second], [file_ids[1]])
+            after = (second[-1].expires, second[-1].file_id)
+            eq_(grooming.verifiable_uploads(session, after), [])
+
+
+@test_context
+def test_check_pending_uploads_chunks(app):
+    """check_pending_uploads purges abandoned uploads in bulk, then checks
+    the verifiable uploads a chunk at a time"""
+    with app.app_context(), set_time():
+        now = time.now()
+        file_ids = add_pending_uploads(app, [
+            now + timedelta(seconds=10),
+            now - timedelta(seconds=90),
+            now - timedelta(seconds=80),
+            now - timedelta(seconds=70),
+            now - timedelta(days=2),
+            now - timedelta(days=3),
+            now - timedelta(days=3),  # being verified
+        ], locked=[6])
+        job_status = mock.Mock()
+        with mock.patch('relengapi.blueprints.tooltool.grooming.start_check') as start_check, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.VERIFY_CHUNK_SIZE', 2):
+            start_check.return_value = None
+            grooming.check_pending_uploads(job_status)
+            eq_([c[1][1].file_id for c in start_check.mock_calls], file_ids[1:4])
+        job_status.log_message.assert_called_once_with(
+            "deleted 2 abandoned pending uploads")
+        eq_(sorted(pu.file_id for pu in tables.PendingUpload.query.all()),
+            file_ids[:4] + file_ids[6:])
+
+
+@test_context.specialize(config={'TOOLTOOL_VERIFY_TIME_LIMIT': 0})
+def test_check_pending_uploads_time_limit(app):
+    """check_pending_uploads stops starting new chunks when its time is up"""
+    with app.app_context(), set_time():
+        add_pending_uploads(app, [time.now() - timedelta(seconds=90)])
+        job_status = mock.Mock()
+        with mock.patch('relengapi.blueprints.tooltool.grooming.start_check') as start_check:
+            grooming.check_pending_uploads(job_status)
+            eq_(start_check.mock_calls, [])
+        job_status.log_message.assert_called_with(
+            "time limit reached; leaving the remaining uploads for the next run")
+
+
+@test_context
+def test_lock_pending_upload(app):
+    """A pending upload can only be locked once at a time, until the lock
+    expires or is released"""
+    with app.app_context():
+        expires = time.now() - timedelta(seconds=90)
+        pu_row, file_row = add_pending_upload_and_file_row(
+            len(DATA), DATA_DIGEST, expires, 'us-west-2')
+        session = app.db.session('relengapi')
+        assert grooming.lock_pending_upload(session, pu_row)
+        assert not grooming.lock_pending_upload(session, pu_row)
+        grooming.unlock_pending_upload(session, pu_row)
+        assert grooming.lock_pending_upload(session, pu_row)
+        later = time.now() + grooming.VERIFY_LOCK_DURATION + timedelta(seconds=1)
+        with mock.patch('relengapi.lib.time.now', return_value=later):
+            assert grooming.lock_pending_upload(session, pu_row)
+
+
+@moto.mock_s3
+@test_context
+def test_check_pending_upload_locked(app):
+    """check_pending_upload leaves a PU alone if it is already being verified"""
+    with app.app_context(), set_time():
+        expires = time.now() - timedelta(seconds=90)
+        pu_row, file_row = add_pending_upload_and_file_row(
+            len(DATA), DATA_DIGEST, expires, 'us-west-2')
+        make_key(app, 'us-west-2', 'tt-usw2', DATA_KEY, DATA)
+        session = app.db.session('relengapi')
+        assert grooming.lock_pending_upload(session, pu_row)
+        grooming.check_pending_upload(session, pu_row)
+        session.commit()
+        # PU has not been deleted, nor a FileInstance added
+        assert tables.PendingUpload.query.first().file.sha512 == DATA_DIGEST
+        eq_(tables.File.query.first().instances, [])
 
 
 @test_context
@@ -287,26 +643,165 @@ def test_check_file_pending_uploads(app):
             assert len(pending_uploads) == 1
 
 
+def add_replication_files(app):
+    regions = sorted(cfg['TOOLTOOL_REGIONS'])
+    files = []
+    for i in range(0, len(regions) + 1):
+        data = os.urandom((i + 1) * 1024)
+        data_digest = hashlib.sha512(data).hexdigest()
+        files.append((add_file_row(len(data),
+                                   data_digest,
+                                   instances=regions[:i]),
+                      0 < i < len(regions)))
+    return files
+
+
 @test_context
 def test_replicate(app):
     """The periodic replication only tries to replicate files with at least one
-    but not a full set of instances."""
+    but not a full set of instances, adds instances for them, and logs its
+    backlog and progress."""
+    with app.app_context():
+        files = add_replication_files(app)
+        job_status = mock.Mock()
+        with mock.patch('relengapi.blueprints.tooltool.grooming.copy_instance') as copy:
+            grooming.replicate(job_status)
+        replicated_keys = [call[1][1] for call in copy.mock_calls]
+        exp_replicated_keys = [
+            util.keyname(file.sha512) for file, should_replicate in files if should_replicate]
+        eq_(replicated_keys, exp_replicated_keys)
+        for file, should_replicate in files:
+            if should_replicate:
+                assert_file_instances(app, file.sha512, ['us-east-1', 'us-west-2'])
+        eq_(grooming.load_replication_cursor(app.db.session('relengapi')), 0)
+        messages = [c[1][0] for c in job_status.log_message.mock_calls]
+        eq_(messages[0], "1 files need replication; files missing per region: "
+                         "us-east-1: 0, us-west-2: 1")
+        assert messages[-1].startswith("made 1 copies (2048 bytes)"), messages
+
+
+@test_context
+def test_replicate_resume(app):
+    """The periodic replication resumes after the file where the last run left
+    off, then wraps around."""
+    with app.app_context():
+        files = [add_file_row(i + 1, hashlib.sha512(str(i)).hexdigest(),
+                              instances=['us-east-1'])
+                 for i in range(5)]
+        session = app.db.session('relengapi')
+        grooming.save_replication_cursor(session, files[2].id)
+        with mock.patch('relengapi.blueprints.tooltool.grooming.copy_instance') as copy, \
+                mock.patch('relengapi.blueprints.tooltool.grooming.REPLICATION_CHUNK_SIZE', 2):
+            grooming.replicate(mock.Mock())
+        replicated_keys = [call[1][1] for call in copy.mock_calls]
+        eq_(replicated_keys, [util.keyname(files[i].sha512) for i in [3, 4, 0, 1, 2]])
+        eq_(grooming.load_replication_cursor(session), 0)
+
+
+@test_context.specialize(config=dict(cfg, TOOLTOOL_REPLICATION_TIME_LIMIT=0))
+def test_replicate_time_limit(app):
+    """The periodic replication stops when its time is up, leaving the cursor
+    in place."""
+    with app.app_context():
+        add_replication_files(app)
+        session = app.db.session('relengapi')
+        grooming.save_replication_cursor(session, 1)
+        job_status = mock.Mock()
+        with mock.patch('relengapi.blueprints.tooltool.grooming.copy_instance') as copy:
+            grooming.replicate(job_status)
+        eq_(copy.mock_calls, [])
+        eq_(grooming.load_replication_cursor(session), 1)
+        job_status.log_message.assert_any_call("time limit reached; stopping after file id 1")
+
+
+@test_context
+def test_replicate_error(app):
+    """If one copy fails, the periodic replication carries on with the rest"""
+    with app.app_context():
+        files = [add_file_row(i + 1, hashlib.sha512(str(i)).hexdigest(),
+                              instances=['us-east-1'])
+                 for i in range(2)]
+        with mock.patch('relengapi.blueprints.tooltool.grooming.copy_instance') as copy:
+            # copies run concurrently, so fail based on the key, not call order
+            bad_key = util.keyname(files[0].sha512)
+
+            def copy_instance(aws, key_name, *args):
+                if key_name == bad_key:
+                    raise RuntimeError('uhoh')
+            copy.side_effect = copy_instance
+            grooming.replicate(mock.Mock())
+        assert_file_instances(app, files[0].sha512, ['us-east-1'])
+        assert_file_instances(app, files[1].sha512, ['us-east-1', 'us-west-2'])
+
+
+@test_context
+def test_replicate_skips_locked(app):
+    """The periodic replication skips files that are already being replicated"""
+    with app.app_context():
+        files = [add_file_row(i + 1, hashlib.sha512(str(i)).hexdigest(),
+                              instances=['us-east-1'])
+                 for i in range(2)]
+        session = app.db.session('relengapi')
+        assert grooming.lock_file_for_replication(session, files[0].id)
+        session.commit()
+        with mock.patch('relengapi.blueprints.tooltool.grooming.copy_instance') as copy:
+            grooming.replicate(mock.Mock())
+        eq_([call[1][1] for call in copy.mock_calls], [util.keyname(files[1].sha512)])
+        # the lock on the skipped file is left alone, but the other is released
+        assert not grooming.lock_file_for_replication(session, files[0].id)
+        assert grooming.lock_file_for_replication(session, files[1].id)
+
+
+@test_context
+def test_replicate_new_file(app):
+    """replicate_new_file replicates the file immediately, and releases its lock"""
+    with app.app_context():
+        file_id = add_file_row(len(DATA), DATA_DIGEST, instances=['us-east-1']).id
+        with mock.patch('relengapi.blueprints.tooltool.grooming.copy_instance') as copy:
+            grooming.replicate_new_file(DATA_DIGEST)
+        copy.assert_called_with(app.aws, DATA_KEY, 'tt-use1', 'us-west-2', 'tt-usw2')
+        assert_file_instances(app, DATA_DIGEST, ['us-east-1', 'us-west-2'])
+        session = app.db.session('relengapi')
+        assert grooming.lock_file_for_replication(session, file_id)
+
+
+@test_context.specialize(config=dict(cfg, TOOLTOOL_CACHE='mock://tooltool'))
+def test_replicate_invalidates_cache(app):
+    """Replicating a file invalidates the download cache for it"""
     with app.app_context():
-        regions = sorted(cfg['TOOLTOOL_REGIONS'])
-        files = []
-        for i in range(0, len(regions) + 1):
-            data = os.urandom((i + 1) * 1024)
-            data_digest = hashlib.sha512(data).hexdigest()
-            files.append((add_file_row(len(data),
-                                       data_digest,
-                                       instances=regions[:i]),
-                          0 < i < len(regions)))
-        with mock.patch('relengapi.blueprints.tooltool.grooming.replicate_file') as rep_file:
-            grooming.replicate(None)
-        replicated_files = [call[1][1] for call in rep_file.mock_calls]
-        exp_replicated_files = [
-            file for file, should_replicate in files if should_replicate]
-        eq_(replicated_files, exp_replicated_files)
+        add_file_row(len(DATA), DATA_DIGEST, instances=['us-east-1'])
+        cache.set_file(DATA_DIGEST, 'public', ['us-east-1'])
+        with mock.patch('relengapi.blueprints.tooltool.grooming.copy_instance'):
+            grooming.replicate_new_file(DATA_DIGEST)
+        eq_(cache.get_file(DATA_DIGEST), None)
+
+
+@test_context
+def test_replicate_new_file_locked(app):
+    """replicate_new_file does nothing if the file is already being replicated"""
+    with app.app_context():
+        file = add_file_row(len(DATA), DATA_DIGEST, instances=['us-east-1'])
+        session = app.db.session('relengapi')
+        assert grooming.lock_file_for_replication(session, file.id)
+        session.commit()
+        with mock.patch('relengapi.blueprints.tooltool.grooming.copy_instance') as copy:
+            grooming.replicate_new_file(DATA_DIGEST)
+        eq_(copy.mock_calls, [])
+        assert_file_instances(app, DATA_DIGEST, ['us-east-1'])
+
+
+def test_plan_replication_nearest():
+    """plan_replication copies from the nearest region containing the file"""
+    regions = {'us-east-1': 'tt-use1', 'us-west-1': 'tt-usw1', 'us-west-2': 'tt-usw2'}
+    file = tables.File(sha512=DATA_DIGEST, size=len(DATA))
+    file.instances = [tables.FileInstance(region='us-east-1'),
+                      tables.FileInstance(region='us-west-2')]
+    with mock.patch('relengapi.blueprints.tooltool.grooming.current_app') as app:
+        app.config = {'TOOLTOOL_REGIONS': regions}
+        eq_(grooming.plan_replication(file), [('us-west-2', 'us-west-1')])
+        file.instances = [tables.FileInstance(region='us-east-1')]
+        eq_(grooming.plan_replication(file), [('us-east-1', 'us-west-1'),
+                                              ('us-east-1', 'us-west-2')])
 
 
 @test_context
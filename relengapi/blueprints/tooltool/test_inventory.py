@@ -0,0 +1,191 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gzip
+import hashlib
+import mock
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_
+from relengapi.blueprints.tooltool import inventory
+from relengapi.blueprints.tooltool import tables
+from relengapi.blueprints.tooltool import util
+from relengapi.lib import time
+from relengapi.lib.testing.context import TestContext
+
+cfg = {
+    'TOOLTOOL_REGIONS': {
+        'us-east-1': 'tt-use1',
+        'us-west-2': 'tt-usw2',
+    },
+}
+test_context = TestContext(config=cfg, databases=['relengapi'])
+
+DIGESTS = dict((name, hashlib.sha512(name).hexdigest())
+               for name in ['ok', 'missing', 'orphan', 'pending', 'unknown'])
+
+
+def add_files(app):
+    """Add files to the DB: 'ok' and 'missing' have instances in us-east-1,
+    'orphan' has none, and 'pending' has a pending upload"""
+    with app.app_context():
+        session = app.db.session('relengapi')
+        for name in 'ok', 'missing', 'orphan', 'pending':
+            file = tables.File(size=len(name), visibility='public', sha512=DIGESTS[name])
+            session.add(file)
+            if name in ('ok', 'missing'):
+                session.add(tables.FileInstance(file=file, region='us-east-1'))
+            if name == 'pending':
+                session.add(tables.PendingUpload(
+                    file=file, region='us-east-1', expires=time.now()))
+        session.commit()
+
+
+def bucket_keys(region):
+    """The keys in each region's bucket: 'missing' is missing from us-east-1,
+    while 'orphan', 'pending' and 'unknown' have no instance there"""
+    if region != 'us-east-1':
+        return []
+    return [util.keyname(DIGESTS[name]) for name in ('ok', 'orphan', 'pending', 'unknown')] + [
+        util.keyname('junk'), 'README']
+
+
+def reconcile(app):
+    job_status = mock.Mock()
+    with mock.patch('relengapi.blueprints.tooltool.inventory.list_bucket') as list_bucket:
+        list_bucket.side_effect = lambda aws, region, bucket: bucket_keys(region)
+        with app.app_context():
+            inventory.reconcile_inventory(job_status)
+    return [c[1][0] for c in job_status.log_message.mock_calls]
+
+
+def instances(app):
+    with app.app_context():
+        return sorted((i.file.sha512, i.region) for i in tables.FileInstance.query.all())
+
+
+def pending_uploads(app):
+    with app.app_context():
+        return sorted((pu.file.sha512, pu.region) for pu in tables.PendingUpload.query.all())
+
+
+def test_digest_from_key():
+    """Only keys naming a digest in the sha512 prefix are files"""
+    eq_(inventory.digest_from_key(util.keyname(DIGESTS['ok'])), DIGESTS['ok'])
+    eq_(inventory.digest_from_key(util.keyname('abc')), None)
+    eq_(inventory.digest_from_key(DIGESTS['ok']), None)
+
+
+def test_compact():
+    """Compact digests are half the size and expand to the original"""
+    c = inventory.compact(DIGESTS['ok'])
+    eq_(len(c), 64)
+    eq_(inventory.expand(c), DIGESTS['ok'])
+
+
+def test_list_bucket():
+    """list_bucket lists the keys with the sha512 prefix"""
+    aws = mock.Mock()
+    bucket = aws.connect_to.return_value.get_bucket.return_value
+    bucket.list.return_value = [mock.Mock(), mock.Mock()]
+    bucket.list.return_value[0].name = 'sha512/a'
+    bucket.list.return_value[1].name = 'sha512/b'
+    eq_(list(inventory.list_bucket(aws, 'us-east-1', 'tt-use1')), ['sha512/a', 'sha512/b'])
+    aws.connect_to.assert_called_with('s3', 'us-east-1')
+    bucket.list.assert_called_with(prefix='sha512/')
+
+
+def test_read_inventory():
+    """read_inventory reads the keys from plain and gzipped inventory files"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        content = '"tt-use1","sha512/a","10"\n"tt-use1","sha512/b","20"\n\n'
+        plain = os.path.join(tmpdir, 'inventory.csv')
+        with open(plain, 'w') as f:
+            f.write(content)
+        gzipped = os.path.join(tmpdir, 'inventory.csv.gz')
+        with gzip.open(gzipped, 'w') as f:
+            f.write(content)
+        eq_(list(inventory.read_inventory(plain)), ['sha512/a', 'sha512/b'])
+        eq_(list(inventory.read_inventory(gzipped)), ['sha512/a', 'sha512/b'])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@test_context
+def test_reconcile_region(app):
+    """reconcile_region finds instances missing from the bucket and files in
+    the bucket without an instance or pending upload"""
+    add_files(app)
+    with app.app_context():
+        session = app.db.session('relengapi')
+        missing, orphaned = inventory.reconcile_region(
+            session, 'us-east-1', bucket_keys('us-east-1'))
+    eq_(sorted(inventory.expand(c) for c in missing), [DIGESTS['missing']])
+    eq_(sorted(inventory.expand(c) for c in orphaned),
+        sorted([DIGESTS['orphan'], DIGESTS['unknown']]))
+
+
+@test_context
+def test_reconcile_inventory_report(app):
+    """By default, reconcile_inventory only reports the differences"""
+    add_files(app)
+    before = instances(app), pending_uploads(app)
+    eq_(reconcile(app), [
+        "us-east-1: 1 instances missing from S3, 2 objects without an instance",
+        "us-west-2: 0 instances missing from S3, 0 objects without an instance",
+    ])
+    eq_((instances(app), pending_uploads(app)), before)
+
+
+@test_context.specialize(config=dict(cfg, TOOLTOOL_INVENTORY_FIX=True))
+def test_reconcile_inventory_fix(app):
+    """With TOOLTOOL_INVENTORY_FIX, reconcile_inventory deletes missing
+    instances and queues known files without an instance for verification"""
+    add_files(app)
+    eq_(reconcile(app), [
+        "us-east-1: 1 instances missing from S3, 2 objects without an instance; "
+        "deleted 1 instances, queued 1 objects for verification",
+        "us-west-2: 0 instances missing from S3, 0 objects without an instance; "
+        "deleted 0 instances, queued 0 objects for verification",
+    ])
+    eq_(instances(app), [(DIGESTS['ok'], 'us-east-1')])
+    eq_(pending_uploads(app), sorted([(DIGESTS['orphan'], 'us-east-1'),
+                                      (DIGESTS['pending'], 'us-east-1')]))
+    # the queued upload is verified by the next check_pending_uploads run
+    with app.app_context():
+        file = tables.File.query.filter(tables.File.sha512 == DIGESTS['orphan']).first()
+        assert file.pending_uploads[0].expires <= time.now()
+
+
+@test_context.specialize(
+    config=dict(cfg, TOOLTOOL_INVENTORY_FILES={'us-east-1': '/inv.csv.gz'}))
+def test_reconcile_inventory_file(app):
+    """A region with an inventory file is reconciled against that file rather
+    than a listing of its bucket"""
+    add_files(app)
+    with mock.patch('relengapi.blueprints.tooltool.inventory.read_inventory') as read_inventory:
+        read_inventory.return_value = [util.keyname(DIGESTS[n]) for n in ('ok', 'missing')]
+        log = reconcile(app)
+    read_inventory.assert_called_with('/inv.csv.gz')
+    eq_(log[0], "us-east-1: 0 instances missing from S3, 0 objects without an instance")
+
+
+@test_context.specialize(
+    config=dict(cfg, TOOLTOOL_INVENTORY_FIX=True,
+                TOOLTOOL_INVENTORY_FILES={'us-east-1': '/inv.csv.gz'}))
+def test_reconcile_inventory_file_fix(app):
+    """Instances are never deleted based on an inventory file, which may
+    have been generated before a file was uploaded"""
+    add_files(app)
+    with mock.patch('relengapi.blueprints.tooltool.inventory.read_inventory') as read_inventory:
+        # 'missing' was uploaded after this inventory was generated
+        read_inventory.return_value = [util.keyname(DIGESTS['ok'])]
+        log = reconcile(app)
+    eq_(log[0], "us-east-1: 1 instances missing from S3, 0 objects without an instance; "
+        "kept missing instances (inventory file), queued 0 objects for verification")
+    eq_(instances(app), sorted([(DIGESTS['ok'], 'us-east-1'),
+                                (DIGESTS['missing'], 'us-east-1')]))
@@ -0,0 +1,212 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import mock
+import sqlalchemy as sa
+
+from nose.tools import eq_
+from relengapi.blueprints.tooltool import search
+from relengapi.blueprints.tooltool import tables
+from relengapi.lib import time
+from relengapi.lib.testing.context import TestContext
+from relengapi.lib.testing.subcommands import run_main
+from sqlalchemy import event
+from sqlalchemy import orm
+
+test_context = TestContext(databases=['relengapi'])
+
+
+def add_batch(app, author, message, filenames):
+    with app.app_context():
+        session = app.db.session('relengapi')
+        batch = tables.Batch(author=author, message=message, uploaded=time.now())
+        session.add(batch)
+        for filename, content in filenames.iteritems():
+            digest = hashlib.sha512(content).hexdigest()
+            file = tables.File.query.filter(tables.File.sha512 == digest).first()
+            if not file:
+                file = tables.File(size=len(content), visibility='public', sha512=digest)
+            session.add(tables.BatchFile(filename=filename, batch=batch, file=file))
+        session.commit()
+
+
+def add_batches(app):
+    add_batch(app, 'dustin@mozilla.com', 'Update GCC to 4.9', {
+        'gcc-4.9.tar.xz': 'gcc',
+        'setup.sh': 'setup',
+    })
+    add_batch(app, 'catlee@mozilla.com', 'Add clang', {
+        'clang.tar.bz2': 'clang',
+        'setup.sh': 'setup',
+    })
+
+
+def filenames(file_ids):
+    files = tables.File.query.filter(tables.File.id.in_(file_ids)) if file_ids else []
+    return sorted(bf.filename for f in files for bf in f._batches)
+
+
+def trigram_rows(app, table):
+    with app.app_context():
+        return sorted(tuple(r) for r in app.db.session('relengapi').execute(sa.select([table])))
+
+
+def test_trigrams():
+    """Trigrams are lowercased and unique"""
+    eq_(search.trigrams(u'ABab'), set([u'aba', u'bab']))
+    eq_(search.trigrams(u'aaaa'), set([u'aaa']))
+    eq_(search.trigrams(u'ab'), set())
+
+
+@test_context
+def test_index_on_insert(app):
+    """Inserting batches and batch files indexes them, without indexing a
+    file's trigrams twice"""
+    add_batches(app)
+    with app.app_context():
+        setup = tables.File.query.filter(
+            tables.File.sha512 == hashlib.sha512('setup').hexdigest()).first()
+        rows = [r for r in trigram_rows(app, tables.filename_trigrams) if r[1] == setup.id]
+    eq_(sorted(r[0] for r in rows), sorted(search.trigrams(u'setup.sh')))
+    batch_grams = set(r[0] for r in trigram_rows(app, tables.batch_trigrams) if r[1] == 2)
+    eq_(batch_grams, search.trigrams(u'catlee@mozilla.com') | search.trigrams(u'Add clang'))
+
+
+@test_context
+def test_index_listener_scope(app):
+    """Only sessions which insert batches listen for their flushes"""
+    with app.app_context():
+        session = app.db.session('relengapi')
+        tables.File.query.all()
+        session.commit()
+        assert not event.contains(orm.Session, 'after_flush', search._index_new_rows)
+        assert not event.contains(session(), 'after_flush', search._index_new_rows)
+        add_batch(app, 'me@mozilla.com', 'Add make', {'make.tar.gz': 'make'})
+        assert event.contains(session(), 'after_flush', search._index_new_rows)
+
+
+@test_context
+def test_search_files(app):
+    """Files are found by filename substrings, with or without the index"""
+    add_batches(app)
+    with app.app_context():
+        session = app.db.session('relengapi')
+        for q, exp in [
+            ('TAR', ['clang.tar.bz2', 'gcc-4.9.tar.xz']),
+            ('4.9', ['gcc-4.9.tar.xz']),
+            ('.sh', ['setup.sh', 'setup.sh']),
+            ('z', ['clang.tar.bz2', 'gcc-4.9.tar.xz']),
+            ('tar.gz', []),
+        ]:
+            eq_(filenames(search.search_files(session, q, 100)), exp, q)
+
+
+@test_context
+def test_search_wildcards(app):
+    """`_` and `%` in a query match only themselves"""
+    add_batches(app)
+    add_batch(app, 'me_too@mozilla.com', '100% new', {'gcc_4.9.tar.xz': 'gcc_'})
+    with app.app_context():
+        session = app.db.session('relengapi')
+        for q, exp in [
+            ('gcc_4', ['gcc_4.9.tar.xz']),
+            ('c_', ['gcc_4.9.tar.xz']),
+            ('_', ['gcc_4.9.tar.xz']),
+            ('g%', []),
+            ('!', []),
+        ]:
+            eq_(filenames(search.search_files(session, q, 100)), exp, q)
+        for q, exp in [('e_t', [3]), ('0% n', [3]), ('%', [3]), ('m_', []), ('%n', [])]:
+            eq_(search.search_batches(session, q, 100), exp, q)
+
+
+@test_context
+def test_search_files_digest(app):
+    """Files are found by digest prefixes of at least 8 characters"""
+    add_batches(app)
+    digest = hashlib.sha512('clang').hexdigest()
+    with app.app_context():
+        session = app.db.session('relengapi')
+        clang_id = tables.File.query.filter(tables.File.sha512 == digest).first().id
+        eq_(search.search_files(session, digest[:8], 100), [clang_id])
+        eq_(search.search_files(session, digest, 100), [clang_id])
+        eq_(search.search_files(session, digest[:7], 100), [])
+
+
+@test_context
+def test_search_files_pagination(app):
+    """File search results are ordered by id and paginated"""
+    add_batches(app)
+    with app.app_context():
+        session = app.db.session('relengapi')
+        all_ids = search.search_files(session, '', 100)
+        eq_(all_ids, sorted(all_ids))
+        eq_(len(all_ids), 3)
+        eq_(search.search_files(session, '', 2), all_ids[:2])
+        eq_(search.search_files(session, '', 2, 2), all_ids[2:])
+
+
+@test_context
+def test_search_batches(app):
+    """Batches are found by author and message substrings, and paginated"""
+    add_batches(app)
+    with app.app_context():
+        session = app.db.session('relengapi')
+        for q, limit, offset, exp in [
+            ('mozilla.com', 100, 0, [1, 2]),
+            ('CLANG', 100, 0, [2]),
+            ('dd', 100, 0, [2]),
+            ('mozilla.com', 1, 1, [2]),
+            ('nope', 100, 0, []),
+        ]:
+            eq_(search.search_batches(session, q, limit, offset), exp, q)
+
+
+@test_context
+def test_reindex(app):
+    """reindex rebuilds the trigram tables from scratch"""
+    add_batches(app)
+    files_before = trigram_rows(app, tables.filename_trigrams)
+    batches_before = trigram_rows(app, tables.batch_trigrams)
+    with app.app_context():
+        session = app.db.session('relengapi')
+        session.execute(tables.filename_trigrams.delete())
+        session.execute(tables.batch_trigrams.insert(), [{'trigram': 'xyz', 'batch_id': 1}])
+        session.commit()
+        search.reindex(session, chunk_size=1)
+    eq_(trigram_rows(app, tables.filename_trigrams), files_before)
+    eq_(trigram_rows(app, tables.batch_trigrams), batches_before)
+
+
+@test_context
+def test_reindex_keeps_index(app):
+    """reindex only replaces one chunk's trigrams at a time, so the rest of
+    the index remains usable"""
+    add_batches(app)
+    all_ids = set(r[1] for r in trigram_rows(app, tables.filename_trigrams))
+    real_index_filenames = search._index_filenames
+    missing = []
+
+    def index_filenames(conn, filenames, skip_existing=True):
+        indexed = set(r[0] for r in conn.execute(
+            sa.select([tables.filename_trigrams.c.file_id])))
+        missing.append(all_ids - indexed)
+        real_index_filenames(conn, filenames, skip_existing)
+
+    with app.app_context():
+        with mock.patch('relengapi.blueprints.tooltool.search._index_filenames',
+                        side_effect=index_filenames):
+            search.reindex(app.db.session('relengapi'), chunk_size=1)
+    eq_(len(missing), 3)
+    for id, m in zip(sorted(all_ids), missing):
+        eq_(m, set([id]))
+
+
+def test_reindex_subcommand():
+    """`relengapi tooltool-reindex` rebuilds the search index"""
+    with mock.patch('relengapi.blueprints.tooltool.search.reindex') as reindex:
+        run_main(['tooltool-reindex'],
+                 settings={'SQLALCHEMY_DATABASE_URIS': {'relengapi': 'sqlite://'}})
+    eq_(len(reindex.mock_calls), 1)
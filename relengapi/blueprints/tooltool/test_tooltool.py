@@ -9,18 +9,21 @@ import json
 import mock
 import moto
 import pytz
+import sqlalchemy as sa
 import time
 import urlparse
 
 from contextlib import contextmanager
 from nose.tools import eq_
 from relengapi.blueprints import tooltool
+from relengapi.blueprints.tooltool import grooming
 from relengapi.blueprints.tooltool import tables
 from relengapi.blueprints.tooltool import util
 from relengapi.lib import auth
 from relengapi.lib import time as relengapi_time
 from relengapi.lib.permissions import p
 from relengapi.lib.testing.context import TestContext
+from relengapi.lib.testing.queries import assert_max_queries
 
 
 def userperms(perms, email='me'):
@@ -45,6 +48,9 @@ test_context = TestContext(config=cfg, databases=['relengapi'],
 allow_anon_cfg = cfg.copy()
 allow_anon_cfg['TOOLTOOL_ALLOW_ANONYMOUS_PUBLIC_DOWNLOAD'] = True
 
+cache_cfg = cfg.copy()
+cache_cfg['TOOLTOOL_CACHE'] = 'mock://tooltool'
+
 ONE = '1\n'
 ONE_DIGEST = hashlib.sha512(ONE).hexdigest()
 TWO = '22\n'
@@ -412,6 +418,38 @@ def test_upload_batch_success_existing_pending_upload(client, app):
             app, result['id'], files=[('one', len(ONE), ONE_DIGEST, [])])
 
 
+@moto.mock_s3
+@test_context
+def test_upload_batch_during_verification(client, app):
+    """A POST to /upload for a file whose upload is being verified extends the
+    pending upload without unlocking it, and the pending upload is kept when
+    the verification finishes, to be verified again after the new URL
+    expires."""
+    with set_time(NOW - 120):
+        add_file_to_db(app, ONE, regions=[], pending_regions=['us-east-1'])
+    with set_time(), app.app_context():
+        session = app.db.session('relengapi')
+        assert grooming.lock_pending_upload(session, tables.PendingUpload.query.first())
+        locked_until = tables.PendingUpload.query.first().verifying_until
+
+        with not_so_random_choice():
+            resp = upload_batch(client, mkbatch())
+        eq_(resp.status_code, 200, resp.data)
+        # the request ended with a new session
+        session = app.db.session('relengapi')
+        pu = tables.PendingUpload.query.first()
+        eq_(pu.verifying_until, locked_until)
+        eq_(pu.expires, relengapi_time.now() + datetime.timedelta(seconds=60))
+
+        # a second verification can't start, and the first one finishes
+        assert not grooming.lock_pending_upload(session, pu)
+        with mock.patch('relengapi.blueprints.tooltool.grooming.replicate_new_file'):
+            grooming.finish_check(session, pu, True, pu.region)
+        pu = tables.PendingUpload.query.first()
+        eq_(pu.verifying_until, None)
+        eq_([i.region for i in tables.File.query.first().instances], ['us-east-1'])
+
+
 @moto.mock_s3
 @test_context
 def test_upload_batch_success_no_instances(client, app):
@@ -478,6 +516,54 @@ def test_upload_batch_success_some_existing_files(client, app):
     assert_pending_upload(app, TWO_DIGEST, 'us-west-2')
 
 
+@moto.mock_s3
+@test_context
+def test_upload_batch_success_many_files(client, app):
+    """A POST to /upload with many files, some new and some awaiting upload,
+    uses a constant number of queries, inserts the new files, and replaces
+    any existing pending uploads."""
+    contents = ['{}\n'.format(i) for i in range(20)]
+    batch = mkbatch()
+    batch['files'] = {
+        'f{}'.format(i): {
+            'algorithm': 'sha512',
+            'size': len(c),
+            'digest': hashlib.sha512(c).hexdigest(),
+            'visibility': 'public',
+        } for i, c in enumerate(contents)}
+    with set_time(NOW - 30):
+        for c in contents[:5]:
+            add_file_to_db(app, c, regions=[], pending_regions=['us-east-1'])
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    with app.app_context():
+        engine = app.db.engine('relengapi')
+    sa.event.listen(engine, 'before_cursor_execute', count)
+    try:
+        with set_time():
+            resp = upload_batch(client, batch, region='us-west-2')
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute', count)
+    result = assert_batch_response(resp, files={
+        'f{}'.format(i): {'digest': hashlib.sha512(c).hexdigest()}
+        for i, c in enumerate(contents)})
+    # the number of statements does not depend on the number of files
+    assert len(statements) < 15, statements
+
+    assert_batch_row(app, result['id'], files=[
+        ('f{}'.format(i), len(c), hashlib.sha512(c).hexdigest(), [])
+        for i, c in enumerate(contents)])
+    with app.app_context():
+        pus = tables.PendingUpload.query.all()
+        eq_(len(pus), len(contents))
+        eq_(set(pu.region for pu in pus), set(['us-west-2']))
+        eq_(set(pu.expires for pu in pus), set([
+            datetime.datetime.fromtimestamp(NOW + 60, pytz.UTC)]))
+
+
 @test_context
 def test_upload_change_visibility(client, app):
     """Uploading a file that already exists with a different visibility level
@@ -631,6 +717,129 @@ def test_download_file_exists_region_choice(app, client):
         assert_signed_302(resp, ONE_DIGEST, region='us-west-2')
 
 
+@moto.mock_s3
+@test_context.specialize(config=cache_cfg)
+def test_download_file_cached(app, client):
+    """With TOOLTOOL_CACHE set, repeated downloads of a file are served from
+    the cache, reusing the same signed URL, until the cache is invalidated."""
+    add_file_to_db(app, ONE, regions=['us-east-1'])
+    with set_time():
+        resp = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+        assert_signed_302(resp, ONE_DIGEST, region='us-east-1')
+    with app.app_context():
+        # remove the file from the DB behind the cache's back
+        tables.FileInstance.query.delete()
+        app.db.session('relengapi').commit()
+    with set_time(NOW + 5):
+        resp2 = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+    eq_(resp2.status_code, 302)
+    eq_(resp2.headers['Location'], resp.headers['Location'])
+    with app.app_context():
+        tooltool.cache.invalidate(ONE_DIGEST)
+    resp = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+    eq_(resp.status_code, 404)
+
+
+@moto.mock_s3
+@test_context.specialize(config=cache_cfg,
+                         user=userperms([p.tooltool.download.public, p.tooltool.manage]))
+def test_download_file_cache_invalidated_by_patch(app, client):
+    """Changing a file's visibility invalidates the download cache."""
+    add_file_to_db(app, ONE, regions=['us-east-1'], visibility='public')
+    resp = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+    eq_(resp.status_code, 302)
+    resp = do_patch(client, 'sha512', ONE_DIGEST,
+                    [{'op': 'set_visibility', 'visibility': 'internal'}])
+    eq_(resp.status_code, 200)
+    resp = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+    eq_(resp.status_code, 403)
+
+
+@moto.mock_s3
+@test_context
+def test_resolve(app, client):
+    """POSTing a list of digests to /resolve returns a signed URL or a status
+    for each, preferring the given region."""
+    three_digest = hashlib.sha512('333\n').hexdigest()
+    add_file_to_db(app, ONE, regions=['us-west-2', 'us-east-1'])
+    add_file_to_db(app, TWO, visibility='internal')
+    with set_time():
+        resp = client.post_json('/tooltool/resolve?region=us-west-2',
+                                data=[ONE_DIGEST, TWO_DIGEST, three_digest])
+        eq_(resp.status_code, 200)
+        result = json.loads(resp.data)['result']
+        eq_(sorted(result), sorted([ONE_DIGEST, TWO_DIGEST, three_digest]))
+        eq_(result[ONE_DIGEST]['status'], 200)
+        assert_signed_url(result[ONE_DIGEST]['get_url'], ONE_DIGEST, region='us-west-2')
+        eq_(result[TWO_DIGEST], {'digest': TWO_DIGEST, 'status': 403})
+        eq_(result[three_digest], {'digest': three_digest, 'status': 404})
+
+
+@moto.mock_s3
+@test_context.specialize(config=cache_cfg)
+def test_resolve_cached(app, client):
+    """With TOOLTOOL_CACHE set, /resolve uses the same cached file information
+    and signed URLs as downloads do"""
+    add_file_to_db(app, ONE, regions=['us-east-1'])
+    add_file_to_db(app, TWO, regions=['us-east-1'])
+    with set_time():
+        resp = client.get('/tooltool/sha512/{}'.format(ONE_DIGEST))
+        assert_signed_302(resp, ONE_DIGEST, region='us-east-1')
+        result = json.loads(client.post_json(
+            '/tooltool/resolve', data=[ONE_DIGEST, TWO_DIGEST]).data)['result']
+    eq_(result[ONE_DIGEST]['get_url'], resp.headers['Location'])
+    with app.app_context():
+        # remove the files from the DB behind the cache's back
+        tables.FileInstance.query.delete()
+        app.db.session('relengapi').commit()
+    with set_time(NOW + 5), \
+            mock.patch.object(app.aws, 'generate_s3_urls') as generate_s3_urls:
+        result2 = json.loads(client.post_json(
+            '/tooltool/resolve', data=[ONE_DIGEST, TWO_DIGEST]).data)['result']
+    eq_(result2, result)
+    eq_(generate_s3_urls.mock_calls, [])
+    with app.app_context():
+        tooltool.cache.invalidate(TWO_DIGEST)
+    result = json.loads(client.post_json(
+        '/tooltool/resolve', data=[TWO_DIGEST]).data)['result']
+    eq_(result[TWO_DIGEST]['status'], 404)
+
+
+@moto.mock_s3
+@test_context
+def test_resolve_no_instances(app, client):
+    """A file with no instances resolves to a 404"""
+    add_file_to_db(app, ONE, regions=[])
+    resp = client.post_json('/tooltool/resolve', data=[ONE_DIGEST])
+    eq_(json.loads(resp.data)['result'][ONE_DIGEST]['status'], 404)
+
+
+@moto.mock_s3
+@test_context
+def test_resolve_empty(app, client):
+    """Resolving an empty list of digests returns an empty result"""
+    resp = client.post_json('/tooltool/resolve', data=[])
+    eq_(resp.status_code, 200)
+    eq_(json.loads(resp.data)['result'], {})
+
+
+@moto.mock_s3
+@test_context
+def test_resolve_invalid_digest(app, client):
+    """Resolving an invalid digest returns 400"""
+    resp = client.post_json('/tooltool/resolve', data=[ONE_DIGEST, 'abcd'])
+    eq_(resp.status_code, 400)
+
+
+@moto.mock_s3
+@test_context
+def test_resolve_too_many(app, client):
+    """Resolving too many digests at once returns 400"""
+    with mock.patch('relengapi.blueprints.tooltool.MAX_RESOLVE_FILES', 1):
+        resp = client.post_json('/tooltool/resolve', data=[ONE_DIGEST, TWO_DIGEST])
+    eq_(resp.status_code, 400)
+
+
 @moto.mock_s3
 @test_context
 def test_search_batches(app, client):
@@ -775,6 +984,76 @@ def test_get_files(app, client):
         eq_(sorted(json.loads(resp.data)['result']), sorted(exp_files))
 
 
+@test_context
+def test_get_files_pagination(app, client):
+    """GETs to /file?q=.. accept limit and offset, and reject bad values."""
+    f1 = add_file_to_db(app, ONE)
+    f2 = add_file_to_db(app, TWO)
+    add_batch_to_db(app, 'me@me.com', 'a batch', {'one': f1, 'two': f2})
+    resp = client.get('/tooltool/file?q=&limit=1&offset=1')
+    eq_(resp.status_code, 200)
+    eq_([f['digest'] for f in json.loads(resp.data)['result']], [TWO_DIGEST])
+    for args in ['limit=0', 'limit=1001', 'offset=-1']:
+        resp = client.get('/tooltool/file?q=&' + args)
+        eq_(resp.status_code, 400, args)
+        resp = client.get('/tooltool/upload?q=&' + args)
+        eq_(resp.status_code, 400, args)
+
+
+def add_many_batches(app, num_batches, files_per_batch):
+    # every other file has an instance
+    for i in range(num_batches * files_per_batch):
+        add_file_to_db(app, str(i), regions=['us-east-1'] if i % 2 else [])
+    with app.app_context():
+        files = tables.File.query.order_by(tables.File.id).all()
+    for b in range(num_batches):
+        add_batch_to_db(app, 'me@me.com', 'batch {}'.format(b), {
+            'file{}'.format(i): files[b * files_per_batch + i]
+            for i in range(files_per_batch)})
+
+
+@test_context
+def test_search_batches_query_count(app, client):
+    """Searching batches takes a constant number of queries, however many
+    batches and files are returned."""
+    add_many_batches(app, 10, 5)
+    with assert_max_queries(app.db.engine('relengapi'), 3):
+        resp = client.get('/tooltool/upload?q=batch')
+    result = json.loads(resp.data)['result']
+    eq_(len(result), 10)
+    eq_(sorted(f['has_instances'] for f in result[0]['files'].itervalues()),
+        [False, False, False, True, True])
+
+
+@test_context
+def test_search_files_query_count(app, client):
+    """Searching files takes a constant number of queries, however many files
+    are returned."""
+    add_many_batches(app, 10, 5)
+    with assert_max_queries(app.db.engine('relengapi'), 2):
+        resp = client.get('/tooltool/file?q=file')
+    eq_(len(json.loads(resp.data)['result']), 50)
+
+
+@test_context
+def test_get_batch_query_count(app, client):
+    """Getting a batch takes a constant number of queries, however many files
+    it has."""
+    add_many_batches(app, 1, 20)
+    with assert_max_queries(app.db.engine('relengapi'), 3):
+        resp = client.get('/tooltool/upload/1')
+    eq_(len(json.loads(resp.data)['result']['files']), 20)
+
+
+@test_context
+def test_get_file_query_count(app, client):
+    """Getting a file, with its instances, takes one query"""
+    add_file_to_db(app, ONE, regions=['us-east-1', 'us-west-2'])
+    with assert_max_queries(app.db.engine('relengapi'), 1):
+        resp = client.get('/tooltool/file/sha512/{}'.format(ONE_DIGEST))
+    eq_(sorted(json.loads(resp.data)['result']['instances']), ['us-east-1', 'us-west-2'])
+
+
 @test_context
 def test_get_file_bad_algo(client):
     """A GET to /file/<algo>/<digest> with an unknown algorithm fails with 404"""
@@ -68,3 +68,20 @@ class UploadBatch(wsme.types.Base):
     #: filenames containing path separators (``\`` and ``/``) will be rejected the
     #: tooltool client.
     files = wsme.types.wsattr({unicode: File}, mandatory=True)
+
+
+class ResolvedFile(wsme.types.Base):
+
+    """The result of resolving a single file with ``POST /tooltool/resolve``."""
+
+    #: The sha512 digest of the file contents
+    digest = unicode
+
+    #: An HTTP status code for this file: 200 if it can be downloaded, 403 if
+    #: the user does not have permission to download it, or 404 if it does
+    #: not exist or has no instances.
+    status = int
+
+    #: The URL from which this file can be downloaded via HTTP GET, present
+    #: only when the status is 200
+    get_url = wsme.types.wsattr(unicode, mandatory=False)
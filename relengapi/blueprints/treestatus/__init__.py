@@ -2,25 +2,34 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import flask
+import datetime
+import functools
 import json
 import logging
 import sqlalchemy as sa
 
 from contextlib import contextmanager
 from flask import Blueprint
+from flask import Response
 from flask import current_app
+from flask import request
+from flask import stream_with_context
 from flask import url_for
 from flask.ext.login import current_user
+from relengapi import util
 from relengapi.lib import angular
 from relengapi.lib import api
 from relengapi.lib import http
 from relengapi.lib import time as relengapi_time
 from relengapi.lib.api import apimethod
+from sqlalchemy import event
+from sqlalchemy import orm
+from sqlalchemy.orm import scoping
 from werkzeug.exceptions import BadRequest
 from werkzeug.exceptions import NotFound
 from wsme import Unset
 
+from relengapi.blueprints.treestatus import events
 from relengapi.blueprints.treestatus import model
 from relengapi.blueprints.treestatus import types
 from relengapi.lib.permissions import p
@@ -34,6 +43,22 @@ p.treestatus.admin.doc('Administrate treestatus (add, delete, modify trees)')
 
 log = logging.getLogger(__name__)
 TREE_SUMMARY_LOG_LIMIT = 5
+# the most log entries or changes returned at once, and the number of changes
+# included in the index page (the rest are fetched a page at a time)
+MAX_PAGE_SIZE = 1000
+STACK_PAGE_SIZE = 20
+# the cache key for the names of all trees; this is longer than the 32
+# characters allowed in a tree name, so it cannot collide with a tree's key
+TREE_NAMES_CACHE_KEY = 'treestatus:names-of-all-the-trees'
+# how long cached trees are kept, in seconds; changes invalidate them, but a
+# reader may cache a tree's old state as it is being changed
+TREE_CACHE_TTL = 60
+# default duration of an event stream, after which the client reconnects, and
+# the interval between keepalive comments in the stream, in seconds
+DEFAULT_EVENTS_STREAM_DURATION = 300
+EVENTS_HEARTBEAT_INTERVAL = 15
+# how long clients wait before reconnecting, in milliseconds
+EVENTS_RETRY_MS = 2000
 public_data = http.response_headers(
     ('cache-control', 'no-cache'),
     ('access-control-allow-origin', '*'))
@@ -47,29 +72,40 @@ def update_tree_status(session, tree, status=None, reason=None,
                        tags=[], message_of_the_day=None):
     """Update the given tree's status; note that this does not commit
     the session.  Supply a tree object or name."""
-    if status is not None:
-        tree.status = status
-    if reason is not None:
-        tree.reason = reason
-    if message_of_the_day is not None:
-        tree.message_of_the_day = message_of_the_day
+    update_trees_status(session, [tree], status=status, reason=reason,
+                        tags=tags, message_of_the_day=message_of_the_day)
+
+
+def update_trees_status(session, trees, status=None, reason=None,
+                        tags=[], message_of_the_day=None):
+    """Update the status of the given tree objects in bulk, logging the
+    change for all of them with one statement; note that this does not
+    commit the session."""
+    for tree in trees:
+        if status is not None:
+            tree.status = status
+        if reason is not None:
+            tree.reason = reason
+        if message_of_the_day is not None:
+            tree.message_of_the_day = message_of_the_day
 
     # log it if the reason or status have changed
-    if status or reason:
+    if trees and (status or reason):
         if status is None:
             status = 'no change'
         if reason is None:
             reason = 'no change'
-        l = model.DbLog(
-            tree=tree.tree,
+        log = dict(
             when=relengapi_time.now(),
             who=str(current_user),
             status=status,
             reason=reason,
-            tags=tags)
-        session.add(l)
+            tags=json.dumps(tags))
+        session.execute(model.DbLog.__table__.insert(),
+                        [dict(log, tree=tree.tree) for tree in trees])
 
-    tree_cache_invalidate(tree.tree)
+    tree_cache_invalidate_after_commit(session, [tree.tree for tree in trees])
+    events.changed(session)
 
 
 @contextmanager
@@ -82,22 +118,32 @@ def _get_mc():
             yield mc
 
 
-def tree_cache_get(tree):
+def tree_cache_get_json(tree):
+    """Return the cached JSON text for the given tree, or None"""
     with _get_mc() as mc:
         if not mc:
             return None
         data = mc.get(tree.encode('utf-8'))
         if not data:
             return
-        return api.loads(types.JsonTree, data.decode('utf-8'))
+        return data.decode('utf-8')
 
 
-def tree_cache_set(tree, data):
+def tree_cache_set_json(tree, j):
     with _get_mc() as mc:
         if not mc:
             return None
-        j = api.dumps(types.JsonTree, data)
-        mc.set(tree.encode('utf-8'), j.encode('utf-8'))
+        mc.set(tree.encode('utf-8'), j.encode('utf-8'), time=TREE_CACHE_TTL)
+
+
+def tree_cache_get(tree):
+    j = tree_cache_get_json(tree)
+    if j:
+        return api.loads(types.JsonTree, j)
+
+
+def tree_cache_set(tree, data):
+    tree_cache_set_json(tree, api.dumps(types.JsonTree, data))
 
 
 def tree_cache_invalidate(tree):
@@ -107,12 +153,141 @@ def tree_cache_invalidate(tree):
         mc.delete(tree.encode('utf-8'))
 
 
+def tree_cache_invalidate_multi(trees):
+    with _get_mc() as mc:
+        if not mc:
+            return None
+        mc.delete_multi([t.encode('utf-8') for t in trees])
+
+
+def tree_cache_invalidate_after_commit(session, trees):
+    """Invalidate the given trees when the session is committed, so that a
+    reader cannot cache their state from before the commit after they are
+    invalidated"""
+    if isinstance(session, scoping.scoped_session):
+        session = session()
+    session.info.setdefault('treestatus_stale_trees', set()).update(trees)
+    if not event.contains(session, 'after_commit', _invalidate_stale_trees):
+        event.listen(session, 'after_commit', _invalidate_stale_trees)
+        event.listen(session, 'after_rollback', _forget_stale_trees)
+
+
+def _invalidate_stale_trees(session):
+    trees = session.info.pop('treestatus_stale_trees', None)
+    if trees:
+        tree_cache_invalidate_multi(sorted(trees))
+
+
+def _forget_stale_trees(session):
+    session.info.pop('treestatus_stale_trees', None)
+
+
+def tree_cache_get_multi_json(trees):
+    """Return a dictionary of the cached JSON text of the trees among those
+    named"""
+    with _get_mc() as mc:
+        if not mc:
+            return {}
+        data = mc.get_multi([t.encode('utf-8') for t in trees])
+        return {k.decode('utf-8'): v.decode('utf-8') for k, v in data.iteritems() if v}
+
+
+def tree_cache_set_multi_json(trees):
+    """Cache the given dictionary of JSON text, keyed by tree name"""
+    with _get_mc() as mc:
+        if not mc:
+            return None
+        mc.set_multi({k.encode('utf-8'): v.encode('utf-8') for k, v in trees.iteritems()},
+                     time=TREE_CACHE_TTL)
+
+
+def tree_names_cache_get():
+    with _get_mc() as mc:
+        if not mc:
+            return None
+        data = mc.get(TREE_NAMES_CACHE_KEY)
+        if data is None:
+            return
+        return json.loads(data)
+
+
+def tree_names_cache_set(names):
+    with _get_mc() as mc:
+        if not mc:
+            return None
+        mc.set(TREE_NAMES_CACHE_KEY, json.dumps(sorted(names)), time=TREE_CACHE_TTL)
+
+
+def tree_names_cache_invalidate():
+    with _get_mc() as mc:
+        if not mc:
+            return None
+        mc.delete(TREE_NAMES_CACHE_KEY)
+
+
+def tree_json(tree):
+    """Return the JSON text for the given tree, from the cache if possible,
+    or None if there is no such tree"""
+    j = tree_cache_get_json(tree)
+    if j:
+        return j
+    t = current_app.db.session('relengapi').query(model.DbTree).get(tree)
+    if not t:
+        return None
+    j = api.dumps(types.JsonTree, t.to_json())
+    tree_cache_set_json(tree, j)
+    return j
+
+
+def trees_json():
+    """Return the JSON text for the dictionary of all trees, from the cache
+    if possible"""
+    # the names of the trees are cached separately from the trees themselves,
+    # so changing a tree's status only invalidates that tree
+    session = current_app.db.session('relengapi')
+    names = tree_names_cache_get()
+    if names is None:
+        trees = {t.tree: api.dumps(types.JsonTree, t.to_json())
+                 for t in session.query(model.DbTree)}
+        tree_names_cache_set(trees)
+        tree_cache_set_multi_json(trees)
+    else:
+        trees = tree_cache_get_multi_json(names)
+        missing = [n for n in names if n not in trees]
+        if missing:
+            q = session.query(model.DbTree).filter(model.DbTree.tree.in_(missing))
+            fetched = {t.tree: api.dumps(types.JsonTree, t.to_json()) for t in q}
+            tree_cache_set_multi_json(fetched)
+            trees.update(fetched)
+    # assemble the dictionary from the trees' JSON, rather than parsing it
+    return u'{%s}' % u', '.join(u'%s: %s' % (json.dumps(name), trees[name])
+                                for name in sorted(trees))
+
+
+def cached_json(get_json):
+    """Decorator for an API method returning the data in the JSON text
+    given by `get_json`, called with the same arguments.  Unless the method is
+    called for its data or from a browser, the JSON is served directly, with
+    an ETag, bypassing WSME."""
+    def wrap(wrapped):
+        @functools.wraps(wrapped)
+        def replacement(*args, **kwargs):
+            if '_data_only_' in kwargs or util.is_browser():
+                return wrapped(*args, **kwargs)
+            j = get_json(*args, **kwargs)
+            if j is None:
+                raise NotFound("No such tree")
+            return api.json_response(j)
+        return replacement
+    return wrap
+
+
 @bp.route('/')
 def index():
     return angular.template('index.html',
                             url_for('.static', filename='treestatus.js'),
                             url_for('.static', filename='treestatus.css'),
-                            stack=api.get_data(get_stack),
+                            stack=api.get_data(get_stack, limit=STACK_PAGE_SIZE),
                             trees=api.get_data(get_trees))
 
 
@@ -127,15 +302,17 @@ def show_tree_details(tree):
 
 @bp.route('/trees')
 @public_data
+@cached_json(trees_json)
 @apimethod({unicode: types.JsonTree})
 def get_trees():
     """
     Get the status of all trees.
+
+    Like the single-tree endpoint, this is cached and is safe to call
+    frequently.  Responses have an ETag, so pollers can make conditional
+    requests.
     """
-    trees = {}
-    for t in current_app.db.session('relengapi').query(model.DbTree):
-        trees[t.tree] = t.to_json()
-    return trees
+    return api.loads({unicode: types.JsonTree}, trees_json())
 
 
 @bp.route('/v0/trees')
@@ -146,31 +323,25 @@ def v0_get_trees():
     Get the status of all trees in a format compatible with the old
     treestatus
     """
-    trees = api.get_data(get_trees)
-    resp = flask.Response(api.dumps({unicode: types.JsonTree}, trees))
-    resp.headers['content-type'] = 'application/json'
-    return resp
+    return api.json_response(trees_json(), wrap=False)
 
 
 @bp.route('/trees/<path:tree>')
 @public_data
+@cached_json(tree_json)
 @apimethod(types.JsonTree, unicode)
 def get_tree(tree):
     """
     Get the status of a single tree.
 
     This endpoint is cached heavily and is safe to call frequently to verify
-    the status of a tree.
+    the status of a tree.  Responses have an ETag, so pollers can make
+    conditional requests.
     """
-    r = tree_cache_get(tree)
-    if r:
-        return r
-    t = current_app.db.session('relengapi').query(model.DbTree).get(tree)
-    if not t:
+    j = tree_json(tree)
+    if j is None:
         raise NotFound("No such tree")
-    j = t.to_json()
-    tree_cache_set(tree, j)
-    return j
+    return api.loads(types.JsonTree, j)
 
 
 @bp.route('/v0/trees/<path:tree>')
@@ -180,10 +351,10 @@ def v0_get_tree(tree):
     Get the status of a single tree in a format compatible with the old
     treestatus
     """
-    tree = api.get_data(get_tree, tree)
-    resp = flask.Response(api.dumps(types.JsonTree, tree))
-    resp.headers['content-type'] = 'application/json'
-    return resp
+    j = tree_json(tree)
+    if j is None:
+        raise NotFound("No such tree")
+    return api.json_response(j, wrap=False)
 
 
 @bp.route('/trees/<path:tree_name>', methods=['PUT'])
@@ -204,6 +375,7 @@ def make_tree(tree_name, body):
         session.commit()
     except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
         raise BadRequest("tree already exists")
+    tree_names_cache_invalidate()
     return None, 204
 
 
@@ -222,41 +394,101 @@ def kill_tree(tree):
     model.DbStatusChangeTree.query.filter_by(tree=tree).delete()
     session.commit()
     tree_cache_invalidate(tree)
+    tree_names_cache_invalidate()
     return None, 204
 
 
+def paginate(query, tbl, before_id, since, until, limit):
+    """Limit a query for `tbl`, which has `id` and `when` columns, to a page
+    of `limit` rows (or all rows, if `limit` is None), newest first,
+    optionally with `when` in [since, until) and starting after the row with
+    id `before_id`.  Rows are ordered by (when, id), so paging by id works
+    even though ids are not in the order of `when`."""
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        raise BadRequest("limit must be between 1 and %d" % MAX_PAGE_SIZE)
+    if before_id is not None:
+        session = current_app.db.session('relengapi')
+        before = session.query(tbl.when).filter(tbl.id == before_id).scalar()
+        if before is None:
+            # an empty page would look like the end of the history
+            raise BadRequest("no entry with id %d" % before_id)
+        query = query.filter(sa.or_(
+            tbl.when < before,
+            sa.and_(tbl.when == before, tbl.id < before_id)))
+    if since is not None:
+        query = query.filter(tbl.when >= since)
+    if until is not None:
+        query = query.filter(tbl.when < until)
+    query = query.order_by(tbl.when.desc(), tbl.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
 @bp.route('/trees/<path:tree>/logs')
 @public_data
-@apimethod([types.JsonTreeLog], unicode, int)
-def get_logs(tree, all=0):
+@apimethod([types.JsonTreeLog], unicode, int, int, int, datetime.datetime, datetime.datetime)
+def get_logs(tree, all=0, before_id=None, limit=None, since=None, until=None):
     """
-    Get a log of changes for the given tree.  This is limited to the most recent
-    5 entries by default.  Use `?all=1` to get all log entries.
+    Get a log of changes for the given tree, newest first.  This is limited
+    to the most recent 5 entries by default.  Use `?all=1` to get all
+    entries, or `?limit=N` to get up to 1000.
+
+    To get the next page, give the id of the last entry of this one as
+    `?before_id=`.  Use `?since=` and `?until=` to get the entries made in a
+    range of times (inclusive and exclusive, respectively).
     """
     # verify the tree exists first
     t = current_app.db.session('relengapi').query(model.DbTree).get(tree)
     if not t:
         raise NotFound("No such tree")
 
-    logs = []
+    if limit is None and not all:
+        limit = TREE_SUMMARY_LOG_LIMIT
     q = current_app.db.session('relengapi').query(
         model.DbLog).filter_by(tree=tree)
-    q = q.order_by(model.DbLog.when.desc())
-    if not all:
-        q = q.limit(TREE_SUMMARY_LOG_LIMIT)
+    q = paginate(q, model.DbLog, before_id, since, until, limit)
+    return [l.to_json() for l in q]
 
-    logs = [l.to_json() for l in q]
-    return logs
+
+@bp.route('/events')
+@public_data
+def get_events():
+    """
+    Stream changes to tree status as Server-Sent Events.  See the
+    documentation for details.
+    """
+    session = current_app.db.session('relengapi')
+    last_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    if last_id is None:
+        position = events.latest_position(session)
+    else:
+        try:
+            position = events.parse_position(session, last_id)
+        except ValueError:
+            raise BadRequest("invalid last event id")
+    duration = current_app.config.get('TREESTATUS_EVENTS_STREAM_DURATION',
+                                      DEFAULT_EVENTS_STREAM_DURATION)
+    body = events.stream(position, request.args.getlist('tree'), duration,
+                         EVENTS_HEARTBEAT_INTERVAL, EVENTS_RETRY_MS)
+    return Response(stream_with_context(body), mimetype='text/event-stream')
 
 
 @bp.route('/stack', methods=['GET'])
-@apimethod([types.JsonStateChange])
-def get_stack():
+@apimethod([types.JsonStateChange], int, int, datetime.datetime, datetime.datetime)
+def get_stack(before_id=None, limit=None, since=None, until=None):
     """
-    Get the "undo stack" of changes to trees, most recent first.
+    Get the "undo stack" of changes to trees, most recent first.  This is
+    limited to 1000 changes, or to `?limit=N`.  As for tree logs, use
+    `?before_id=` to get the next page, and `?since=` and `?until=` to limit
+    the changes to a range of times.
     """
     tbl = model.DbStatusChange
-    return [ch.to_json() for ch in tbl.query.order_by(tbl.when.desc())]
+    q = tbl.query.options(orm.subqueryload(tbl.trees))
+    if limit is None:
+        limit = MAX_PAGE_SIZE
+    q = paginate(q, tbl, before_id, since, until, limit)
+    return [ch.to_json() for ch in q]
 
 
 @bp.route('/stack/<int:id>', methods=['DELETE'])
@@ -311,8 +543,9 @@ def update_trees(body):
     The `tags` property must not be empty if `status` is `closed`.
     """
     session = current_app.db.session('relengapi')
-    trees = [session.query(model.DbTree).get(t) for t in body.trees]
-    if not all(trees):
+    q = session.query(model.DbTree).filter(model.DbTree.tree.in_(body.trees))
+    trees = q.all()
+    if len(trees) != len(set(body.trees)):
         raise NotFound("one or more trees not found")
 
     if body.status == 'closed' and not body.tags:
@@ -327,13 +560,15 @@ def update_trees(body):
             reason=body.reason,
             when=relengapi_time.now(),
             status=body.status)
-        for tree in trees:
-            stt = model.DbStatusChangeTree(
-                tree=tree.tree,
-                last_state=json.dumps(
-                    {'status': tree.status, 'reason': tree.reason}))
-            ch.trees.append(stt)
         session.add(ch)
+        # flush to get the change's id, then add its trees all at once
+        session.flush()
+        if trees:
+            session.execute(model.DbStatusChangeTree.__table__.insert(), [
+                dict(stack_id=ch.id,
+                     tree=tree.tree,
+                     last_state=json.dumps({'status': tree.status, 'reason': tree.reason}))
+                for tree in trees])
 
     # update the trees as requested
     def unset_to_none(x):
@@ -343,12 +578,16 @@ def update_trees(body):
     new_motd = unset_to_none(body.message_of_the_day)
     new_tags = unset_to_none(body.tags) or []
 
-    for tree in trees:
-        update_tree_status(session, tree,
-                           status=new_status,
-                           reason=new_reason,
-                           message_of_the_day=new_motd,
-                           tags=new_tags)
+    update_trees_status(session, trees,
+                        status=new_status,
+                        reason=new_reason,
+                        message_of_the_day=new_motd,
+                        tags=new_tags)
 
     session.commit()
     return None, 204
+
+
+@bp.record
+def init_blueprint(state):
+    events.init_app(state.app)
@@ -0,0 +1,279 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Tree status change events.
+
+Every change to a tree's status or reason is logged in ``DbLog``, and the log
+entry ids serve as event ids, so the log itself is the event history and
+clients can resume from any event.  Publishing an event only announces that there
+is something new: each process has a `Broker` which wakes the requests waiting
+for events, and they read the new log entries from the database.
+
+The broker hears directly about changes committed in its own process.  To hear
+about changes in other processes, it watches a fan-out backend, configured with
+``TREESTATUS_EVENTS``; the default, ``local``, does no fan-out at all.
+"""
+
+import sqlalchemy as sa
+import structlog
+import threading
+import time
+
+from flask import current_app
+from relengapi.blueprints.treestatus import model
+from relengapi.blueprints.treestatus import types
+from relengapi.lib import api
+from sqlalchemy import event
+from sqlalchemy.orm import scoping
+
+logger = structlog.get_logger()
+
+# how often a process checks a shared backend for changes made in other
+# processes, in seconds
+POLL_INTERVAL = 1
+
+# the most events read from the database at once
+EVENTS_CHUNK_SIZE = 100
+
+# how far below the highest id sent to look for log entries committed late
+EVENTS_REORDER_WINDOW = 100
+
+
+class Broker(object):
+
+    """Announce new events to the threads of this process waiting for them"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.generation = 0
+        self._cond = threading.Condition()
+        self._watcher = None
+        self._watcher_lock = threading.Lock()
+
+    def publish(self):
+        """Announce a new event, here and to other processes"""
+        self.notify()
+        try:
+            self.backend.publish()
+        except Exception:
+            # other processes' clients will see the event when they next
+            # check the database
+            logger.exception("while publishing a tree status event")
+
+    def notify(self):
+        with self._cond:
+            self.generation += 1
+            self._cond.notify_all()
+
+    def wait(self, generation, timeout):
+        """Wait for up to `timeout` seconds for an event to be announced after
+        `generation`, a value of `self.generation`.  Returns True if one was."""
+        self.start_watching()
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.generation == generation:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def start_watching(self):
+        # watch a shared backend in a thread, started when first needed
+        if not self.backend.shared:
+            return
+        with self._watcher_lock:
+            if self._watcher is None:
+                self._watcher = threading.Thread(
+                    target=self._watch, name='treestatus-events')
+                self._watcher.daemon = True
+                self._watcher.start()
+
+    def _watch(self):  # pragma: no cover
+        version = self.check(None)
+        while True:
+            time.sleep(POLL_INTERVAL)
+            version = self.check(version)
+
+    def check(self, last_version):
+        """Announce an event if the backend's version differs from
+        `last_version`, returning the current version"""
+        try:
+            version = self.backend.version()
+        except Exception:
+            logger.exception("while checking for tree status events")
+            return last_version
+        if version != last_version:
+            self.notify()
+        return version
+
+
+class LocalBackend(object):
+
+    """No fan-out: only changes made in this process are announced promptly.
+    This is suitable for single-process deployments."""
+
+    shared = False
+
+    def __init__(self, app, config):
+        pass
+
+    def publish(self):
+        pass
+
+    def version(self):
+        return None
+
+
+class MemcachedBackend(object):
+
+    """Fan-out through a counter in memcached, which is incremented for each
+    event and checked by each process every POLL_INTERVAL seconds"""
+
+    shared = True
+    key = 'treestatus:events:version'
+
+    def __init__(self, app, config):
+        self.memcached = app.memcached
+        self.cache_config = config['cache']
+
+    def publish(self):
+        with self.memcached.cache(self.cache_config) as mc:
+            if mc.incr(self.key) is None and not mc.add(self.key, 1):
+                # another process added it first
+                mc.incr(self.key)
+
+    def version(self):
+        with self.memcached.cache(self.cache_config) as mc:
+            return mc.get(self.key)
+
+
+backends = {
+    'local': LocalBackend,
+    'memcached': MemcachedBackend,
+}
+
+
+def init_app(app):
+    config = app.config.get('TREESTATUS_EVENTS', {})
+    backend = backends[config.get('type', 'local')](app, config)
+    app.treestatus_events = Broker(backend)
+
+
+def changed(session):
+    """Note that the session contains a tree status change, which will be
+    published when the session is committed"""
+    if isinstance(session, scoping.scoped_session):
+        session = session()
+    session.info['treestatus_changed'] = True
+    # listen to this session only, rather than to every session in the app
+    if not event.contains(session, 'after_commit', _publish_changes):
+        event.listen(session, 'after_commit', _publish_changes)
+        event.listen(session, 'after_rollback', _forget_changes)
+
+
+def _publish_changes(session):
+    if session.info.pop('treestatus_changed', False):
+        current_app.treestatus_events.publish()
+
+
+def _forget_changes(session):
+    session.info.pop('treestatus_changed', None)
+
+
+# Log entry ids are assigned when they are inserted, but the entries become
+# visible when they are committed, which may be in a different order.  So a
+# stream's position is the highest id it has sent, along with the ids in the
+# EVENTS_REORDER_WINDOW ids below that which it has not seen, any of which may
+# yet be committed.  The position is sent to the client as the event id, as
+# `<id>` or `<id>:<gap>,<gap>,..`.
+
+
+def missing_ids(session, last_id):
+    """Return the ids in the window below `last_id` which are not (yet) in
+    the log"""
+    low = max(last_id - EVENTS_REORDER_WINDOW, 0)
+    present = set(r[0] for r in session.query(model.DbLog.id).filter(
+        model.DbLog.id > low, model.DbLog.id <= last_id))
+    return set(xrange(low + 1, last_id + 1)) - present
+
+
+def format_position(last_id, gaps):
+    if not gaps:
+        return str(last_id)
+    return '%d:%s' % (last_id, ','.join(str(g) for g in sorted(gaps)))
+
+
+def parse_position(session, text):
+    """Return the (last_id, gaps) given by an event id, raising ValueError if
+    it is invalid.  For a bare log entry id, the gaps are those ids below it
+    which are not yet in the log."""
+    last_id, sep, gaps = text.partition(':')
+    last_id = int(last_id)
+    if last_id < 0:
+        raise ValueError("negative id")
+    if not sep:
+        return last_id, missing_ids(session, last_id)
+    gaps = set(int(g) for g in gaps.split(','))
+    if len(gaps) > EVENTS_REORDER_WINDOW or \
+            not all(max(last_id - EVENTS_REORDER_WINDOW, 0) < g <= last_id for g in gaps):
+        raise ValueError("gap outside of window")
+    return last_id, gaps
+
+
+def latest_position(session):
+    last_id = session.query(sa.func.max(model.DbLog.id)).scalar() or 0
+    return last_id, missing_ids(session, last_id)
+
+
+def read_events(session, last_id, gaps, trees=None):
+    """Read up to EVENTS_CHUNK_SIZE log entries after the position given by
+    `last_id` and `gaps`.  Returns a list of (event id, JSON text) pairs for
+    the entries for the given trees (or all trees), the new position, and
+    whether there may be more entries to read."""
+    gaps = set(gaps)
+    cond = model.DbLog.id > last_id
+    if gaps:
+        cond = sa.or_(cond, model.DbLog.id.in_(gaps))
+    q = session.query(model.DbLog).filter(cond)
+    q = q.order_by(model.DbLog.id).limit(EVENTS_CHUNK_SIZE)
+    entries = q.all()
+    events = []
+    for l in entries:
+        if l.id in gaps:
+            gaps.discard(l.id)
+        else:
+            gaps.update(xrange(last_id + 1, l.id))
+            last_id = l.id
+        gaps = set(g for g in gaps if g > last_id - EVENTS_REORDER_WINDOW)
+        if not trees or l.tree in trees:
+            events.append((format_position(last_id, gaps),
+                           api.dumps(types.JsonTreeLog, l.to_json())))
+    return events, (last_id, gaps), len(entries) == EVENTS_CHUNK_SIZE
+
+
+def stream(position, trees, duration, heartbeat_interval, retry_ms):
+    """Generate a Server-Sent Events stream of the changes after `position`,
+    a (last_id, gaps) pair, for `duration` seconds, with a comment every
+    `heartbeat_interval` seconds without events to keep the connection
+    alive"""
+    broker = current_app.treestatus_events
+    session = current_app.db.session('relengapi')
+    deadline = time.time() + duration
+    yield 'retry: %d\n\n' % retry_ms
+    while True:
+        # note the generation before reading, so that an event committed
+        # in the meantime isn't missed
+        generation = broker.generation
+        events, position, more = read_events(session, position[0], position[1], trees)
+        # end the transaction, so that the next read sees new changes
+        session.close()
+        for event_id, data in events:
+            yield 'id: %s\ndata: %s\n\n' % (event_id, data)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        # if there may be more events, read them right away
+        if not more and not broker.wait(generation, min(heartbeat_interval, remaining)):
+            yield ': keepalive\n\n'
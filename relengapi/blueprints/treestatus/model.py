@@ -8,6 +8,7 @@ import logging
 from relengapi.lib import db
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy import Text
@@ -46,6 +47,9 @@ class DbLog(db.declarative_base('relengapi')):
     reason = Column(Text, nullable=False)
     _tags = Column("tags", Text, nullable=False)
 
+    # serves a tree's log, newest first
+    __table_args__ = (Index('ix_treestatus_log_tree_when', 'tree', 'when'), )
+
     def __init__(self, tags=None, **kwargs):
         if tags is not None:
             kwargs['_tags'] = json.dumps(tags)
@@ -57,6 +61,7 @@ class DbLog(db.declarative_base('relengapi')):
 
     def to_json(self):
         return types.JsonTreeLog(
+            id=self.id,
             tree=self.tree,
             when=self.when,
             who=self.who,
@@ -247,11 +247,29 @@ angular.module('treestatus').controller('TreeListController',
         });
     };
 
+    // the index page only includes the most recent changes; more are
+    // fetched a page at a time
+    var STACK_PAGE_SIZE = 20;
+    $scope.more_stack = $scope.stack.length >= STACK_PAGE_SIZE;
+
     var reloadStack = function() {
-        restapi.get('/treestatus/stack', {
+        restapi.get('/treestatus/stack?limit=' + STACK_PAGE_SIZE, {
             while: 'fetching undo stack data',
         }).then(function (data, status, headers, config) {
             $scope.stack = data.data.result;
+            $scope.more_stack = $scope.stack.length >= STACK_PAGE_SIZE;
+        });
+    };
+
+    $scope.loadMoreStack = function() {
+        var last = $scope.stack[$scope.stack.length - 1];
+        restapi.get('/treestatus/stack?limit=' + STACK_PAGE_SIZE +
+                    '&before_id=' + last.id, {
+            while: 'fetching more of the undo stack',
+        }).then(function (data, status, headers, config) {
+            var page = data.data.result;
+            $scope.stack = $scope.stack.concat(page);
+            $scope.more_stack = page.length >= STACK_PAGE_SIZE;
         });
     };
 
@@ -339,7 +357,10 @@ angular.module('treestatus').controller('TreeDetailController',
                                     function($scope, restapi, initial_data) {
     $scope.tree = initial_data.tree;
     $scope.logs = initial_data.logs;
-    $scope.show_all_logs = false;
+    // the page includes the most recent few log entries; more are fetched
+    // a page at a time
+    var SUMMARY_LOGS = 5, LOGS_PAGE_SIZE = 100;
+    $scope.more_logs = $scope.logs.length >= SUMMARY_LOGS;
 
     $scope.new_motd = $scope.tree.message_of_the_day;
 
@@ -352,11 +373,13 @@ angular.module('treestatus').controller('TreeDetailController',
     var treename = $scope.tree.tree;
 
     var reloadLogs = function() {
-        var all_ext = $scope.show_all_logs ? '?all=1' : '';
-        restapi.get('/treestatus/trees/' + treename + '/logs' + all_ext, {
-            while: 'fetching more logs',
+        // reload as many entries as are shown
+        var limit = Math.min(Math.max($scope.logs.length, SUMMARY_LOGS), 1000);
+        restapi.get('/treestatus/trees/' + treename + '/logs?limit=' + limit, {
+            while: 'fetching logs',
         }).then(function (data, status, headers, config) {
             $scope.logs = data.data.result;
+            $scope.more_logs = $scope.logs.length >= limit;
         });
     };
 
@@ -368,9 +391,16 @@ angular.module('treestatus').controller('TreeDetailController',
         });
     };
 
-    $scope.loadAllLogs = function() {
-        $scope.show_all_logs = true;
-        reloadLogs();
+    $scope.loadMoreLogs = function() {
+        var last = $scope.logs[$scope.logs.length - 1];
+        restapi.get('/treestatus/trees/' + treename + '/logs?limit=' +
+                    LOGS_PAGE_SIZE + '&before_id=' + last.id, {
+            while: 'fetching more logs',
+        }).then(function (data, status, headers, config) {
+            var page = data.data.result;
+            $scope.logs = $scope.logs.concat(page);
+            $scope.more_logs = page.length >= LOGS_PAGE_SIZE;
+        });
     };
 
     $scope.refresh = function() {
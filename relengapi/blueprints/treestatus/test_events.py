@@ -0,0 +1,251 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import json
+import mock
+import threading
+import time
+
+from nose.tools import eq_
+from relengapi.blueprints import treestatus
+from relengapi.blueprints.treestatus import events
+from relengapi.blueprints.treestatus import model
+from relengapi.blueprints.treestatus.test_treestatus import db_setup
+from relengapi.blueprints.treestatus.test_treestatus import sheriff
+from relengapi.lib.testing.context import TestContext
+from sqlalchemy import event
+from sqlalchemy import orm
+
+config = {'TREESTATUS_EVENTS_STREAM_DURATION': 0}
+test_context = TestContext(databases=['relengapi'],
+                           db_setup=db_setup,
+                           config=config)
+
+
+def parse_stream(data):
+    """Return the (event id, parsed data) of each event in an event stream"""
+    result = []
+    for message in data.split('\n\n'):
+        fields = dict(l.split(': ', 1) for l in message.split('\n')
+                      if l and not l.startswith(':'))
+        if 'data' in fields:
+            result.append((fields['id'], json.loads(fields['data'])))
+    return result
+
+
+def add_log(app, tree, status):
+    session = app.db.session('relengapi')
+    tree_row = session.query(model.DbTree).get(tree)
+    with app.test_request_context():
+        # (update_tree_status needs a current user)
+        treestatus.update_tree_status(session, tree_row, status=status, reason='r')
+        session.commit()
+
+
+def test_broker_wait_timeout():
+    """Broker.wait returns False if nothing is announced in time"""
+    broker = events.Broker(events.LocalBackend(None, {}))
+    eq_(broker.wait(broker.generation, 0.01), False)
+
+
+def test_broker_wait_notified():
+    """Broker.wait returns True when an event is announced, even if that
+    happened before it was called"""
+    broker = events.Broker(events.LocalBackend(None, {}))
+    generation = broker.generation
+    thd = threading.Thread(target=lambda: (time.sleep(0.01), broker.publish()))
+    thd.start()
+    eq_(broker.wait(generation, 10), True)
+    thd.join()
+    eq_(broker.wait(generation, 0), True)
+
+
+def test_broker_local_no_watcher():
+    """A broker with the local backend does not start a watcher thread"""
+    broker = events.Broker(events.LocalBackend(None, {}))
+    broker.wait(broker.generation, 0)
+    eq_(broker._watcher, None)
+
+
+@test_context.specialize(config={'TREESTATUS_EVENTS': {'type': 'memcached',
+                                                       'cache': 'mock://events'}})
+def test_memcached_fan_out(app):
+    """With the memcached backend, a broker announces events published by
+    the broker of another process"""
+    other = events.Broker(events.MemcachedBackend(app, app.config['TREESTATUS_EVENTS']))
+    broker = app.treestatus_events
+    version = broker.check(None)
+    generation = broker.generation
+    eq_(broker.check(version), version)
+    eq_(broker.generation, generation)
+    other.publish()
+    other.publish()
+    eq_(broker.check(version), (version or 0) + 2)
+    eq_(broker.generation, generation + 1)
+
+
+@test_context
+def test_commit_publishes(app):
+    """Committing a status change publishes an event, while rolling one back
+    does not"""
+    broker = app.treestatus_events
+    generation = broker.generation
+    add_log(app, 'tree1', 'open')
+    eq_(broker.generation, generation + 1)
+
+    session = app.db.session('relengapi')
+    events.changed(session)
+    session.rollback()
+    session.commit()
+    eq_(broker.generation, generation + 1)
+
+
+@test_context
+def test_get_events_resume(client):
+    """GET /treestatus/events with Last-Event-ID streams the log entries
+    after that id"""
+    resp = client.get('/treestatus/events', headers=[('Last-Event-ID', '2')])
+    eq_(resp.status_code, 200)
+    eq_(resp.headers['Content-Type'], 'text/event-stream; charset=utf-8')
+    eq_(resp.headers['Access-Control-Allow-Origin'], '*')
+    assert resp.data.startswith('retry: ')
+    got = parse_stream(resp.data)
+    eq_([(id, e['tree'], e['reason']) for id, e in got],
+        [('3', 'tree1', 'because'), ('4', 'tree2', 'so there')])
+
+
+@test_context
+def test_get_events_query_param(client):
+    """The last event id can be given as a query parameter, and the events
+    limited to some trees"""
+    resp = client.get('/treestatus/events?last_event_id=0&tree=tree2')
+    eq_([id for id, e in parse_stream(resp.data)], ['4'])
+
+
+@test_context
+def test_get_events_new_only(client):
+    """Without a last event id, only new events are streamed"""
+    resp = client.get('/treestatus/events')
+    eq_(parse_stream(resp.data), [])
+
+
+@test_context
+def test_get_events_bad_id(client):
+    """An invalid last event id is a bad request"""
+    resp = client.get('/treestatus/events', headers=[('Last-Event-ID', 'x')])
+    eq_(resp.status_code, 400)
+
+
+def add_log_entry(app, id, tree):
+    session = app.db.session('relengapi')
+    session.add(model.DbLog(id=id, tree=tree, when=datetime.datetime(2015, 8, 1),
+                            who='me', status='open', reason='r', tags=[]))
+    session.commit()
+
+
+@test_context
+def test_read_events_late_commit(app):
+    """A log entry committed after one with a higher id is still read, once,
+    and the event ids carry the ids not yet seen"""
+    with app.app_context():
+        session = app.db.session('relengapi')
+        add_log_entry(app, 6, 'tree1')
+        got, position, more = events.read_events(session, 4, set())
+        eq_([id for id, data in got], ['6:5'])
+        eq_(position, (6, set([5])))
+        eq_(events.read_events(session, 6, set([5]))[0], [])
+
+        add_log_entry(app, 5, 'tree2')
+        got, position, more = events.read_events(session, 6, set([5]))
+        eq_([(id, json.loads(data)['id']) for id, data in got], [('6', 5)])
+        eq_(position, (6, set()))
+        eq_(more, False)
+
+
+@test_context
+def test_read_events_trees(app):
+    """Entries for other trees advance the position without being sent"""
+    with app.app_context():
+        session = app.db.session('relengapi')
+        got, position, more = events.read_events(session, 0, set(), ['tree2'])
+        eq_([id for id, data in got], ['4'])
+        eq_(position, (4, set()))
+
+
+@test_context
+def test_parse_position(app):
+    """Event ids are parsed to positions, with the gaps below a bare id
+    found in the log"""
+    with app.app_context():
+        session = app.db.session('relengapi')
+        add_log_entry(app, 6, 'tree1')
+        eq_(events.parse_position(session, '6'), (6, set([5])))
+        eq_(events.parse_position(session, '6:2,5'), (6, set([2, 5])))
+        eq_(events.latest_position(session), (6, set([5])))
+        for bad in ['x', '-1', '6:', '6:x', '6:7', '6:0', '6:-1']:
+            try:
+                events.parse_position(session, bad)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError(bad)
+
+
+@test_context
+def test_get_events_resume_gaps(app, client):
+    """Resuming from an event id with gaps sends the entries in the gaps"""
+    add_log_entry(app, 6, 'tree1')
+    add_log_entry(app, 5, 'tree2')
+    resp = client.get('/treestatus/events', headers=[('Last-Event-ID', '6:5')])
+    eq_([e['id'] for id, e in parse_stream(resp.data)], [5])
+    resp = client.get('/treestatus/events', headers=[('Last-Event-ID', '6:x')])
+    eq_(resp.status_code, 400)
+
+
+@test_context
+def test_changed_listens_to_session(app):
+    """Only sessions with changes listen for their commits"""
+    with app.app_context():
+        session = app.db.session('relengapi')
+        assert not event.contains(orm.Session, 'after_commit', events._publish_changes)
+        assert not event.contains(session(), 'after_commit', events._publish_changes)
+        events.changed(session)
+        assert event.contains(session(), 'after_commit', events._publish_changes)
+        session.rollback()
+
+
+@test_context
+def test_stream_wakes(app):
+    """The event stream sends events as they are published, and keepalives
+    while there are none"""
+    with app.test_request_context(), \
+            mock.patch.object(app.treestatus_events, 'wait') as wait:
+        def publish(generation, timeout):
+            if len(wait.mock_calls) == 1:
+                add_log(app, 'tree1', 'open')
+                return True
+            return False
+        wait.side_effect = publish
+        stream = events.stream((4, set()), [], 10, 1, 2000)
+        eq_(next(stream), 'retry: 2000\n\n')
+        got = parse_stream(next(stream))
+        eq_([(id, e['tree'], e['status']) for id, e in got], [('5', 'tree1', 'open')])
+        eq_(next(stream), ': keepalive\n\n')
+        eq_(wait.mock_calls[0][1][1], 1)
+
+
+@test_context.specialize(user=sheriff)
+def test_patch_publishes(app, client):
+    """Changing a tree's status with PATCH /treestatus/trees publishes an
+    event, which can then be read from the stream"""
+    generation = app.treestatus_events.generation
+    client.patch('/treestatus/trees', data=json.dumps(
+        dict(trees=['tree1'], status='open')),
+        headers=[('Content-Type', 'application/json')])
+    eq_(app.treestatus_events.generation, generation + 1)
+    resp = client.get('/treestatus/events', headers=[('Last-Event-ID', '4')])
+    got = parse_stream(resp.data)
+    eq_([(id, e['tree'], e['status']) for id, e in got], [('5', 'tree1', 'open')])
+    assert got[0][1]['when'] > datetime.datetime(2015, 8, 1).isoformat()
@@ -15,6 +15,7 @@ from relengapi.blueprints.treestatus import types
 from relengapi.lib import auth
 from relengapi.lib.permissions import p
 from relengapi.lib.testing.context import TestContext
+from relengapi.lib.testing.queries import count_queries
 
 
 tree1_json = {
@@ -185,6 +186,152 @@ def test_memcache_functions(app):
         eq_(treestatus.tree_cache_get(u't'), None)
 
 
+@test_context
+def test_memcache_multi_functions(app):
+    """The (private) memcached functions for many trees, and for the names
+    of all trees, correctly get, set, and invalidate using a mock cache"""
+    with app.app_context():
+        trees = {u't%d' % i: u'{"tree": "t%d"}' % i for i in range(3)}
+        eq_(treestatus.tree_cache_get_multi_json([u't0', u't1']), {})
+        treestatus.tree_cache_set_multi_json(trees)
+        treestatus.tree_cache_invalidate(u't1')
+        eq_(treestatus.tree_cache_get_multi_json([u't0', u't1', u't2']),
+            {u't0': u'{"tree": "t0"}', u't2': u'{"tree": "t2"}'})
+
+        eq_(treestatus.tree_names_cache_get(), None)
+        treestatus.tree_names_cache_set([u't1', u't0'])
+        eq_(treestatus.tree_names_cache_get(), [u't0', u't1'])
+        treestatus.tree_names_cache_invalidate()
+        eq_(treestatus.tree_names_cache_get(), None)
+
+
+@test_context
+def test_memcache_expiry(app):
+    """Cached trees and tree names expire"""
+    with app.app_context():
+        treestatus.tree_cache_set_json(u't0', u'{"tree": "t0"}')
+        treestatus.tree_cache_set_multi_json({u't1': u'{"tree": "t1"}'})
+        treestatus.tree_names_cache_set([u't0', u't1'])
+        with app.memcached.cache(config['TREESTATUS_CACHE']) as mc:
+            for key in 't0', 't1', treestatus.TREE_NAMES_CACHE_KEY:
+                assert mc.dictionary[key][1] is not None, key
+
+
+@test_context
+def test_update_invalidates_after_commit(app):
+    """Updating a tree's status invalidates its cached state when the change
+    is committed, and not before, nor if it is rolled back"""
+    with app.test_request_context():
+        session = app.db.session('relengapi')
+        tree = session.query(model.DbTree).get('tree1')
+        treestatus.tree_cache_set_json(u'tree1', u'{"tree": "tree1"}')
+        treestatus.update_tree_status(session, tree, status='open')
+        assert treestatus.tree_cache_get_json(u'tree1')
+        session.rollback()
+        assert treestatus.tree_cache_get_json(u'tree1')
+
+        tree = session.query(model.DbTree).get('tree1')
+        treestatus.update_tree_status(session, tree, status='open')
+        assert treestatus.tree_cache_get_json(u'tree1')
+        session.commit()
+        eq_(treestatus.tree_cache_get_json(u'tree1'), None)
+
+
+@test_context
+def test_get_trees_cached(app, client):
+    """Once /treestatus/trees has been fetched, fetching it again does not
+    query the database"""
+    client.get('/treestatus/trees')
+    with count_queries(app.db.engine('relengapi')) as statements:
+        resp = client.get('/treestatus/trees')
+    eq_(statements, [])
+    eq_(json.loads(resp.data)['result'], {'tree1': tree1_json})
+
+
+@test_context
+def test_get_trees_partly_cached(app, client):
+    """When only some trees are cached, /treestatus/trees fetches the rest
+    from the database"""
+    client.get('/treestatus/trees')
+    with app.app_context():
+        treestatus.tree_cache_invalidate(u'tree1')
+    resp = client.get('/treestatus/trees')
+    eq_(json.loads(resp.data)['result'], {'tree1': tree1_json})
+    with app.app_context():
+        eq_(treestatus.tree_cache_get(u'tree1').status, 'closed')
+
+
+@test_context
+def test_get_trees_etag(client):
+    """/treestatus/trees and /treestatus/v0/trees/ have an ETag, and a
+    conditional request with a matching ETag gets a 304"""
+    for path in '/treestatus/trees', '/treestatus/v0/trees/':
+        resp = client.get(path)
+        etag = resp.headers['ETag']
+        resp = client.get(path, headers=[('If-None-Match', etag)])
+        eq_(resp.status_code, 304)
+        eq_(resp.headers['Cache-Control'], 'no-cache')
+
+
+@test_context.specialize(user=sheriff)
+def test_get_tree_etag(client):
+    """/treestatus/trees/tree1 has an ETag, which changes when the tree
+    does"""
+    etag = client.get('/treestatus/trees/tree1').headers['ETag']
+    # the v0 body is exactly the tree's JSON, without the request id, so its
+    # ETag is the strong form of the same tag
+    eq_('W/' + client.get('/treestatus/v0/trees/tree1').headers['ETag'], etag)
+    resp = client.get('/treestatus/trees/tree1', headers=[('If-None-Match', etag)])
+    eq_(resp.status_code, 304)
+    client.patch('/treestatus/trees', data=json.dumps(
+        dict(trees=['tree1'], status='open')),
+        headers=[('Content-Type', 'application/json')])
+    resp = client.get('/treestatus/trees/tree1', headers=[('If-None-Match', etag)])
+    eq_(resp.status_code, 200)
+    eq_(json.loads(resp.data)['result']['status'], 'open')
+
+
+@test_context
+def test_get_tree_cached_skips_wsme(client):
+    """A cached tree is served without converting it to or from WSME types"""
+    client.get('/treestatus/trees/tree1')
+    with mock.patch('wsme.rest.json.fromjson') as fromjson, \
+            mock.patch('wsme.rest.json.tojson') as tojson:
+        resp = client.get('/treestatus/trees/tree1')
+        eq_(fromjson.mock_calls, [])
+        eq_(tojson.mock_calls, [])
+    eq_(json.loads(resp.data)['result'], tree1_json)
+
+
+@test_context
+def test_get_tree_browser(client):
+    """A browser is still shown the HTML rendering of a tree"""
+    resp = client.get('/treestatus/trees/tree1', headers=[('Accept', 'text/html')])
+    eq_(resp.status_code, 200)
+    assert 'enjoy troy' in resp.data
+    assert 'ETag' not in resp.headers
+
+
+@test_context.specialize(user=admin_and_sheriff)
+def test_get_trees_cache_invalidation(app, client):
+    """Updating, making, and killing trees are reflected in a cached
+    /treestatus/trees"""
+    def get_trees():
+        resp = client.get('/treestatus/trees')
+        return json.loads(resp.data)['result']
+    get_trees()
+    client.patch('/treestatus/trees', data=json.dumps(
+        dict(trees=['tree1'], status='open')),
+        headers=[('Content-Type', 'application/json')])
+    eq_(get_trees()['tree1']['status'], 'open')
+    client.put('/treestatus/trees/tree2', data=json.dumps(
+        dict(tree='tree2', status='open', reason='', message_of_the_day='')),
+        headers=[('Content-Type', 'application/json')])
+    eq_(sorted(get_trees()), ['tree1', 'tree2'])
+    client.delete('/treestatus/trees/tree1')
+    eq_(sorted(get_trees()), ['tree2'])
+
+
 @test_context
 def test_index_view(client):
     """Getting /treestatus/ results in an index page"""
@@ -365,6 +512,7 @@ def test_get_logs(client):
     entries (newest first), with a no-cache header and ACAO *"""
     resp = client.get('/treestatus/trees/tree1/logs')
     eq_(json.loads(resp.data)['result'], [{
+        'id': 2,
         'tree': 'tree1',
         'tags': [],
         'who': 'dustin',
@@ -372,6 +520,7 @@ def test_get_logs(client):
         'reason': 'i really wanted to',
         'status': 'opened',
     }, {
+        'id': 3,
         'tree': 'tree1',
         'tags': ['a', 'b'],
         'who': 'dustin',
@@ -379,6 +528,7 @@ def test_get_logs(client):
         'reason': 'because',
         'status': 'closed',
     }, {
+        'id': 1,
         'tree': 'tree1',
         'tags': ['a'],
         'who': 'dustin',
@@ -415,6 +565,55 @@ def test_get_logs_all(client, app):
     eq_(len(json.loads(resp.data)['result']), 8)
 
 
+@test_context
+def test_get_logs_all_unlimited(client):
+    """?all=1 gets all log entries, however many there are"""
+    with mock.patch('relengapi.blueprints.treestatus.MAX_PAGE_SIZE', 2):
+        resp = client.get('/treestatus/trees/tree1/logs?all=1')
+    eq_([l['id'] for l in json.loads(resp.data)['result']], [2, 3, 1])
+
+
+@test_context
+def test_get_logs_pages(client):
+    """Log entries can be fetched a page at a time, ordered by time even
+    where that is not the order of their ids"""
+    def page(qs):
+        resp = client.get('/treestatus/trees/tree1/logs?' + qs)
+        return [l['id'] for l in json.loads(resp.data)['result']]
+    eq_(page('limit=2'), [2, 3])
+    eq_(page('limit=2&before_id=3'), [1])
+    eq_(page('before_id=2'), [3, 1])
+    eq_(page('before_id=1'), [])
+
+
+@test_context.specialize(db_setup=db_setup_stack)
+def test_get_pages_bad_before_id(client):
+    """A before_id that is not an existing entry is a bad request, rather
+    than an empty page"""
+    for path in '/treestatus/trees/tree1/logs', '/treestatus/stack':
+        resp = client.get(path + '?before_id=99')
+        eq_(resp.status_code, 400)
+
+
+@test_context
+def test_get_logs_times(client):
+    """Log entries can be limited to a range of times"""
+    resp = client.get('/treestatus/trees/tree1/logs?all=1'
+                      '&since=2015-07-14T17:44:00&until=2015-07-15T17:44:00')
+    eq_([l['id'] for l in json.loads(resp.data)['result']], [3])
+    resp = client.get('/treestatus/trees/tree1/logs?since=2015-07-14T00:00:00')
+    eq_([l['id'] for l in json.loads(resp.data)['result']], [2, 3])
+
+
+@test_context
+def test_get_logs_bad_limit(client):
+    """A log page size that is not between 1 and MAX_PAGE_SIZE is a bad
+    request"""
+    for limit in 0, treestatus.MAX_PAGE_SIZE + 1:
+        resp = client.get('/treestatus/trees/tree1/logs?limit=%d' % limit)
+        eq_(resp.status_code, 400)
+
+
 @test_context
 def test_get_logs_nosuch(client):
     """Getting /treestatus/trees/NOSUCH/logs results in a 404"""
@@ -448,6 +647,38 @@ def test_get_stack(client):
     ])
 
 
+@test_context.specialize(db_setup=db_setup_stack)
+def test_get_stack_pages(client):
+    """The stack can be fetched a page at a time, and limited to a range of
+    times"""
+    def page(qs):
+        resp = client.get('/treestatus/stack?' + qs)
+        return [ch['id'] for ch in json.loads(resp.data)['result']]
+    eq_(page('limit=1'), [2])
+    eq_(page('limit=1&before_id=2'), [1])
+    eq_(page('until=2015-07-15T00:00:00'), [1])
+    eq_(page('since=2015-07-15T00:00:00'), [2])
+
+
+@test_context.specialize(db_setup=db_setup_stack)
+def test_get_stack_eager_trees(app, client):
+    """Getting the stack loads the trees of all changes at once"""
+    with count_queries(app.db.engine('relengapi')) as statements:
+        resp = client.get('/treestatus/stack')
+    eq_(len(json.loads(resp.data)['result']), 2)
+    eq_(len(statements), 2)
+
+
+@test_context.specialize(db_setup=db_setup_stack)
+def test_index_view_stack_page(app):
+    """The index page includes only the first page of the stack"""
+    with app.test_request_context():
+        with mock.patch('relengapi.blueprints.treestatus.STACK_PAGE_SIZE', 1):
+            with mock.patch('relengapi.lib.angular.template') as template:
+                treestatus.index()
+    eq_([ch.id for ch in template.mock_calls[0][2]['stack']], [2])
+
+
 @test_context.specialize(db_setup=db_setup_stack, user=sheriff)
 def test_revert_stack(app, client):
     """DELETEing /treestatus/stack/N with ?revert=1 undoes the effects of
@@ -765,3 +996,52 @@ def test_patch_trees_remember(app, client):
     assert_change_last_state(app, 3,
                              tree0=('closed', 'bug 123'),
                              tree1=('closed', 'bug 456'))
+
+
+@test_context.specialize(db_setup=db_setup_stack, user=sheriff)
+def test_patch_trees_bulk_queries(app, client):
+    """PATCHing many trees takes no more queries than PATCHing one"""
+    def patch(trees, reason):
+        update = {'trees': trees, 'status': 'closed', 'reason': reason,
+                  'tags': ['t'], 'remember': True}
+        with count_queries(app.db.engine('relengapi')) as statements:
+            resp = client.patch('/treestatus/trees',
+                                data=json.dumps(update),
+                                headers=[('Content-Type', 'application/json')])
+        eq_(resp.status_code, 204)
+        return len(statements)
+    eq_(patch(['tree0', 'tree1', 'tree2'], 'outage'), patch(['tree0'], 'still out'))
+    for tree in 'tree0', 'tree1', 'tree2':
+        assert_logged(app, tree, 'closed', 'outage', tags=['t'])
+    assert_change_last_state(app, 3,
+                             tree0=('closed', 'bug 123'),
+                             tree1=('closed', 'bug 456'),
+                             tree2=('closed', 'bug 456'))
+
+
+@test_context.specialize(db_setup=db_setup_stack, user=sheriff)
+def test_patch_trees_invalidates_cache(app, client):
+    """PATCHing many trees invalidates all of them in the cache"""
+    client.get('/treestatus/trees')
+    client.patch('/treestatus/trees', data=json.dumps(
+        {'trees': ['tree0', 'tree2'], 'status': 'open'}),
+        headers=[('Content-Type', 'application/json')])
+    with app.app_context():
+        eq_(treestatus.tree_cache_get(u'tree0'), None)
+        eq_(treestatus.tree_cache_get(u'tree1').status, 'closed')
+        eq_(treestatus.tree_cache_get(u'tree2'), None)
+    resp = client.get('/treestatus/trees')
+    eq_(sorted((t['tree'], t['status']) for t in json.loads(resp.data)['result'].values()),
+        [('tree0', 'open'), ('tree1', 'closed'), ('tree2', 'open')])
+
+
+@test_context.specialize(user=sheriff)
+def test_patch_trees_none(app, client):
+    """PATCHing an empty list of trees changes and logs nothing"""
+    resp = client.patch('/treestatus/trees', data=json.dumps(
+        dict(trees=[], status='open', reason='r', remember=True)),
+        headers=[('Content-Type', 'application/json')])
+    eq_(resp.status_code, 204)
+    assert_nothing_logged(app, 'tree1')
+    with app.app_context():
+        eq_(model.DbStatusChangeTree.query.all(), [])
@@ -35,6 +35,9 @@ class JsonTreeLog(wsme.types.Base):
 
     _name = 'TreeLog'
 
+    #: the id of the log entry, for paging through the log
+    id = wsme.types.wsattr(int, mandatory=False)
+
     #: the name of the tree
     tree = wsme.types.wsattr(unicode, mandatory=True)
 
@@ -3,6 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import functools
+import hashlib
 import sys
 import traceback
 import werkzeug
@@ -150,6 +151,23 @@ def get_data(view_func, *args, **kwargs):
     return rv
 
 
+def json_response(result_json, wrap=True):
+    """Make a response from already-serialized JSON text, with an ETag computed
+    from that text, so that a request with a matching ``If-None-Match`` gets a
+    304.  If `wrap` is true, the JSON is the result of an API method, and is
+    wrapped as `JsonHandler` would; this skips converting the result to and
+    from WSME types.  The wrapper includes the request id, so the ETag of a
+    wrapped response is weak."""
+    if isinstance(result_json, unicode):
+        result_json = result_json.encode('utf-8')
+    body = result_json
+    if wrap:
+        body = '{"request_id": %s, "result": %s}' % (json.dumps(g.request_id), result_json)
+    resp = Response(body, content_type='application/json')
+    resp.set_etag(hashlib.sha1(result_json).hexdigest(), weak=wrap)
+    return resp.make_conditional(request)
+
+
 class JsonObject(wsme.types.UserType):
 
     basetype = dict
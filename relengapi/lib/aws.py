@@ -4,13 +4,18 @@
 
 from __future__ import absolute_import
 
+import base64
 import boto
+import boto.utils
+import hashlib
+import hmac
 import importlib
 import json
 import logging
 import structlog
 import threading
 import time
+import urllib
 import wsme.rest.json
 
 from boto.sqs import message as sqs_message
@@ -23,14 +28,90 @@ class _StopListening(Exception):
     pass
 
 
+class _S3Signer(object):
+
+    """Sign query-authenticated S3 URLs for a single connection, using the
+    same (signature version 2) algorithm as boto's ``generate_url``, but with
+    the HMAC key and the per-bucket parts of the URL computed only once.  A
+    signer is only valid while the connection's credentials are unchanged;
+    see `is_current`."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.access_key = conn.provider.access_key
+        self.secret_key = conn.provider.secret_key
+        self.hmac = hmac.new(self.secret_key, digestmod=hashlib.sha1)
+        self._buckets = {}
+
+    def is_current(self, conn):
+        """Return True if this signer can sign for the given connection with
+        its current credentials"""
+        return (self.conn is conn and
+                self.access_key == conn.provider.access_key and
+                self.secret_key == conn.provider.secret_key)
+
+    @staticmethod
+    def can_sign(conn, keys, headers):
+        # fall back to boto for anything but the simple case
+        if conn._auth_handler.capability[0] != 'hmac-v1':
+            return False
+        if conn.provider.security_token:
+            return False
+        if set(headers) - set(['Content-Type']):
+            return False
+        return not any(k.startswith('/') or '//' in k for k in keys)
+
+    def _bucket_bases(self, bucket):
+        try:
+            return self._buckets[bucket]
+        except KeyError:
+            conn = self.conn
+            cf = conn.calling_format
+            url_base = cf.build_url_base(conn, conn.protocol, conn.server_name(conn.port),
+                                         bucket, '')
+            auth_base = conn.get_path(cf.build_auth_path(bucket, ''))
+            self._buckets[bucket] = url_base, auth_base
+            return url_base, auth_base
+
+    def sign(self, method, bucket, keys, expires, content_type):
+        url_base, auth_base = self._bucket_bases(bucket)
+        string_to_sign = '%s\n\n%s\n%d\n%s' % (method, content_type, expires, auth_base)
+        query = '?Signature=%s&Expires=%d&AWSAccessKeyId=%s'
+        urls = []
+        for key in keys:
+            key = urllib.quote(boto.utils.get_utf8_value(key))
+            h = self.hmac.copy()
+            h.update(string_to_sign + key)
+            signature = urllib.quote(base64.b64encode(h.digest()), safe='')
+            urls.append(url_base + key + query % (signature, expires, self.access_key))
+        return urls
+
+
 class AWS(object):
 
     def __init__(self, config):
         self.config = config
-        self._connections = {}
-        self._queues = {}
+        # boto connections are not thread-safe, so each thread gets its own
+        # connections, queues, and signers
+        self._local = threading.local()
         self._listeners = []
 
+    def _thread_cache(self, name):
+        try:
+            return getattr(self._local, name)
+        except AttributeError:
+            cache = {}
+            setattr(self._local, name, cache)
+            return cache
+
+    @property
+    def _connections(self):
+        return self._thread_cache('connections')
+
+    @property
+    def _queues(self):
+        return self._thread_cache('queues')
+
     def connect_to(self, service_name, region_name):
         key = service_name, region_name
         if key in self._connections:
@@ -45,6 +126,21 @@ class AWS(object):
         self._connections[key] = conn
         return conn
 
+    def generate_s3_urls(self, region_name, bucket, keys, method='GET', expires_in=60,
+                         headers=None):
+        signers = self._thread_cache('signers')
+        conn = self.connect_to('s3', region_name)
+        headers = headers or {}
+        expires = int(time.time() + expires_in)
+        if not _S3Signer.can_sign(conn, keys, headers):
+            return [conn.generate_url(method=method, expires_in=expires, bucket=bucket,
+                                      key=key, headers=headers, expires_in_absolute=True)
+                    for key in keys]
+        signer = signers.get(region_name)
+        if not signer or not signer.is_current(conn):
+            signer = signers[region_name] = _S3Signer(conn)
+        return signer.sign(method, bucket, keys, expires, headers.get('Content-Type', ''))
+
     def connect_to_default(self, service_name, region_name):
         # for the service, import 'boto.$service'
         service = importlib.import_module('boto.' + service_name)
@@ -0,0 +1,32 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from contextlib import contextmanager
+from sqlalchemy import event
+
+
+@contextmanager
+def count_queries(engine):
+    """Record the SQL statements executed on `engine` within the context,
+    yielding the list to which they are appended."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@contextmanager
+def assert_max_queries(engine, max_queries):
+    """Fail if more than `max_queries` SQL statements are executed on `engine`
+    within the context."""
+    with count_queries(engine) as statements:
+        yield
+    assert len(statements) <= max_queries, \
+        "expected at most {} queries, got {}:\n{}".format(
+            max_queries, len(statements), '\n'.join(statements))
@@ -72,6 +72,14 @@ def app_setup(app):
     def return_response():
         return redirect('/foo')
 
+    @app.route('/json_response')
+    def json_response():
+        return api.json_response(u'{"x": "\u2603"}')
+
+    @app.route('/json_response/unwrapped')
+    def json_response_unwrapped():
+        return api.json_response('[1, 2]', wrap=False)
+
 
 @contextlib.contextmanager
 def fixed_uuid4(uuid):
@@ -253,6 +261,42 @@ class AType(object):
 wsme.types.register_type(AType)
 
 
+@test_context
+def test_json_response(client):
+    """json_response wraps pre-serialized JSON as JsonHandler would, with
+    an ETag"""
+    resp = client.get('/json_response')
+    eq_(resp.status_code, 200)
+    eq_(resp.headers['Content-Type'], 'application/json')
+    data = json.loads(resp.data)
+    eq_(data['result'], {'x': u'\u2603'})
+    assert data['request_id']
+    # the body varies with the request id, so the ETag is weak
+    assert resp.headers['ETag'].startswith('W/"')
+    resp = client.get('/json_response', headers=[('If-None-Match', resp.headers['ETag'])])
+    eq_(resp.status_code, 304)
+
+
+@test_context
+def test_json_response_unwrapped(client):
+    """json_response with wrap=False returns the JSON as-is"""
+    resp = client.get('/json_response/unwrapped')
+    eq_(json.loads(resp.data), [1, 2])
+    assert resp.headers['ETag'].startswith('"')
+
+
+@test_context
+def test_json_response_not_modified(client):
+    """json_response returns a 304 for a request with a matching
+    If-None-Match header"""
+    etag = client.get('/json_response/unwrapped').headers['ETag']
+    resp = client.get('/json_response/unwrapped', headers=[('If-None-Match', etag)])
+    eq_(resp.status_code, 304)
+    eq_(resp.data, '')
+    resp = client.get('/json_response/unwrapped', headers=[('If-None-Match', '"other"')])
+    eq_(resp.status_code, 200)
+
+
 def test_jsonObject():
     # dictionaries work fine
     obj = AType()
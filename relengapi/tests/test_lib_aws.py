@@ -7,6 +7,7 @@ import json
 import logging
 import mock
 import moto
+import threading
 
 from logging import handlers
 from moto import mock_sqs
@@ -52,6 +53,67 @@ def test_connect_to(app):
     eq_(app.aws.connect_to('sqs', 'us-east-1'), 'sqs_conn')
 
 
+@test_context.specialize(config=aws_cfg)
+def test_connect_to_per_thread(app):
+    # boto connections are not thread-safe, so each thread gets its own
+    with mock.patch('boto.s3.connect_to_region', side_effect=lambda **kw: object()):
+        conn = app.aws.connect_to('s3', 'us-west-2')
+        other = []
+        thd = threading.Thread(
+            target=lambda: other.append(app.aws.connect_to('s3', 'us-west-2')))
+        thd.start()
+        thd.join()
+        assert other[0] is not conn
+        assert app.aws.connect_to('s3', 'us-west-2') is conn
+
+
+def check_generate_s3_urls(app, region, method, headers):
+    keys = ['sha512/abcd', 'dir/with space', u'caf\xe9']
+    with mock.patch('time.time', return_value=1000):
+        with app.app_context():
+            urls = app.aws.generate_s3_urls(region, 'tt-bucket', keys, method=method,
+                                            expires_in=60, headers=headers)
+            conn = app.aws.connect_to('s3', region)
+            exp_urls = [conn.generate_url(method=method, expires_in=60, bucket='tt-bucket',
+                                          key=key, headers=dict(headers or {}))
+                        for key in keys]
+    eq_(urls, exp_urls)
+
+
+@test_context.specialize(config=aws_cfg)
+def test_generate_s3_urls(app):
+    check_generate_s3_urls(app, 'us-east-1', 'GET', None)
+
+
+@test_context.specialize(config=aws_cfg)
+def test_generate_s3_urls_content_type(app):
+    check_generate_s3_urls(app, 'us-west-2', 'PUT',
+                           {'Content-Type': 'application/octet-stream'})
+
+
+@test_context.specialize(config=aws_cfg)
+def test_generate_s3_urls_new_credentials(app):
+    """When the connection's credentials change, URLs are signed with the new
+    ones"""
+    check_generate_s3_urls(app, 'us-east-1', 'GET', None)
+    with app.app_context():
+        provider = app.aws.connect_to('s3', 'us-east-1').provider
+        provider.access_key = 'rotated-key'
+        provider.secret_key = 'rotated-secret'
+    check_generate_s3_urls(app, 'us-east-1', 'GET', None)
+    with app.app_context():
+        url, = app.aws.generate_s3_urls('us-east-1', 'tt-bucket', ['k'])
+    assert 'AWSAccessKeyId=rotated-key' in url, url
+
+
+@test_context.specialize(config=aws_cfg)
+def test_generate_s3_urls_other_headers(app):
+    # headers the fast path doesn't handle are signed by boto
+    with mock.patch('relengapi.lib.aws._S3Signer.sign') as sign:
+        check_generate_s3_urls(app, 'us-west-2', 'PUT', {'x-amz-acl': 'private'})
+    eq_(sign.call_count, 0)
+
+
 @mock_sqs
 @test_context
 def test_connect_to_no_creds(app):
@@ -0,0 +1,32 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import sqlalchemy as sa
+
+from nose.tools import assert_raises
+from nose.tools import eq_
+from relengapi.lib.testing.queries import assert_max_queries
+from relengapi.lib.testing.queries import count_queries
+
+
+def test_count_queries():
+    """count_queries records the statements executed within the context"""
+    engine = sa.create_engine('sqlite://')
+    engine.execute('select 1')
+    with count_queries(engine) as statements:
+        engine.execute('select 2')
+        engine.execute('select 3')
+    engine.execute('select 4')
+    eq_(statements, ['select 2', 'select 3'])
+
+
+def test_assert_max_queries():
+    """assert_max_queries fails only if too many statements are executed"""
+    engine = sa.create_engine('sqlite://')
+    with assert_max_queries(engine, 1):
+        engine.execute('select 1')
+    with assert_raises(AssertionError):
+        with assert_max_queries(engine, 1):
+            engine.execute('select 1')
+            engine.execute('select 2')
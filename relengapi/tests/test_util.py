@@ -80,6 +80,28 @@ def test_is_browser(app):
                 "%s should %sbe a browser" % (headers, '' if is_browser else 'not '))
 
 
+def test_lru_cache():
+    cache = util.LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    eq_(cache.get('a'), 1)
+    # 'b' is now the least recently used, so it is discarded
+    cache.set('c', 3)
+    eq_(cache.get('b'), None)
+    eq_(cache.get('b', 'missing'), 'missing')
+    eq_(cache.get('a'), 1)
+    eq_(cache.get('c'), 3)
+    eq_(len(cache), 2)
+
+
+def test_lru_cache_clear():
+    cache = util.LRUCache(2)
+    cache.set('a', 1)
+    cache.clear()
+    eq_(cache.get('a'), None)
+    eq_(len(cache), 0)
+
+
 NOW = datetime.datetime(2014, 6, 15, 7, 15, 29, 612709)
 
 # datetime.datetime is a built-in type, so its attributes can't be mocked
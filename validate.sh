@@ -227,6 +227,8 @@ git_only='
     src
     settings_example.py
     misc/fiximports.py
+    misc/mapper_benchmark.py
+    misc/tooltool_search_benchmark.py
     misc/release.sh
 '
 git ls-files . | while read f; do